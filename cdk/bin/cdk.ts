@@ -6,6 +6,19 @@ import { CdkStack } from '../lib/cdk-stack';
 const app = new cdk.App();
 const projectName = "notion-webhooks";
 const intervalMinutes = 1;
+// Number of databases monitored by one invocation of the monitoring Lambda
+const monitoringGroupSize = 1;
+// Send the pages from monitoring to webhooks through an SQS FIFO queue
+const useWebhooksQueue = false;
+// Notify the changes of the database properties once, not on every page
+const schemaEvents = true;
+// Record the versions of the pages to fetch the missed changes later
+const changeHistory = true;
+// Hold the differences for a webhooks URL which keeps failing
+const circuitBreaker = true;
+// Concurrent executions of the webhooks Lambda (0 for no limit).
+// Monitoring invokes it at up to this many events per second.
+const webhooksConcurrency = 10;
 const logLevel = "DEBUG";
 
 new CdkStack(app, `${projectName}-stack`, {
@@ -24,6 +37,12 @@ new CdkStack(app, `${projectName}-stack`, {
   /* For more information, see https://docs.aws.amazon.com/cdk/latest/guide/environments.html */
   projectName,
   intervalMinutes,
+  monitoringGroupSize,
+  useWebhooksQueue,
+  schemaEvents,
+  changeHistory,
+  circuitBreaker,
+  webhooksConcurrency,
   logLevel,
   notionSecretKey: process.env.NOTION_SECRET_KEY,
   notionUserId: process.env.NOTION_USER_EMAIL,
@@ -4,13 +4,21 @@ import * as events from 'aws-cdk-lib/aws-events';
 import * as targets from 'aws-cdk-lib/aws-events-targets';
 import * as iam from 'aws-cdk-lib/aws-iam';
 import * as lambda from 'aws-cdk-lib/aws-lambda';
+import * as eventsources from 'aws-cdk-lib/aws-lambda-event-sources';
 import * as logs from 'aws-cdk-lib/aws-logs';
+import * as sqs from 'aws-cdk-lib/aws-sqs';
 import { Construct } from 'constructs';
 import { existsSync } from 'fs';
 
 export interface CustomizedProps extends cdk.StackProps {
   projectName: string;
   intervalMinutes: number;
+  monitoringGroupSize: number;
+  useWebhooksQueue: boolean;
+  schemaEvents: boolean;
+  changeHistory: boolean;
+  circuitBreaker: boolean;
+  webhooksConcurrency: number;
   logLevel: string;
   notionSecretKey: string | undefined;
   notionUserId: string | undefined,
@@ -75,6 +83,53 @@ export class CdkStack extends cdk.Stack {
       removalPolicy: cdk.RemovalPolicy.DESTROY,
     })
 
+    // The versions of the pages, indexed by the database and the time.
+    let dynamodbTableHistory: dynamodb.Table | undefined = undefined;
+    if (props.changeHistory) {
+      dynamodbTableHistory = new dynamodb.Table(this, "dynamodb-table-history", {
+        tableName: `${props.projectName}-history`,
+        partitionKey: {
+          name: "id",
+          type: dynamodb.AttributeType.STRING,
+        },
+        sortKey: {
+          name: "version",
+          type: dynamodb.AttributeType.NUMBER,
+        },
+        billingMode: dynamodb.BillingMode.PAY_PER_REQUEST,  // On-demand request
+        removalPolicy: cdk.RemovalPolicy.DESTROY,
+      })
+      dynamodbTableHistory.addGlobalSecondaryIndex({
+        indexName: "database_id-last_edited_time",
+        partitionKey: {
+          name: "database_id",
+          type: dynamodb.AttributeType.STRING,
+        },
+        sortKey: {
+          name: "last_edited_time",
+          type: dynamodb.AttributeType.STRING,
+        },
+      })
+    }
+
+    // The circuits of the webhooks URLs and the differences held for them
+    let dynamodbTableDelivery: dynamodb.Table | undefined = undefined;
+    if (props.circuitBreaker) {
+      dynamodbTableDelivery = new dynamodb.Table(this, "dynamodb-table-delivery", {
+        tableName: `${props.projectName}-delivery`,
+        partitionKey: {
+          name: "url",
+          type: dynamodb.AttributeType.STRING,
+        },
+        sortKey: {
+          name: "key",
+          type: dynamodb.AttributeType.STRING,
+        },
+        billingMode: dynamodb.BillingMode.PAY_PER_REQUEST,  // On-demand request
+        removalPolicy: cdk.RemovalPolicy.DESTROY,
+      })
+    }
+
     //////// Webhooks
     // IAM
     const iamPolicyForWebhooks = new iam.Policy(this, "iam-policy-dynamodb", {
@@ -99,6 +154,8 @@ export class CdkStack extends cdk.Stack {
       ]
     })
     iamRoleForWebhooks.attachInlinePolicy(iamPolicyForWebhooks);
+    dynamodbTableHistory?.grantReadWriteData(iamRoleForWebhooks);
+    dynamodbTableDelivery?.grantReadWriteData(iamRoleForWebhooks);
 
     // Lambda
     const lambdaWebhooks = new lambda.Function(this, "lambda-webhooks", {
@@ -108,22 +165,80 @@ export class CdkStack extends cdk.Stack {
       code: lambda.Code.fromAsset("../src/webhooks"),
       handler: "lambda_handler.lambda_function",
       role: iamRoleForWebhooks,
+      // The ceiling of the load on the webhooks URLs and the page info table
+      ...(props.webhooksConcurrency > 0 ? { reservedConcurrentExecutions: props.webhooksConcurrency } : {}),
       environment: {
         "LOGLEVEL": props.logLevel,
         "TABLE_NAME": dynamodbTablePageInfo.tableName,
+        ...(dynamodbTableHistory ? { "HISTORY_TABLE_NAME": dynamodbTableHistory.tableName } : {}),
+        ...(dynamodbTableDelivery ? { "DELIVERY_TABLE_NAME": dynamodbTableDelivery.tableName } : {}),
       },
       layers: [lambdaLayer],
       logGroup: logGroup,
     })
 
+    if (dynamodbTableDelivery) {
+      // Retry the differences held for the URLs which were down.
+      new events.Rule(this, "event-bridge-redeliver", {
+        ruleName: `${props.projectName}-redeliver`,
+        schedule: events.Schedule.cron({minute: `*/${props.intervalMinutes}`}),
+        targets: [new targets.LambdaFunction(lambdaWebhooks, {
+          event: events.RuleTargetInput.fromObject({
+            redeliver: true,
+          })
+        })]
+      })
+    }
+
+    // SQS
+    // Monitoring sends the pages to the queue instead of invoking webhooks.
+    let webhooksQueue: sqs.Queue | undefined = undefined;
+    if (props.useWebhooksQueue) {
+      const deadLetterQueue = new sqs.Queue(this, "sqs-webhooks-dlq", {
+        queueName: `${props.projectName}-webhooks-dlq.fifo`,
+        fifo: true,
+        retentionPeriod: cdk.Duration.days(14),
+        removalPolicy: cdk.RemovalPolicy.DESTROY,
+      })
+      webhooksQueue = new sqs.Queue(this, "sqs-webhooks", {
+        // FIFO keeps the order of the changes of each page.
+        queueName: `${props.projectName}-webhooks.fifo`,
+        fifo: true,
+        // Recommended to be 6 times the timeout of the function
+        visibilityTimeout: cdk.Duration.seconds(duration * 6),
+        deadLetterQueue: {
+          queue: deadLetterQueue,
+          maxReceiveCount: 5,
+        },
+        removalPolicy: cdk.RemovalPolicy.DESTROY,
+      })
+      lambdaWebhooks.addEventSource(new eventsources.SqsEventSource(webhooksQueue, {
+        batchSize: 10,
+        reportBatchItemFailures: true,
+        // Stay under the reserved concurrency instead of being throttled.
+        ...(props.webhooksConcurrency > 0 ? { maxConcurrency: Math.max(2, props.webhooksConcurrency) } : {}),
+      }))
+    }
+
     //////// Monitoring
     // IAM
+    const lambdaMonitoringName = `${props.projectName}-monitoring-lambda`;
     const iamPolicyForMonitoring = new iam.Policy(this, "iam-policy-lambda-monitoring", {
       policyName: `${props.projectName}-lambda-invoke-policy`,
       statements: [
         new iam.PolicyStatement({
           actions: ["lambda:InvokeFunction"],
-          resources: [lambdaWebhooks.functionArn],
+          resources: [
+            lambdaWebhooks.functionArn,
+            // Re-invoke itself to continue a query before the timeout.
+            // The ARN is built from the name to avoid a circular dependency.
+            this.formatArn({
+              service: "lambda",
+              resource: "function",
+              resourceName: lambdaMonitoringName,
+              arnFormat: cdk.ArnFormat.COLON_RESOURCE_NAME,
+            }),
+          ],
         })
       ]
     })
@@ -137,10 +252,13 @@ export class CdkStack extends cdk.Stack {
       ]
     });
     iamRoleForMonitoring.attachInlinePolicy(iamPolicyForMonitoring);
+    webhooksQueue?.grantSendMessages(iamRoleForMonitoring);
+    // Read the congestion reported by webhooks.
+    dynamodbTablePageInfo.grantReadData(iamRoleForMonitoring);
 
     // Lambda
     const lambdaMonitoring = new lambda.Function(this, "lambda-monitoring", {
-      functionName: `${props.projectName}-monitoring-lambda`,
+      functionName: lambdaMonitoringName,
       runtime: lambda.Runtime.PYTHON_3_12,
       timeout: cdk.Duration.seconds(duration),
       code: lambda.Code.fromAsset("../src/monitoring"),
@@ -151,6 +269,10 @@ export class CdkStack extends cdk.Stack {
         "SECRET_KEY": props.notionSecretKey,
         "INTERVAL_MINUTES": String(props.intervalMinutes),
         "LAMBDA_NAME_WEBHOOKS": lambdaWebhooks.functionName,
+        "SCHEMA_EVENTS": String(props.schemaEvents),
+        "TABLE_NAME_PAGE_INFO": dynamodbTablePageInfo.tableName,
+        ...(props.webhooksConcurrency > 0 ? { "WEBHOOKS_MAX_RATE": String(props.webhooksConcurrency) } : {}),
+        ...(webhooksQueue ? { "WEBHOOKS_QUEUE_URL": webhooksQueue.queueUrl } : {}),
       },
       layers: [lambdaLayer],
       logGroup: logGroup,
@@ -196,11 +318,47 @@ export class CdkStack extends cdk.Stack {
         "LOGLEVEL": props.logLevel,
         "TABLE_NAME": dynamodbTableDatabaseId.tableName,
         "LAMBDA_NAME_MONITORING": lambdaMonitoring.functionName,
+        "MONITORING_GROUP_SIZE": String(props.monitoringGroupSize),
       },
       layers: [lambdaLayer],
       logGroup: logGroup,
     })
 
+    //////// Changes
+    // Consumers pull the changes of a database from the history.
+    if (dynamodbTableHistory) {
+      const iamRoleForChanges = new iam.Role(this, "iam-role-lambda-changes", {
+        roleName: `${props.projectName}-changes-lambda-role`,
+        assumedBy: new iam.ServicePrincipal("lambda.amazonaws.com"),
+        managedPolicies: [
+          {
+            "managedPolicyArn": "arn:aws:iam::aws:policy/service-role/AWSLambdaBasicExecutionRole"
+          }
+        ]
+      });
+      dynamodbTableHistory.grantReadData(iamRoleForChanges);
+
+      const lambdaChanges = new lambda.Function(this, "lambda-changes", {
+        functionName: `${props.projectName}-changes-lambda`,
+        runtime: lambda.Runtime.PYTHON_3_12,
+        timeout: cdk.Duration.seconds(30),
+        code: lambda.Code.fromAsset("../src/changes"),
+        handler: "lambda_handler.lambda_function",
+        role: iamRoleForChanges,
+        environment: {
+          "LOGLEVEL": props.logLevel,
+          "HISTORY_TABLE_NAME": dynamodbTableHistory.tableName,
+        },
+        layers: [lambdaLayer],
+        logGroup: logGroup,
+      })
+      // Only the principals allowed to invoke the URL can read the changes.
+      const changesUrl = lambdaChanges.addFunctionUrl({
+        authType: lambda.FunctionUrlAuthType.AWS_IAM,
+      })
+      new cdk.CfnOutput(this, "changes-url", { value: changesUrl.url })
+    }
+
     // EventBridge
     new events.Rule(this, "event-bridge", {
       ruleName: `${props.projectName}-schedule`,
@@ -2,4 +2,7 @@ export LIB_DIRECTORY=./lib/python/
 rm -rf "$LIB_DIRECTORY"
 mkdir -p "$LIB_DIRECTORY"
 
-pip install -t "$LIB_DIRECTORY" -r requirements.lock
+# The shared package (src/notion_webhooks) is installed as a regular package,
+# because an editable install (`-e file:.` of the lock file) doesn't work in a layer.
+grep -v '^-e ' requirements.lock | pip install -t "$LIB_DIRECTORY" -r /dev/stdin
+pip install -t "$LIB_DIRECTORY" --no-deps .
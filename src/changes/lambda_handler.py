@@ -0,0 +1,130 @@
+import base64
+import binascii
+import functools
+import json
+import os
+from datetime import datetime, timezone
+from typing import Any, Dict, Optional
+
+from aws_lambda_powertools import Logger
+from aws_lambda_powertools.utilities.typing import LambdaContext
+
+from notion_webhooks.history import ChangeHistory, create_change_history
+
+if os.getenv("LOGLEVEL"):
+    log_level = os.getenv("LOGLEVEL")
+else:
+    log_level = "INFO"
+logger = Logger()
+logger.setLevel(log_level)
+
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 1000
+
+
+class BadRequest(Exception):
+    pass
+
+
+@functools.lru_cache(maxsize=None)
+def get_change_history() -> ChangeHistory:
+    # Created once per container and reused by the following requests.
+    history = create_change_history()
+    if history is None:
+        raise RuntimeError("HISTORY_TABLE_NAME is not set")
+    return history
+
+
+def encode_token(last_evaluated_key: Dict[str, Any]) -> str:
+    text = json.dumps(last_evaluated_key, separators=(",", ":"))
+    return base64.urlsafe_b64encode(text.encode()).decode()
+
+
+def decode_token(token: str) -> Dict[str, Any]:
+    try:
+        key = json.loads(base64.urlsafe_b64decode(token.encode()))
+    except (binascii.Error, ValueError):
+        raise BadRequest("invalid next_token")
+    if not isinstance(key, dict):
+        raise BadRequest("invalid next_token")
+    return key
+
+
+def _normalize_time(text: str) -> str:
+    """Format the time as Notion does, to compare it as a string."""
+    try:
+        dt = datetime.fromisoformat(text.replace("Z", "+00:00"))
+    except ValueError:
+        raise BadRequest(f"invalid since: {text}")
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    dt = dt.astimezone(timezone.utc)
+    return dt.strftime("%Y-%m-%dT%H:%M:%S.") + f"{dt.microsecond // 1000:03}Z"
+
+
+def _get_params(event: Dict[str, Any]) -> Dict[str, Any]:
+    # A request of the function URL, or a direct invocation.
+    if "requestContext" in event:
+        return event.get("queryStringParameters") or {}
+    return event
+
+
+def query_changes(
+    database_id: str,
+    since: str,
+    limit: Optional[int] = None,
+    next_token: Optional[str] = None,
+) -> Dict[str, Any]:
+    """Return the changes of the database after ``since``.
+
+    ``next_token`` is returned while there are more changes, to be passed
+    to get the next ones.
+    """
+    limit = min(limit or DEFAULT_LIMIT, MAX_LIMIT)
+    start_key = decode_token(next_token) if next_token else None
+
+    changes, last_key = get_change_history().query_changes(
+        database_id, _normalize_time(since), limit, start_key
+    )
+    logger.info("database id: %s, changes: %s", database_id, len(changes))
+
+    result: Dict[str, Any] = {"changes": changes}
+    if last_key:
+        result["next_token"] = encode_token(last_key)
+    return result
+
+
+def _query(params: Dict[str, Any]) -> Dict[str, Any]:
+    for name in ["database_id", "since"]:
+        if not params.get(name):
+            raise BadRequest(f"{name} is required")
+    try:
+        limit = int(params.get("limit") or DEFAULT_LIMIT)
+    except ValueError:
+        raise BadRequest("limit must be an integer")
+    if limit <= 0:
+        raise BadRequest("limit must be positive")
+
+    return query_changes(
+        params["database_id"], params["since"], limit, params.get("next_token")
+    )
+
+
+@logger.inject_lambda_context
+def lambda_function(event: Dict[str, Any], context: LambdaContext):
+    logger.debug("event: %s", event)
+    params = _get_params(event)
+    try:
+        result = _query(params)
+    except BadRequest as e:
+        if "requestContext" not in event:
+            raise
+        return {"statusCode": 400, "body": json.dumps({"message": str(e)})}
+
+    if "requestContext" not in event:
+        return result
+    return {
+        "statusCode": 200,
+        "headers": {"Content-Type": "application/json"},
+        "body": json.dumps(result, ensure_ascii=False),
+    }
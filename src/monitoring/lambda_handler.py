@@ -1,14 +1,22 @@
+import functools
 import json
 import os
+import threading
+import time
 import urllib.parse
 import urllib.request
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta, timezone
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
 
 import boto3
 from aws_lambda_powertools import Logger
 from aws_lambda_powertools.utilities.data_classes import EventBridgeEvent
 from aws_lambda_powertools.utilities.typing import LambdaContext
 
+from notion_webhooks.backpressure import Backpressure
+from notion_webhooks.snapshot_store import create_snapshot_store
+
 if os.getenv("LOGLEVEL"):
     log_level = os.getenv("LOGLEVEL")
 else:
@@ -16,21 +24,141 @@ else:
 logger = Logger()
 logger.setLevel(log_level)
 
+
+@functools.lru_cache(maxsize=None)
+def get_client(service_name: str):
+    # Created once per container and reused by the following invocations.
+    return boto3.client(service_name)
+
+
 ENDPOINT_ROOT = "https://api.notion.com/v1"
 
+# Notion allows an average of three requests per second per integration.
+DEFAULT_RATE_LIMIT = 3
+DEFAULT_MAX_WORKERS = 4
+DEFAULT_BACKFILL_SLICE_MINUTES = 60
+# Keys of the event describing how far a previous invocation got.
+CONTINUATION_KEYS = ("continuation", "backfill")
+# Limits of SendMessageBatch
+SQS_BATCH_SIZE = 10
+SQS_MAX_BATCH_BYTES = 256 * 1024
+SQS_MAX_RETRIES = 3
+# Pace of the invocations of webhooks (per second), adapted by AIMD
+DEFAULT_WEBHOOKS_MAX_RATE = 50
+DEFAULT_WEBHOOKS_MIN_RATE = 1
+# An async invoke usually returns in tens of milliseconds. Slower ones
+# mean the retries of the throttled requests inside boto3.
+DEFAULT_SLOW_INVOKE_SECONDS = 1.0
+INVOKE_MAX_RETRIES = 3
 
-def _build_filter_conditions():
-    now = datetime.now(timezone.utc)
-    dt_end = now.replace(second=0, microsecond=0)
-    interval = int(os.environ["INTERVAL_MINUTES"])
-    dt_start = dt_end - timedelta(minutes=interval)
 
+class RateLimiter:
+    """Rate limiter shared by all threads of one invocation.
+
+    Each request reserves the next free slot and sleeps once until it, so
+    up to ``capacity`` requests may start at once. The slots are computed
+    from ``clock`` without polling it, so a clock which does not advance
+    (e.g. frozen in tests) slows the requests down but never spins.
+    """
+
+    def __init__(
+        self,
+        rate: float,
+        capacity: Optional[float] = None,
+        clock: Callable[[], float] = time.monotonic,
+        sleep: Callable[[float], None] = time.sleep,
+    ):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self._clock = clock
+        self._sleep = sleep
+        self._next = clock()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            now = self._clock()
+            slot = max(self._next, now)
+            self._next = slot + 1 / self.rate
+            wait = slot - now - (self.capacity - 1) / self.rate
+        if wait > 0:
+            self._sleep(wait)
+
+
+class AdaptiveRateLimiter(RateLimiter):
+    """Rate limiter whose rate is adapted by AIMD.
+
+    The rate increases by ``increase`` per second's worth of successful
+    requests, and is multiplied by ``decrease`` on congestion.
+    """
+
+    def __init__(
+        self,
+        min_rate: float,
+        max_rate: float,
+        increase: float = 1.0,
+        decrease: float = 0.5,
+        clock: Callable[[], float] = time.monotonic,
+        sleep: Callable[[float], None] = time.sleep,
+    ):
+        # Start at a quarter of the ceiling, with a burst of one second.
+        rate = max(min_rate, max_rate / 4)
+        super().__init__(rate, max(1.0, rate), clock, sleep)
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.decrease = decrease
+        self._reported_at = 0.0
+
+    def on_success(self):
+        with self._lock:
+            rate = self.rate + self.increase / self.rate
+            self.rate = min(self.max_rate, rate)
+
+    def on_congestion(self):
+        with self._lock:
+            self.rate = max(self.min_rate, self.rate * self.decrease)
+            rate = self.rate
+        logger.info("webhooks rate decreased: %.1f/s", rate)
+
+    def on_backpressure(self, reported_at: float):
+        """Slow down once per congestion reported by webhooks."""
+        with self._lock:
+            if reported_at <= self._reported_at:
+                return
+            self._reported_at = reported_at
+        self.on_congestion()
+
+
+@functools.lru_cache(maxsize=None)
+def get_webhooks_rate_limiter() -> AdaptiveRateLimiter:
+    # Kept per container, so the next invocation starts at the learned rate.
+    min_rate = os.getenv("WEBHOOKS_MIN_RATE", DEFAULT_WEBHOOKS_MIN_RATE)
+    max_rate = os.getenv("WEBHOOKS_MAX_RATE", DEFAULT_WEBHOOKS_MAX_RATE)
+    return AdaptiveRateLimiter(float(min_rate), float(max_rate))
+
+
+@functools.lru_cache(maxsize=None)
+def get_backpressure() -> Optional[Backpressure]:
+    # None unless TABLE_NAME_PAGE_INFO is set.
+    table_name = os.getenv("TABLE_NAME_PAGE_INFO")
+    if not table_name:
+        return None
+    client = get_client("dynamodb")
+    store = create_snapshot_store("dynamodb", table_name, client=client)
+    return Backpressure(store)
+
+
+def _build_time_window(
+    dt_start: datetime, dt_end: datetime, inclusive_start: bool = False
+) -> Dict[str, Any]:
+    start_operator = "on_or_after" if inclusive_start else "after"
     cond = {
         "and": [
             {
                 "timestamp": "last_edited_time",
                 "last_edited_time": {
-                    "after": dt_start.isoformat(),
+                    start_operator: dt_start.isoformat(),
                 },
             },
             {
@@ -44,21 +172,99 @@ def _build_filter_conditions():
     return cond
 
 
-def query_database(database_id, filter_conditions):
-    logger.debug("query_database filter conditions: %s", filter_conditions)
+def _build_filter_conditions():
+    now = datetime.now(timezone.utc)
+    dt_end = now.replace(second=0, microsecond=0)
+    interval = int(os.environ["INTERVAL_MINUTES"])
+    dt_start = dt_end - timedelta(minutes=interval)
 
-    url = f"{ENDPOINT_ROOT}/databases/{database_id}/query"
-    logger.debug("query_database url: %s", url)
+    return _build_time_window(dt_start, dt_end)
+
+
+def _debounce(time_window: Dict[str, Any], minutes: int) -> Dict[str, Any]:
+    """Shift the time window back by ``minutes``.
+
+    A page is found only after it has not been edited for ``minutes``, so
+    the successive edits of the page are sent as one page information and
+    webhooks takes a single difference from the last snapshot.
+    """
+    conds = []
+    for cond in time_window["and"]:
+        ((operator, value),) = cond["last_edited_time"].items()
+        dt = _parse_datetime(value) - timedelta(minutes=minutes)
+        conds.append(cond | {"last_edited_time": {operator: dt.isoformat()}})
+    return {"and": conds}
+
+
+def _with_database_filter(
+    filter_conditions: Dict[str, Any], database_filter: Optional[Dict]
+) -> Dict[str, Any]:
+    """AND-combine the time window with the filter of the database."""
+    if not database_filter:
+        return filter_conditions
 
+    return {"and": filter_conditions["and"] + [database_filter]}
+
+
+def _parse_datetime(text: str) -> datetime:
+    # Notion returns "Z" as UTC designator, which fromisoformat of
+    # Python < 3.11 does not accept.
+    dt = datetime.fromisoformat(text.replace("Z", "+00:00"))
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return dt
+
+
+def _split_time_range(
+    dt_start: datetime, dt_end: datetime, slice_minutes: int
+) -> List[Tuple[datetime, datetime]]:
+    slices = []
+    step = timedelta(minutes=slice_minutes)
+    current = dt_start
+    while True:
+        next_ = min(current + step, dt_end)
+        slices.append((current, next_))
+        if next_ >= dt_end:
+            return slices
+        current = next_
+
+
+def _notion_headers() -> Dict[str, str]:
     SECRET_KEY = os.environ["SECRET_KEY"]
-    headers = {
+    return {
         "Authorization": f"Bearer {SECRET_KEY}",
         "Content-Type": "application/json",
         "Notion-Version": "2022-06-28",
     }
 
-    results = []
-    next_cursor = ""
+
+def iter_query_database(
+    database_id,
+    filter_conditions,
+    rate_limiter: Optional[RateLimiter] = None,
+    start_cursor: str = "",
+    filter_properties: Optional[List[str]] = None,
+) -> Iterator[Tuple[str, List[Dict[str, Any]]]]:
+    """Yield the cursor of each request together with the pages it returned.
+
+    Passing the yielded cursor back as ``start_cursor`` resumes the query
+    from that request. ``filter_properties`` limits the properties in the
+    response to the given property IDs.
+    """
+    logger.debug("query_database filter conditions: %s", filter_conditions)
+
+    url = f"{ENDPOINT_ROOT}/databases/{database_id}/query"
+    if filter_properties:
+        # Property IDs are returned URL-encoded by Notion, so keep "%" as is.
+        url += "?" + "&".join(
+            "filter_properties=" + urllib.parse.quote(id_, safe="%")
+            for id_ in filter_properties
+        )
+    logger.debug("query_database url: %s", url)
+
+    headers = _notion_headers()
+
+    next_cursor = start_cursor
     has_more = True
     while has_more:
         body = {
@@ -68,46 +274,507 @@ def query_database(database_id, filter_conditions):
         if next_cursor:
             body["start_cursor"] = next_cursor
 
+        if rate_limiter:
+            rate_limiter.acquire()
+
         # "Add connect" is required in the Notion database settings
         req = urllib.request.Request(url, json.dumps(body).encode(), headers)
         with urllib.request.urlopen(req) as res:
             body = json.load(res)
 
-        results += body["results"]
+        yield next_cursor, body["results"]
 
         next_cursor = body["next_cursor"]
         has_more = body["has_more"]
 
+
+def query_database(
+    database_id,
+    filter_conditions,
+    rate_limiter: Optional[RateLimiter] = None,
+    filter_properties: Optional[List[str]] = None,
+):
+    results = []
+    query = iter_query_database(
+        database_id,
+        filter_conditions,
+        rate_limiter,
+        filter_properties=filter_properties,
+    )
+    for _, pages in query:
+        results += pages
+
     return results
 
 
-@logger.inject_lambda_context
-def lambda_function(event: EventBridgeEvent, context: LambdaContext):
-    logger.structure_logs(append=True, request_id=event.get("request_id"))
+def fetch_database_schema(
+    database_id, rate_limiter: Optional[RateLimiter] = None
+) -> Dict[str, Any]:
+    """Return the properties of the database, with its last_edited_time."""
+    url = f"{ENDPOINT_ROOT}/databases/{database_id}"
+    if rate_limiter:
+        rate_limiter.acquire()
 
-    logger.info("event: %s", event)
-    database_id = event["database_id"]
-    webhooks_url = event["webhooks_url"]
-    lambda_name = os.environ["LAMBDA_NAME_WEBHOOKS"]
+    req = urllib.request.Request(url, headers=_notion_headers())
+    with urllib.request.urlopen(req) as res:
+        body = json.load(res)
+
+    properties = {
+        name: {"id": prop["id"], "name": prop["name"], "type": prop["type"]}
+        for name, prop in body["properties"].items()
+    }
+    return {
+        "id": database_id,
+        "last_edited_time": body["last_edited_time"],
+        "properties": properties,
+    }
+
+
+def _project_page(
+    page: Dict[str, Any], watched_properties: Optional[List[str]]
+) -> Dict[str, Any]:
+    """Keep only the watched properties (by property ID) of the page."""
+    if not watched_properties:
+        return page
+
+    properties = {
+        name: prop
+        for name, prop in page.get("properties", {}).items()
+        if prop["id"] in watched_properties
+    }
+    return page | {"properties": properties}
+
+
+def _get_databases(event: Dict[str, Any]) -> List[Dict[str, Any]]:
+    # A coalesced event carries several databases, a plain one only one.
+    if "databases" in event:
+        return event["databases"]
+
+    return [{k: v for k, v in event.items() if k != "request_id"}]
+
+
+def _is_running_out_of_time(context: Optional[LambdaContext]) -> bool:
+    if context is None:
+        # Not running on Lambda, there is no time limit.
+        return False
+
+    margin = int(os.getenv("CONTINUATION_MARGIN_SECONDS", "30"))
+    return context.get_remaining_time_in_millis() < margin * 1000
 
-    filter_conditions = _build_filter_conditions()
-    results = query_database(database_id, filter_conditions)
-    logger.info("pages count: %s", len(results))
 
-    client = boto3.client("lambda")
-    for r in results:
-        id_ = r["id"]
-        logger.info("page id: %s", id_)
-        logger.debug("page: %s", r)
+def _continue_later(
+    database: Dict[str, Any],
+    state: Dict[str, Any],
+    request_id: Optional[str],
+    context: LambdaContext,
+):
+    next_event = dict(database)
+    for key in CONTINUATION_KEYS:
+        next_event.pop(key, None)
+    next_event |= state | {"request_id": request_id}
+    logger.info("continue with: %s", next_event)
+
+    client = get_client("lambda")
+    client.invoke(
+        FunctionName=context.function_name,
+        InvocationType="Event",
+        Payload=json.dumps(next_event),
+    )
+
+
+class Dispatcher:
+    """Send the events of the pages and schemas to webhooks.
+
+    ``send`` gets the key which orders the events: the events of the same
+    key must be processed in the order they are sent, if possible.
+    """
+
+    def dispatch(
+        self,
+        webhooks_url: List[str],
+        page,
+        request_id,
+        database_properties: Optional[List[str]] = None,
+        database_id: Optional[str] = None,
+    ):
+        logger.info("page id: %s", page["id"])
+        logger.debug("page: %s", page)
+
+        next_event = {
+            "webhooks_url": webhooks_url,
+            "page_info": page,
+            "request_id": request_id,
+        }
+        if database_properties is not None:
+            next_event["database_properties"] = database_properties
+        if database_id is not None:
+            # Recorded with the change history of the page.
+            next_event["database_id"] = database_id
+        version = f"{page['id']}_{page['last_edited_time']}"
+        self.send(next_event, page["id"], version)
+
+    def dispatch_schema(self, webhooks_url: List[str], schema, request_id):
+        logger.info("schema of database id: %s", schema["id"])
 
         next_event = {
             "webhooks_url": webhooks_url,
-            "page_info": r,
-            "request_id": event.get("request_id"),
+            "schema": schema,
+            "request_id": request_id,
         }
+        version = f"{schema['id']}_{schema['last_edited_time']}"
+        self.send(next_event, schema["id"], version)
+
+    def send(self, event: Dict[str, Any], key: str, version: str):
+        raise NotImplementedError
+
+    def flush(self):
+        # Every event is sent as soon as it is dispatched.
+        pass
+
+
+class LambdaDispatcher(Dispatcher):
+    """Send each event to the webhooks Lambda with an async invoke.
+
+    The invocations are paced by ``get_webhooks_rate_limiter``, which slows
+    down when an invoke is throttled or slow, or when webhooks reports that
+    the events wait too long (``get_backpressure``). It speeds up again
+    otherwise.
+    """
+
+    def __init__(self):
+        self.client = get_client("lambda")
+        self.lambda_name = os.environ["LAMBDA_NAME_WEBHOOKS"]
+        self.rate_limiter = get_webhooks_rate_limiter()
+        slow = os.getenv("SLOW_INVOKE_SECONDS", DEFAULT_SLOW_INVOKE_SECONDS)
+        self.slow_invoke_seconds = float(slow)
+
+        backpressure = get_backpressure()
+        if backpressure is not None:
+            interval = int(os.environ["INTERVAL_MINUTES"]) * 60
+            reported_at = backpressure.reported_at(interval)
+            if reported_at is not None:
+                self.rate_limiter.on_backpressure(reported_at)
+
+    def send(self, event: Dict[str, Any], key: str, version: str):
+        # Webhooks measures the lag from here.
+        payload = json.dumps(event | {"dispatched_at": time.time()})
+        throttled = self.client.exceptions.TooManyRequestsException
+        for retry in range(INVOKE_MAX_RETRIES + 1):
+            self.rate_limiter.acquire()
+            start = time.monotonic()
+            try:
+                self.client.invoke(
+                    FunctionName=self.lambda_name,
+                    InvocationType="Event",
+                    Payload=payload,
+                )
+            except throttled:
+                self.rate_limiter.on_congestion()
+                if retry == INVOKE_MAX_RETRIES:
+                    raise
+                continue
+
+            if time.monotonic() - start > self.slow_invoke_seconds:
+                self.rate_limiter.on_congestion()
+            else:
+                self.rate_limiter.on_success()
+            return
+
+
+class SqsDispatcher(Dispatcher):
+    """Send the events to the webhooks queue with SendMessageBatch.
+
+    On a FIFO queue the events are grouped by page (or database) ID, so the
+    changes of a page are processed in order.
+    """
+
+    def __init__(self, queue_url: str):
+        self.client = get_client("sqs")
+        self.queue_url = queue_url
+        self.fifo = queue_url.endswith(".fifo")
+        self._entries: List[Dict[str, Any]] = []
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def send(self, event: Dict[str, Any], key: str, version: str):
+        entry = {"MessageBody": json.dumps(event)}
+        if self.fifo:
+            entry["MessageGroupId"] = key
+            entry["MessageDeduplicationId"] = version
+        size = len(entry["MessageBody"].encode())
+
+        batches = []
+        with self._lock:
+            if self._entries and self._size + size > SQS_MAX_BATCH_BYTES:
+                batches.append(self._take_entries())
+            entry["Id"] = str(len(self._entries))
+            self._entries.append(entry)
+            self._size += size
+            if len(self._entries) == SQS_BATCH_SIZE:
+                batches.append(self._take_entries())
+
+        # Send without the lock, so that other threads keep dispatching.
+        for batch in batches:
+            self._send(batch)
+
+    def flush(self):
+        with self._lock:
+            batch = self._take_entries()
+        self._send(batch)
+
+    def _take_entries(self) -> List[Dict[str, Any]]:
+        entries = self._entries
+        self._entries = []
+        self._size = 0
+        return entries
+
+    def _send(self, entries: List[Dict[str, Any]]):
+        for retry in range(SQS_MAX_RETRIES + 1):
+            if not entries:
+                return
+            if retry:
+                time.sleep(0.1 * 2**retry)
+            ret = self.client.send_message_batch(
+                QueueUrl=self.queue_url, Entries=entries
+            )
+            failed = {f["Id"] for f in ret.get("Failed", [])}
+            entries = [e for e in entries if e["Id"] in failed]
+
+        raise RuntimeError(f"failed to send {len(entries)} events to SQS")
+
+
+def _create_dispatcher():
+    queue_url = os.getenv("WEBHOOKS_QUEUE_URL")
+    if queue_url:
+        return SqsDispatcher(queue_url)
+    return LambdaDispatcher()
+
+
+# last_edited_time of the schema of each database dispatched by this
+# container, so that a schema is dispatched only when it has changed.
+_schema_versions: Dict[str, str] = {}
+_schema_lock = threading.Lock()
+
+
+def _track_schema(
+    database: Dict[str, Any],
+    rate_limiter: RateLimiter,
+    request_id: Optional[str],
+    dispatcher: Dispatcher,
+) -> Optional[List[str]]:
+    """Dispatch the schema of the database if it has changed, and return
+    the names of its (watched) properties.
+
+    ``None`` if the schema is not tracked (``SCHEMA_EVENTS``).
+    """
+    if os.getenv("SCHEMA_EVENTS", "false").lower() != "true":
+        return None
+
+    database_id = database["database_id"]
+    schema = fetch_database_schema(database_id, rate_limiter)
+    schema = _project_page(schema, database.get("watched_properties"))
 
-        client.invoke(
-            FunctionName=lambda_name,
-            InvocationType="Event",
-            Payload=json.dumps(next_event),
+    with _schema_lock:
+        version = _schema_versions.get(database_id)
+    if version != schema["last_edited_time"]:
+        # Webhooks compares it with the saved one, so a schema dispatched by
+        # another container again is not notified twice.
+        webhooks_url = database["webhooks_url"]
+        dispatcher.dispatch_schema(webhooks_url, schema, request_id)
+        with _schema_lock:
+            _schema_versions[database_id] = schema["last_edited_time"]
+
+    return list(schema["properties"])
+
+
+def _edit_order(page: Dict[str, Any]) -> Tuple[str, str]:
+    return page["last_edited_time"], page["id"]
+
+
+def backfill_database(
+    database: Dict[str, Any],
+    rate_limiter: RateLimiter,
+    request_id: Optional[str],
+    context: Optional[LambdaContext],
+    dispatcher,
+):
+    database_id = database["database_id"]
+    webhooks_url = database["webhooks_url"]
+    watched = database.get("watched_properties")
+
+    backfill = database["backfill"]
+    dt_start = _parse_datetime(backfill["start"])
+    dt_end = _parse_datetime(backfill["end"])
+    slice_minutes = backfill.get("slice_minutes")
+    slice_minutes = int(slice_minutes or DEFAULT_BACKFILL_SLICE_MINUTES)
+    # Set only when a previous invocation ran out of time: pages edited at
+    # exactly `start` which were dispatched already.
+    resumed = "dispatched" in backfill
+    dispatched = backfill.get("dispatched", [])
+
+    slices = _split_time_range(dt_start, dt_end, slice_minutes)
+    filters = [
+        _with_database_filter(
+            _build_time_window(s, e, inclusive_start=(i == 0 and resumed)),
+            database.get("filter"),
         )
+        for i, (s, e) in enumerate(slices)
+    ]
+    logger.info("backfill %s in %s slices", database_id, len(slices))
+
+    max_workers = int(os.getenv("MONITORING_MAX_WORKERS", DEFAULT_MAX_WORKERS))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = executor.map(
+            lambda f: query_database(database_id, f, rate_limiter, watched),
+            filters,
+        )
+        pages = {}
+        for r in results:
+            for page in r:
+                pages[page["id"]] = page
+
+    # Every page appears only once, with its latest state. Dispatching them
+    # in order of edit keeps the webhooks path the same as live monitoring.
+    ordered = sorted(pages.values(), key=_edit_order)
+    properties = None
+    if ordered:
+        args = (rate_limiter, request_id, dispatcher)
+        properties = _track_schema(database, *args)
+
+    current_time = backfill["start"]
+    dispatched_at_current_time = list(dispatched)
+    for page in ordered:
+        if page["id"] in dispatched:
+            continue
+
+        last_edited_time = page["last_edited_time"]
+        if last_edited_time != current_time:
+            current_time = last_edited_time
+            dispatched_at_current_time = []
+
+        if _is_running_out_of_time(context):
+            state = {
+                "backfill": {
+                    "start": last_edited_time,
+                    "end": backfill["end"],
+                    "slice_minutes": slice_minutes,
+                    "dispatched": dispatched_at_current_time,
+                }
+            }
+            _continue_later(database, state, request_id, context)
+            return
+
+        page = _project_page(page, watched)
+        args = (request_id, properties, database_id)
+        dispatcher.dispatch(webhooks_url, page, *args)
+        dispatched_at_current_time.append(page["id"])
+
+    logger.info("database id: %s, pages count: %s", database_id, len(pages))
+
+
+def monitor_database(
+    database: Dict[str, Any],
+    time_window: Dict[str, Any],
+    rate_limiter: RateLimiter,
+    request_id: Optional[str],
+    context: Optional[LambdaContext],
+    dispatcher,
+):
+    if "backfill" in database:
+        args = (rate_limiter, request_id, context, dispatcher)
+        backfill_database(database, *args)
+        return
+
+    database_id = database["database_id"]
+    webhooks_url = database["webhooks_url"]
+    watched = database.get("watched_properties")
+    database_filter = database.get("filter")
+    if database.get("debounce_minutes"):
+        time_window = _debounce(time_window, database["debounce_minutes"])
+
+    # A continuation resumes the query of a previous invocation which ran
+    # out of time, with the same time window it started with.
+    continuation = database.get("continuation", {})
+    filter_conditions = _with_database_filter(time_window, database_filter)
+    filter_conditions = continuation.get("filter", filter_conditions)
+    start_cursor = continuation.get("start_cursor", "")
+    offset = continuation.get("offset", 0)
+
+    count = 0
+    # Fetched with the first page, the databases without changes need none.
+    properties = None
+    for cursor, results in iter_query_database(
+        database_id, filter_conditions, rate_limiter, start_cursor, watched
+    ):
+        for i in range(offset, len(results)):
+            if _is_running_out_of_time(context):
+                continuation = {
+                    "filter": filter_conditions,
+                    "start_cursor": cursor,
+                    "offset": i,
+                }
+                state = {"continuation": continuation}
+                _continue_later(database, state, request_id, context)
+                return
+
+            if count == 0:
+                args = (rate_limiter, request_id, dispatcher)
+                properties = _track_schema(database, *args)
+
+            page = _project_page(results[i], watched)
+            args = (request_id, properties, database_id)
+            dispatcher.dispatch(webhooks_url, page, *args)
+            count += 1
+        offset = 0
+
+    logger.info("database id: %s, pages count: %s", database_id, count)
+
+
+def monitor_event(
+    event: Dict[str, Any],
+    context: Optional[LambdaContext] = None,
+    dispatcher=None,
+):
+    """Monitor the databases of an event from orchestration.
+
+    ``dispatcher`` receives the pages to be diffed. It defaults to the
+    webhooks queue if ``WEBHOOKS_QUEUE_URL`` is set, otherwise to invoking
+    the webhooks Lambda. Without ``context`` there is no time limit.
+    """
+    if dispatcher is None:
+        dispatcher = _create_dispatcher()
+
+    databases = _get_databases(event)
+
+    filter_conditions = _build_filter_conditions()
+    rate_limiter = RateLimiter(
+        float(os.getenv("NOTION_RATE_LIMIT", DEFAULT_RATE_LIMIT))
+    )
+
+    request_id = event.get("request_id")
+    args = (filter_conditions, rate_limiter, request_id, context, dispatcher)
+    try:
+        if len(databases) == 1:
+            monitor_database(databases[0], *args)
+            return
+
+        workers = os.getenv("MONITORING_MAX_WORKERS", DEFAULT_MAX_WORKERS)
+        with ThreadPoolExecutor(max_workers=int(workers)) as executor:
+            futures = []
+            for database in databases:
+                future = executor.submit(monitor_database, database, *args)
+                futures.append(future)
+            # Surface the first failure after every database had its chance.
+            for future in futures:
+                future.result()
+    finally:
+        # Send the pages found so far even if a database failed.
+        dispatcher.flush()
+
+
+@logger.inject_lambda_context
+def lambda_function(event: EventBridgeEvent, context: LambdaContext):
+    logger.structure_logs(append=True, request_id=event.get("request_id"))
+
+    logger.info("event: %s", event)
+    monitor_event(event, context)
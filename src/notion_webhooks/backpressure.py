@@ -0,0 +1,69 @@
+"""The congestion of webhooks, fed back to monitoring.
+
+Monitoring invokes webhooks asynchronously, so the invoke returns before
+the event is processed. It doesn't see the events waiting for a webhooks
+container (throttled by the reserved concurrency), nor the slow webhooks
+URLs which keep the containers busy. Both show up as the lag between the
+dispatch of an event and its processing.
+
+Webhooks reports a lag over ``max_lag_seconds`` to the snapshot store, and
+monitoring slows down while the report is recent.
+"""
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Optional
+
+from notion_webhooks.snapshot_store import SnapshotStore
+
+# Saved with the pages, the key doesn't collide with a page ID.
+PRESSURE_KEY = "pressure#webhooks"
+DEFAULT_MAX_LAG_SECONDS = 30
+# Seconds between the reports of a container
+REPORT_INTERVAL_SECONDS = 10
+
+
+class Backpressure:
+    """The lag of the webhooks events in the snapshot store."""
+
+    def __init__(
+        self,
+        store: SnapshotStore,
+        max_lag_seconds: float = DEFAULT_MAX_LAG_SECONDS,
+    ):
+        self.store = store
+        self.max_lag_seconds = max_lag_seconds
+        self._reported = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, dispatched_at: float) -> Optional[float]:
+        """Report the lag of an event dispatched at ``dispatched_at`` (epoch
+        seconds) if it is over the limit. Return the reported lag."""
+        now = time.time()
+        lag = now - dispatched_at
+        if lag <= self.max_lag_seconds:
+            return None
+        with self._lock:
+            if now - self._reported < REPORT_INTERVAL_SECONDS:
+                return None
+            self._reported = now
+
+        reported_at = datetime.fromtimestamp(now, timezone.utc).isoformat()
+        report = {
+            "id": PRESSURE_KEY,
+            "last_edited_time": reported_at,
+            "lag": lag,
+        }
+        self.store.put(PRESSURE_KEY, report)
+        return lag
+
+    def reported_at(self, within_seconds: float) -> Optional[float]:
+        """Return the time (epoch seconds) of the lag reported in the last
+        ``within_seconds``, or None."""
+        report = self.store.get(PRESSURE_KEY)
+        if not report:
+            return None
+        reported_at = datetime.fromisoformat(report["last_edited_time"])
+        if time.time() - reported_at.timestamp() >= within_seconds:
+            return None
+        return reported_at.timestamp()
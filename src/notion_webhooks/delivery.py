@@ -0,0 +1,278 @@
+"""The health of the webhooks URLs and the deliveries held for them.
+
+Each URL has a circuit in the delivery table, shared by the containers:
+
+- ``closed``: the differences are sent
+- ``open``: the URL failed ``failure_threshold`` times in a row, so the
+  differences are held instead of sent
+- ``half_open``: ``reset_seconds`` after it opened, one container probes the
+  URL by sending the held differences. It is closed if they are sent, and
+  opened again otherwise.
+
+The held differences are items of the same URL, in the order of
+``last_edited_time``.
+"""
+import json
+import os
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+CIRCUIT_KEY = "circuit"
+PENDING_PREFIX = "pending#"
+
+DEFAULT_FAILURE_THRESHOLD = 5
+DEFAULT_RESET_SECONDS = 60
+# Seconds to reuse the circuit read by the container
+DEFAULT_CACHE_SECONDS = 5
+
+
+def _pending_key(body: Dict[str, Any]) -> str:
+    # A page has "id", a schema "database_id".
+    id_ = body.get("id") or body.get("database_id")
+    return f"{PENDING_PREFIX}{body['last_edited_time']}#{id_}"
+
+
+class CircuitBreaker:
+    """The circuits of the URLs in a DynamoDB table."""
+
+    def __init__(
+        self,
+        table_name: str,
+        client=None,
+        failure_threshold: int = DEFAULT_FAILURE_THRESHOLD,
+        reset_seconds: float = DEFAULT_RESET_SECONDS,
+        cache_seconds: float = DEFAULT_CACHE_SECONDS,
+    ):
+        self.table_name = table_name
+        if client is None:
+            import boto3
+
+            client = boto3.client("dynamodb")
+        self.client = client
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.cache_seconds = cache_seconds
+        self._cache: Dict[str, Tuple[float, Dict[str, Any]]] = {}
+        self._lock = threading.Lock()
+
+    def _key(self, url: str, key: str = CIRCUIT_KEY) -> Dict[str, Any]:
+        return {"url": {"S": url}, "key": {"S": key}}
+
+    def _remember(self, url: str, circuit: Dict[str, Any]):
+        with self._lock:
+            self._cache[url] = (time.monotonic(), circuit)
+
+    def circuit(self, url: str) -> Dict[str, Any]:
+        """Return the ``state``, ``failures``, ``opened_at`` and ``pending``
+        (the number of the held differences) of the URL."""
+        with self._lock:
+            cached = self._cache.get(url)
+        if cached and time.monotonic() - cached[0] < self.cache_seconds:
+            return cached[1]
+
+        ret = self.client.get_item(
+            TableName=self.table_name, Key=self._key(url), ConsistentRead=True
+        )
+        item = ret.get("Item", {})
+        circuit = {
+            "state": item.get("state", {}).get("S", CLOSED),
+            "failures": int(item.get("failures", {}).get("N", "0")),
+            "opened_at": float(item.get("opened_at", {}).get("N", "0")),
+            "pending": int(item.get("pending", {}).get("N", "0")),
+        }
+        self._remember(url, circuit)
+        return circuit
+
+    def acquire(self, url: str) -> Optional[str]:
+        """Return the state to deliver to the URL in, or None if the
+        differences are to be held.
+
+        Only one container gets ``half_open`` after the reset timeout.
+        """
+        circuit = self.circuit(url)
+        if circuit["state"] == CLOSED:
+            return CLOSED
+
+        # An open circuit, or a probe which has not finished in time
+        if time.time() - circuit["opened_at"] < self.reset_seconds:
+            return None
+        now = time.time()
+        try:
+            self.client.update_item(
+                TableName=self.table_name,
+                Key=self._key(url),
+                UpdateExpression="SET #state = :half_open, opened_at = :now",
+                ConditionExpression="opened_at = :opened_at",
+                ExpressionAttributeNames={"#state": "state"},
+                ExpressionAttributeValues={
+                    ":half_open": {"S": HALF_OPEN},
+                    ":now": {"N": str(now)},
+                    ":opened_at": {"N": str(circuit["opened_at"])},
+                },
+            )
+        except self.client.exceptions.ConditionalCheckFailedException:
+            # Another container is probing.
+            self._forget(url)
+            return None
+        self._remember(url, circuit | {"state": HALF_OPEN, "opened_at": now})
+        return HALF_OPEN
+
+    def _forget(self, url: str):
+        with self._lock:
+            self._cache.pop(url, None)
+
+    def record_success(self, url: str):
+        circuit = self.circuit(url)
+        if circuit["state"] == CLOSED and circuit["failures"] == 0:
+            return
+
+        self.client.update_item(
+            TableName=self.table_name,
+            Key=self._key(url),
+            UpdateExpression="SET #state = :closed, failures = :zero",
+            ExpressionAttributeNames={"#state": "state"},
+            ExpressionAttributeValues={
+                ":closed": {"S": CLOSED},
+                ":zero": {"N": "0"},
+            },
+        )
+        self._remember(url, circuit | {"state": CLOSED, "failures": 0})
+
+    def record_failure(self, url: str):
+        ret = self.client.update_item(
+            TableName=self.table_name,
+            Key=self._key(url),
+            UpdateExpression="ADD failures :one",
+            ExpressionAttributeValues={":one": {"N": "1"}},
+            ReturnValues="ALL_NEW",
+        )
+        attributes = ret["Attributes"]
+        failures = int(attributes["failures"]["N"])
+        state = attributes.get("state", {}).get("S", CLOSED)
+        if state == CLOSED and failures < self.failure_threshold:
+            self._forget(url)
+            return
+
+        # Opened by the failed probe too
+        self.client.update_item(
+            TableName=self.table_name,
+            Key=self._key(url),
+            UpdateExpression="SET #state = :open, opened_at = :now",
+            ExpressionAttributeNames={"#state": "state"},
+            ExpressionAttributeValues={
+                ":open": {"S": OPEN},
+                ":now": {"N": str(time.time())},
+            },
+        )
+        self._forget(url)
+
+    def hold(self, url: str, body: Dict[str, Any]):
+        """Keep the difference to be sent to the URL later."""
+        item = self._key(url, _pending_key(body)) | {
+            "body": {"S": json.dumps(body, ensure_ascii=False)},
+        }
+        try:
+            self.client.put_item(
+                TableName=self.table_name,
+                Item=item,
+                ConditionExpression="attribute_not_exists(#key)",
+                ExpressionAttributeNames={"#key": "key"},
+            )
+        except self.client.exceptions.ConditionalCheckFailedException:
+            # The same difference is held already.
+            return
+        self._add_pending(url, 1)
+
+    def _add_pending(self, url: str, count: int):
+        self.client.update_item(
+            TableName=self.table_name,
+            Key=self._key(url),
+            UpdateExpression="ADD pending :count",
+            ExpressionAttributeValues={":count": {"N": str(count)}},
+        )
+        self._forget(url)
+
+    def held(self, url: str) -> List[Tuple[str, Dict[str, Any]]]:
+        """Return the keys and the held differences of the URL in order."""
+        kwargs = {
+            "TableName": self.table_name,
+            "KeyConditionExpression": "#url = :url AND begins_with(#key, :p)",
+            "ExpressionAttributeNames": {"#url": "url", "#key": "key"},
+            "ExpressionAttributeValues": {
+                ":url": {"S": url},
+                ":p": {"S": PENDING_PREFIX},
+            },
+        }
+        ret = []
+        while True:
+            result = self.client.query(**kwargs)
+            for item in result["Items"]:
+                ret.append((item["key"]["S"], json.loads(item["body"]["S"])))
+            if "LastEvaluatedKey" not in result:
+                return ret
+            kwargs["ExclusiveStartKey"] = result["LastEvaluatedKey"]
+
+    def release(self, url: str, key: str) -> bool:
+        """Remove a held difference before sending it.
+
+        Return False if another container has already taken it.
+        """
+        try:
+            self.client.delete_item(
+                TableName=self.table_name,
+                Key=self._key(url, key),
+                ConditionExpression="attribute_exists(#key)",
+                ExpressionAttributeNames={"#key": "key"},
+            )
+        except self.client.exceptions.ConditionalCheckFailedException:
+            return False
+        self._add_pending(url, -1)
+        return True
+
+    def urls_with_pending(self) -> List[str]:
+        """Return the URLs which have held differences."""
+        kwargs = {
+            "TableName": self.table_name,
+            "FilterExpression": "#key = :circuit AND pending > :zero",
+            "ExpressionAttributeNames": {"#key": "key"},
+            "ExpressionAttributeValues": {
+                ":circuit": {"S": CIRCUIT_KEY},
+                ":zero": {"N": "0"},
+            },
+        }
+        urls = []
+        while True:
+            result = self.client.scan(**kwargs)
+            urls += [item["url"]["S"] for item in result["Items"]]
+            if "LastEvaluatedKey" not in result:
+                return urls
+            kwargs["ExclusiveStartKey"] = result["LastEvaluatedKey"]
+
+
+def create_circuit_breaker(
+    table_name: Optional[str] = None, client=None
+) -> Optional[CircuitBreaker]:
+    """Create the circuit breaker from the environment, or None if not
+    enabled.
+
+    - ``DELIVERY_TABLE_NAME``: the table of the circuits
+    - ``CIRCUIT_FAILURE_THRESHOLD``: failures in a row to open a circuit
+    - ``CIRCUIT_RESET_SECONDS``: seconds until an open circuit is probed
+    """
+    table_name = table_name or os.getenv("DELIVERY_TABLE_NAME")
+    if not table_name:
+        return None
+
+    threshold = os.getenv("CIRCUIT_FAILURE_THRESHOLD")
+    reset = os.getenv("CIRCUIT_RESET_SECONDS")
+    return CircuitBreaker(
+        table_name,
+        client,
+        int(threshold) if threshold else DEFAULT_FAILURE_THRESHOLD,
+        float(reset) if reset else DEFAULT_RESET_SECONDS,
+    )
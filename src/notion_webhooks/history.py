@@ -0,0 +1,237 @@
+"""An append-only change history of the pages.
+
+Each change is a version of the page, keyed by the page ID and the version
+number. It holds the difference which was notified and a delta to rebuild
+the page from the previous version. Every ``snapshot_interval`` versions
+hold the whole page instead, so a page is rebuilt from at most that many
+items.
+
+The ``database_id`` and ``last_edited_time`` of the changes are indexed
+(``HISTORY_INDEX_NAME``) to find the changes of a database since a time.
+"""
+import json
+import os
+from typing import Any, Dict, List, Optional, Tuple
+
+HISTORY_INDEX_NAME = "database_id-last_edited_time"
+DEFAULT_SNAPSHOT_INTERVAL = 20
+# Retries of a version which another process has just appended
+APPEND_MAX_RETRIES = 3
+
+
+def make_delta(prev: Dict[str, Any], cur: Dict[str, Any]) -> Dict[str, Any]:
+    """Return the delta to turn ``prev`` into ``cur``.
+
+    ``set`` holds the ``[path, value]`` of the changed values and ``unset``
+    the paths of the deleted keys. The dictionaries are compared key by key,
+    any other value (a list included) is replaced as a whole.
+    """
+    delta: Dict[str, List] = {"set": [], "unset": []}
+
+    def _walk(path, old, new):
+        for key in old.keys() - new.keys():
+            delta["unset"].append(path + [key])
+        for key, value in new.items():
+            if key not in old:
+                delta["set"].append([path + [key], value])
+            elif isinstance(value, dict) and isinstance(old[key], dict):
+                _walk(path + [key], old[key], value)
+            elif value != old[key] or type(value) is not type(old[key]):
+                delta["set"].append([path + [key], value])
+
+    _walk([], prev, cur)
+    return delta
+
+
+def apply_delta(doc: Dict[str, Any], delta: Dict[str, Any]) -> Dict[str, Any]:
+    """Apply a delta of ``make_delta`` to a copy of ``doc``."""
+    doc = json.loads(json.dumps(doc))
+    for path in delta["unset"]:
+        parent = doc
+        for key in path[:-1]:
+            parent = parent[key]
+        del parent[path[-1]]
+    for path, value in delta["set"]:
+        parent = doc
+        for key in path[:-1]:
+            parent = parent.setdefault(key, {})
+        parent[path[-1]] = value
+    return doc
+
+
+def _is_empty(delta: Dict[str, Any]) -> bool:
+    # Only the edited time changes if the page is dispatched again.
+    changes = [path for path, _ in delta["set"]] + delta["unset"]
+    return all(path == ["last_edited_time"] for path in changes)
+
+
+class ChangeHistory:
+    """The versions of the pages in a DynamoDB table."""
+
+    def __init__(
+        self,
+        table_name: str,
+        client=None,
+        snapshot_interval: int = DEFAULT_SNAPSHOT_INTERVAL,
+    ):
+        self.table_name = table_name
+        if client is None:
+            import boto3
+
+            client = boto3.client("dynamodb")
+        self.client = client
+        self.snapshot_interval = snapshot_interval
+
+    def _latest_version(self, page_id: str) -> int:
+        ret = self.client.query(
+            TableName=self.table_name,
+            KeyConditionExpression="id = :id",
+            ExpressionAttributeValues={":id": {"S": page_id}},
+            ProjectionExpression="version",
+            ScanIndexForward=False,
+            Limit=1,
+        )
+        if not ret["Items"]:
+            return 0
+        return int(ret["Items"][0]["version"]["N"])
+
+    def append(
+        self,
+        database_id: str,
+        prev_page_info: Dict[str, Any],
+        page_info: Dict[str, Any],
+        diff: Optional[Dict[str, Any]] = None,
+    ) -> Optional[int]:
+        """Append the change from ``prev_page_info`` to ``page_info``.
+
+        ``prev_page_info`` is ``{}`` for a new page. Return the appended
+        version, or None if nothing but the edited time has changed.
+        """
+        delta = make_delta(prev_page_info, page_info)
+        if prev_page_info and _is_empty(delta):
+            return None
+
+        page_id = page_info["id"]
+        for _ in range(APPEND_MAX_RETRIES):
+            version = self._latest_version(page_id) + 1
+            item = {
+                "id": {"S": page_id},
+                "version": {"N": str(version)},
+                "database_id": {"S": database_id},
+                "last_edited_time": {"S": page_info["last_edited_time"]},
+            }
+            if diff:
+                item["diff"] = {"S": json.dumps(diff, ensure_ascii=False)}
+            # The first version of a page is always a whole page.
+            interval = self.snapshot_interval
+            if not prev_page_info or (version - 1) % interval == 0:
+                snapshot = json.dumps(page_info, ensure_ascii=False)
+                item["snapshot"] = {"S": snapshot}
+            else:
+                item["delta"] = {"S": json.dumps(delta, ensure_ascii=False)}
+
+            try:
+                self.client.put_item(
+                    TableName=self.table_name,
+                    Item=item,
+                    ConditionExpression="attribute_not_exists(version)",
+                )
+            except self.client.exceptions.ConditionalCheckFailedException:
+                continue
+            return version
+
+        raise RuntimeError(f"failed to append a version of {page_id}")
+
+    def get_page_info(
+        self, page_id: str, version: Optional[int] = None
+    ) -> Dict[str, Any]:
+        """Rebuild the page at ``version`` (default: the latest).
+
+        Return ``{}`` if the page has no such version.
+        """
+        kwargs = {
+            "TableName": self.table_name,
+            "KeyConditionExpression": "id = :id",
+            "ExpressionAttributeValues": {":id": {"S": page_id}},
+            "ScanIndexForward": False,
+        }
+        if version is not None:
+            kwargs["KeyConditionExpression"] += " AND version <= :version"
+            values = kwargs["ExpressionAttributeValues"]
+            values[":version"] = {"N": str(version)}
+
+        # Read back to the nearest snapshot, then apply the later deltas.
+        deltas = []
+        while True:
+            ret = self.client.query(**kwargs)
+            for item in ret["Items"]:
+                if "snapshot" in item:
+                    page_info = json.loads(item["snapshot"]["S"])
+                    for delta in reversed(deltas):
+                        page_info = apply_delta(page_info, delta)
+                    return page_info
+                deltas.append(json.loads(item["delta"]["S"]))
+
+            if "LastEvaluatedKey" not in ret:
+                return {}
+            kwargs["ExclusiveStartKey"] = ret["LastEvaluatedKey"]
+
+    def query_changes(
+        self,
+        database_id: str,
+        since: str,
+        limit: Optional[int] = None,
+        exclusive_start_key: Optional[Dict[str, Any]] = None,
+    ) -> Tuple[List[Dict[str, Any]], Optional[Dict[str, Any]]]:
+        """Return a page of the changes of the database edited after
+        ``since``, and the key to start the next page from (or None).
+
+        The changes are in the order of ``last_edited_time``. Each one is
+        ``{"id", "version", "last_edited_time", "diff"}``, without ``diff``
+        for a new page.
+        """
+        kwargs = {
+            "TableName": self.table_name,
+            "IndexName": HISTORY_INDEX_NAME,
+            "KeyConditionExpression": (
+                "database_id = :database_id AND last_edited_time > :since"
+            ),
+            "ExpressionAttributeValues": {
+                ":database_id": {"S": database_id},
+                ":since": {"S": since},
+            },
+        }
+        if limit:
+            kwargs["Limit"] = limit
+        if exclusive_start_key:
+            kwargs["ExclusiveStartKey"] = exclusive_start_key
+
+        ret = self.client.query(**kwargs)
+        changes = []
+        for item in ret["Items"]:
+            change = {
+                "id": item["id"]["S"],
+                "version": int(item["version"]["N"]),
+                "last_edited_time": item["last_edited_time"]["S"],
+            }
+            if "diff" in item:
+                change["diff"] = json.loads(item["diff"]["S"])
+            changes.append(change)
+        return changes, ret.get("LastEvaluatedKey")
+
+
+def create_change_history(
+    table_name: Optional[str] = None, client=None
+) -> Optional[ChangeHistory]:
+    """Create the history from the environment, or None if not enabled.
+
+    - ``HISTORY_TABLE_NAME``: the table of the history
+    - ``HISTORY_SNAPSHOT_INTERVAL``: versions per whole page
+    """
+    table_name = table_name or os.getenv("HISTORY_TABLE_NAME")
+    if not table_name:
+        return None
+
+    interval = os.getenv("HISTORY_SNAPSHOT_INTERVAL")
+    interval = int(interval) if interval else DEFAULT_SNAPSHOT_INTERVAL
+    return ChangeHistory(table_name, client, interval)
@@ -0,0 +1,351 @@
+"""Stores of the last page information (snapshot) of each page.
+
+``create_snapshot_store`` selects the implementation:
+
+- ``dynamodb``: the page information table (default)
+- ``sqlite``: a SQLite file in WAL mode, for a single node
+- ``memory``: a dict in the process, for tests and benchmarks
+
+Any of them can be wrapped in ``CachedSnapshotStore``, which keeps the
+recent snapshots in the process.
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, List, Optional
+
+# The maximum number of requests of BatchWriteItem
+BATCH_WRITE_SIZE = 25
+BATCH_WRITE_MAX_RETRIES = 10
+BATCH_WRITE_MAX_BACKOFF = 5
+
+
+def _dumps(page_info: Dict[str, Any]) -> str:
+    return json.dumps(page_info, ensure_ascii=False)
+
+
+def batch_write(client, table_name: str, requests: List[Dict[str, Any]]):
+    """Write the requests with BatchWriteItem, 25 at a time, retrying the
+    unprocessed ones."""
+    size = BATCH_WRITE_SIZE
+    for i in range(0, len(requests), size):
+        unprocessed = {table_name: requests[i : i + size]}  # noqa: E203
+        for retry in range(BATCH_WRITE_MAX_RETRIES):
+            ret = client.batch_write_item(RequestItems=unprocessed)
+            unprocessed = ret.get("UnprocessedItems", {})
+            if not unprocessed:
+                break
+            # Exponential backoff, as recommended for the throttled writes.
+            time.sleep(min(BATCH_WRITE_MAX_BACKOFF, 0.05 * 2**retry))
+        else:
+            count = len(unprocessed[table_name])
+            raise RuntimeError(f"{count} items were not written")
+
+
+class SnapshotStore:
+    """The last page information of each page."""
+
+    def get(self, page_id: str) -> Dict[str, Any]:
+        """Return the page information, or ``{}`` if it is a new page."""
+        raise NotImplementedError
+
+    def put(self, page_id: str, page_info: Dict[str, Any]):
+        raise NotImplementedError
+
+    def put_many(self, page_infos: Iterable[Dict[str, Any]]):
+        for page_info in page_infos:
+            self.put(page_info["id"], page_info)
+
+    def put_if_unchanged(
+        self, page_id: str, page_info: Dict[str, Any], last_edited_time: str
+    ) -> bool:
+        """Put only if the stored snapshot was edited at ``last_edited_time``.
+
+        Return whether it was put.
+        """
+        raise NotImplementedError
+
+    def swap(self, page_id: str, page_info: Dict[str, Any]) -> Dict[str, Any]:
+        """Put the page information and return the previous one."""
+        prev_page_info = self.get(page_id)
+        self.put(page_id, page_info)
+        return prev_page_info
+
+
+class DynamoDbSnapshotStore(SnapshotStore):
+    def __init__(self, table_name: str, client=None):
+        self.table_name = table_name
+        if client is None:
+            # Only the DynamoDB store needs boto3.
+            import boto3
+
+            client = boto3.client("dynamodb")
+        self.client = client
+
+    def get(self, page_id: str) -> Dict[str, Any]:
+        ret = self.client.get_item(
+            TableName=self.table_name,
+            Key={
+                "id": {"S": page_id},
+            },
+        )
+        if "Item" not in ret:
+            return {}
+
+        return json.loads(ret["Item"]["page_info"]["S"])
+
+    def put(self, page_id: str, page_info: Dict[str, Any]):
+        self.client.put_item(
+            TableName=self.table_name,
+            Item=self._item(page_id, page_info),
+        )
+
+    def put_if_unchanged(
+        self, page_id: str, page_info: Dict[str, Any], last_edited_time: str
+    ) -> bool:
+        try:
+            self.client.put_item(
+                TableName=self.table_name,
+                Item=self._item(page_id, page_info),
+                ConditionExpression="last_edited_time = :last_edited_time",
+                ExpressionAttributeValues={
+                    ":last_edited_time": {"S": last_edited_time},
+                },
+            )
+        except self.client.exceptions.ConditionalCheckFailedException:
+            return False
+        return True
+
+    def swap(self, page_id: str, page_info: Dict[str, Any]) -> Dict[str, Any]:
+        # PutItem returns the previous item, so no GetItem is needed.
+        ret = self.client.put_item(
+            TableName=self.table_name,
+            Item=self._item(page_id, page_info),
+            ReturnValues="ALL_OLD",
+        )
+        old_item = ret.get("Attributes")
+        if not old_item:
+            return {}
+
+        return json.loads(old_item["page_info"]["S"])
+
+    def put_many(self, page_infos: Iterable[Dict[str, Any]]):
+        requests = []
+        for page_info in page_infos:
+            item = self._item(page_info["id"], page_info)
+            requests.append({"PutRequest": {"Item": item}})
+        batch_write(self.client, self.table_name, requests)
+
+    @staticmethod
+    def _item(page_id: str, page_info: Dict[str, Any]) -> Dict[str, Any]:
+        return {
+            "id": {"S": page_id},
+            "last_edited_time": {"S": page_info["last_edited_time"]},
+            "page_info": {"S": _dumps(page_info)},
+        }
+
+
+class SqliteSnapshotStore(SnapshotStore):
+    """A SQLite file, with a connection per thread.
+
+    WAL mode lets the readers run while a page is written.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        with self._connection() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS page_info ("
+                "id TEXT PRIMARY KEY, "
+                "last_edited_time TEXT NOT NULL, "
+                "page_info TEXT NOT NULL)"
+            )
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            # Durable enough with WAL, and no fsync per transaction.
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def get(self, page_id: str) -> Dict[str, Any]:
+        sql = "SELECT page_info FROM page_info WHERE id = ?"
+        row = self._connection().execute(sql, (page_id,)).fetchone()
+        if row is None:
+            return {}
+
+        return json.loads(row[0])
+
+    def put(self, page_id: str, page_info: Dict[str, Any]):
+        self._put_rows([self._row(page_id, page_info)])
+
+    def put_many(self, page_infos: Iterable[Dict[str, Any]]):
+        self._put_rows([self._row(p["id"], p) for p in page_infos])
+
+    @staticmethod
+    def _row(page_id: str, page_info: Dict[str, Any]):
+        return page_id, page_info["last_edited_time"], _dumps(page_info)
+
+    def _put_rows(self, rows):
+        sql = "INSERT OR REPLACE INTO page_info VALUES (?, ?, ?)"
+        with self._connection() as conn:
+            conn.executemany(sql, rows)
+
+    def put_if_unchanged(
+        self, page_id: str, page_info: Dict[str, Any], last_edited_time: str
+    ) -> bool:
+        sql = (
+            "UPDATE page_info SET last_edited_time = ?, page_info = ? "
+            "WHERE id = ? AND last_edited_time = ?"
+        )
+        params = (
+            page_info["last_edited_time"],
+            _dumps(page_info),
+            page_id,
+            last_edited_time,
+        )
+        with self._connection() as conn:
+            return conn.execute(sql, params).rowcount == 1
+
+
+class MemorySnapshotStore(SnapshotStore):
+    """A dict in the process. The snapshots are lost when it ends."""
+
+    def __init__(self):
+        # Kept as JSON, so that the callers can't change a stored snapshot.
+        self._snapshots: Dict[str, str] = {}
+        self._lock = threading.Lock()
+
+    def get(self, page_id: str) -> Dict[str, Any]:
+        snapshot = self._snapshots.get(page_id)
+        if snapshot is None:
+            return {}
+
+        return json.loads(snapshot)
+
+    def put(self, page_id: str, page_info: Dict[str, Any]):
+        self._snapshots[page_id] = _dumps(page_info)
+
+    def put_if_unchanged(
+        self, page_id: str, page_info: Dict[str, Any], last_edited_time: str
+    ) -> bool:
+        with self._lock:
+            stored = json.loads(self._snapshots.get(page_id, "{}"))
+            if stored.get("last_edited_time") != last_edited_time:
+                return False
+            self._snapshots[page_id] = _dumps(page_info)
+            return True
+
+
+class CachedSnapshotStore(SnapshotStore):
+    """Keep the recently put snapshots in the process (LRU).
+
+    A cached snapshot is used as the previous one only if the put succeeds
+    on the condition that the stored snapshot has the same
+    ``last_edited_time``. Otherwise another process has put a newer one, and
+    the snapshot is read from the wrapped store.
+    """
+
+    def __init__(self, store: SnapshotStore, maxsize: int):
+        self.store = store
+        self.maxsize = maxsize
+        self._cache: OrderedDict[str, str] = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _cached(self, page_id: str) -> Dict[str, Any]:
+        with self._lock:
+            snapshot = self._cache.get(page_id)
+            if snapshot is None:
+                return {}
+            self._cache.move_to_end(page_id)
+        return json.loads(snapshot)
+
+    def _remember(self, page_id: str, page_info: Dict[str, Any]):
+        snapshot = _dumps(page_info)
+        with self._lock:
+            self._cache[page_id] = snapshot
+            self._cache.move_to_end(page_id)
+            while len(self._cache) > self.maxsize:
+                self._cache.popitem(last=False)
+
+    def _forget(self, page_id: str):
+        with self._lock:
+            self._cache.pop(page_id, None)
+
+    def get(self, page_id: str) -> Dict[str, Any]:
+        # Not validated without a put, so always read from the store.
+        return self.store.get(page_id)
+
+    def put(self, page_id: str, page_info: Dict[str, Any]):
+        self._forget(page_id)
+        self.store.put(page_id, page_info)
+        self._remember(page_id, page_info)
+
+    def put_many(self, page_infos: Iterable[Dict[str, Any]]):
+        page_infos = list(page_infos)
+        for page_info in page_infos:
+            self._forget(page_info["id"])
+        self.store.put_many(page_infos)
+
+    def put_if_unchanged(
+        self, page_id: str, page_info: Dict[str, Any], last_edited_time: str
+    ) -> bool:
+        self._forget(page_id)
+        put = self.store.put_if_unchanged(page_id, page_info, last_edited_time)
+        if put:
+            self._remember(page_id, page_info)
+        return put
+
+    def swap(self, page_id: str, page_info: Dict[str, Any]) -> Dict[str, Any]:
+        cached = self._cached(page_id)
+        if cached:
+            edited = cached["last_edited_time"]
+            if self.put_if_unchanged(page_id, page_info, edited):
+                self.hits += 1
+                return cached
+
+        self.misses += 1
+        self._forget(page_id)
+        prev_page_info = self.store.swap(page_id, page_info)
+        self._remember(page_id, page_info)
+        return prev_page_info
+
+
+def create_snapshot_store(
+    kind: Optional[str] = None,
+    table_name: Optional[str] = None,
+    path: Optional[str] = None,
+    client=None,
+    cache_size: int = 0,
+) -> SnapshotStore:
+    """Create the store of ``kind``, by default from the environment.
+
+    - ``SNAPSHOT_STORE``: ``dynamodb`` (default), ``sqlite`` or ``memory``
+    - ``TABLE_NAME``: the table of ``dynamodb``
+    - ``SNAPSHOT_STORE_PATH``: the file of ``sqlite``
+
+    With ``cache_size``, up to that many snapshots are cached in the process.
+    """
+    kind = kind or os.getenv("SNAPSHOT_STORE", "dynamodb")
+    if kind == "dynamodb":
+        table_name = table_name or os.environ["TABLE_NAME"]
+        store = DynamoDbSnapshotStore(table_name, client)
+    elif kind == "sqlite":
+        store = SqliteSnapshotStore(path or os.environ["SNAPSHOT_STORE_PATH"])
+    elif kind == "memory":
+        store = MemorySnapshotStore()
+    else:
+        raise ValueError(f"unknown snapshot store: {kind}")
+
+    if cache_size > 0:
+        return CachedSnapshotStore(store, cache_size)
+    return store
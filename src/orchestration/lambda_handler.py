@@ -1,7 +1,7 @@
+import functools
 import json
 import os
-from collections import defaultdict
-from typing import Dict, List
+from typing import Any, Dict, List, Optional
 
 import boto3
 from aws_lambda_powertools import Logger
@@ -16,22 +16,66 @@ logger = Logger()
 logger.setLevel(log_level)
 
 
-def _get_database_id_url_dict(user_id: str) -> Dict[str, List[str]]:
-    client = boto3.client("dynamodb")
+@functools.lru_cache(maxsize=None)
+def get_client(service_name: str):
+    # Created once per container and reused by the following invocations.
+    return boto3.client(service_name)
+
+
+def _get_databases(
+    user_id: str, table_name: Optional[str] = None
+) -> List[Dict[str, Any]]:
+    client = get_client("dynamodb")
     result = client.query(
-        TableName=os.environ["TABLE_NAME"],
+        TableName=table_name or os.environ["TABLE_NAME"],
         KeyConditionExpression="user_id = :user_id",
         ExpressionAttributeValues={":user_id": {"S": user_id}},
     )
     logger.debug("query result: %s", result)
 
-    id_url_dict = defaultdict(list)
+    databases = []
     for r in result["Items"]:
-        database_id = r["database_id"]["S"]
-        url_list = r["webhooks_url"]["SS"]
-        id_url_dict[database_id] = url_list
+        database = {
+            "database_id": r["database_id"]["S"],
+            "webhooks_url": r["webhooks_url"]["SS"],
+        }
+        if "watched_properties" in r:
+            database["watched_properties"] = r["watched_properties"]["SS"]
+        if "filter" in r:
+            database["filter"] = json.loads(r["filter"]["S"])
+        if "debounce_minutes" in r:
+            database["debounce_minutes"] = int(r["debounce_minutes"]["N"])
+        databases.append(database)
+
+    return databases
+
+
+def _group_databases(
+    databases: List[Dict[str, Any]], group_size: int
+) -> List[List[Dict[str, Any]]]:
+    return [
+        databases[i : i + group_size]  # noqa: E203
+        for i in range(0, len(databases), group_size)
+    ]
 
-    return id_url_dict
+
+def build_monitoring_events(
+    user_id: str, request_id: Optional[str], table_name: Optional[str] = None
+) -> List[Dict[str, Any]]:
+    """Build the events for monitoring from the databases of the user."""
+    group_size = int(os.getenv("MONITORING_GROUP_SIZE", "1"))
+
+    databases = _get_databases(user_id, table_name)
+
+    events = []
+    for group in _group_databases(databases, group_size):
+        if len(group) == 1:
+            events.append(group[0] | {"request_id": request_id})
+        else:
+            # Small databases share one monitoring invocation.
+            events.append({"databases": group, "request_id": request_id})
+
+    return events
 
 
 @logger.inject_lambda_context
@@ -42,15 +86,10 @@ def lambda_function(event: EventBridgeEvent, context: LambdaContext):
     user_id = event["user_id"]
     lambda_name = os.environ["LAMBDA_NAME_MONITORING"]
 
-    id_url_dict = _get_database_id_url_dict(user_id)
+    events = build_monitoring_events(user_id, context.aws_request_id)
 
-    client = boto3.client("lambda")
-    for database_id, url_list in id_url_dict.items():
-        next_event = {
-            "database_id": database_id,
-            "webhooks_url": url_list,
-            "request_id": context.aws_request_id,
-        }
+    client = get_client("lambda")
+    for next_event in events:
         logger.debug("invoke with: %s", next_event)
 
         client.invoke(
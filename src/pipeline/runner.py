@@ -0,0 +1,222 @@
+"""Run orchestration, monitoring and webhooks in one process.
+
+The stages are connected with bounded queues instead of ``lambda.invoke``.
+The pages are sharded by page ID over the webhooks workers, so the changes
+of a page are processed in the order in which they were found.
+Each stage runs its blocking calls in a thread pool of its own size: the
+monitoring threads block while the webhooks queues are full, so sharing a
+pool with the webhooks workers could leave them no thread to drain the
+queues.
+Taking a difference is CPU-bound, so it can be run in a process pool while
+the I/O of the workers stays in threads.
+
+Usage (from the ``src`` directory)::
+
+    python -m pipeline.runner --user-id user@example.com
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import time
+import uuid
+import zlib
+from asyncio import Queue
+from concurrent.futures import (
+    Executor,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+)
+from contextlib import nullcontext
+from typing import Any, Dict, List, Optional
+
+from aws_lambda_powertools import Logger
+
+from monitoring.lambda_handler import Dispatcher, monitor_event
+from orchestration.lambda_handler import build_monitoring_events
+from webhooks.lambda_handler import process_event, take_diff_in_page_info
+
+if os.getenv("LOGLEVEL"):
+    log_level = os.getenv("LOGLEVEL")
+else:
+    log_level = "INFO"
+logger = Logger()
+logger.setLevel(log_level)
+
+DEFAULT_QUEUE_SIZE = 100
+DEFAULT_MONITORING_WORKERS = 4
+DEFAULT_WEBHOOKS_WORKERS = 8
+# 0 takes the differences in the webhooks workers themselves
+DEFAULT_DIFF_PROCESSES = 0
+
+
+class QueueDispatcher(Dispatcher):
+    """Put the events of monitoring onto the webhooks queues.
+
+    ``send`` is called from the monitoring threads and blocks while the
+    queue is full, which slows monitoring down to the pace of webhooks.
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, queues: List[Queue]):
+        self.loop = loop
+        self.queues = queues
+
+    def send(self, event: Dict[str, Any], key: str, version: str):
+        shard = zlib.crc32(key.encode()) % len(self.queues)
+        put = self.queues[shard].put(event)
+        asyncio.run_coroutine_threadsafe(put, self.loop).result()
+
+
+async def _monitoring_worker(
+    events: Queue, dispatcher: QueueDispatcher, executor: Executor
+):
+    loop = asyncio.get_running_loop()
+    while (event := await events.get()) is not None:
+        try:
+            args = (monitor_event, event, None, dispatcher)
+            await loop.run_in_executor(executor, *args)
+        except Exception:
+            logger.exception("monitoring failed: %s", event)
+
+
+class PoolDiffer:
+    """Take the differences of the pages in an executor."""
+
+    def __init__(self, executor: Executor):
+        self.executor = executor
+
+    def __call__(self, prev_info, current_info):
+        func = take_diff_in_page_info
+        return self.executor.submit(func, prev_info, current_info).result()
+
+
+def diff_pool(processes: int):
+    """Create the process pool for ``run_once``, if ``processes`` > 0."""
+    if processes <= 0:
+        return nullcontext()
+
+    # Don't fork the threads of the running pipeline.
+    mp_context = multiprocessing.get_context("spawn")
+    return ProcessPoolExecutor(processes, mp_context=mp_context)
+
+
+async def _webhooks_worker(pages: Queue, take_diff, executor: Executor):
+    loop = asyncio.get_running_loop()
+    while (item := await pages.get()) is not None:
+        try:
+            args = (process_event, item, take_diff)
+            await loop.run_in_executor(executor, *args)
+        except Exception:
+            logger.exception("webhooks failed: %s", item)
+
+
+async def run_once(
+    user_id: str,
+    table_name: Optional[str] = None,
+    request_id: Optional[str] = None,
+    queue_size: int = DEFAULT_QUEUE_SIZE,
+    monitoring_workers: int = DEFAULT_MONITORING_WORKERS,
+    webhooks_workers: int = DEFAULT_WEBHOOKS_WORKERS,
+    pool: Optional[Executor] = None,
+):
+    """Monitor the databases of the user once, as orchestration does.
+
+    With ``pool``, the differences are taken in it instead of the webhooks
+    workers.
+    """
+    request_id = request_id or str(uuid.uuid4())
+    take_diff = PoolDiffer(pool) if pool else take_diff_in_page_info
+
+    events: Queue[Optional[Dict[str, Any]]] = Queue(queue_size)
+    pages: List[Queue] = [Queue(queue_size) for _ in range(webhooks_workers)]
+    dispatcher = QueueDispatcher(asyncio.get_running_loop(), pages)
+
+    # Sized to the workers, so no worker waits for a thread.
+    monitoring_pool = ThreadPoolExecutor(monitoring_workers, "monitoring")
+    webhooks_pool = ThreadPoolExecutor(webhooks_workers, "webhooks")
+    with monitoring_pool, webhooks_pool:
+        monitoring = [
+            _monitoring_worker(events, dispatcher, monitoring_pool)
+            for _ in range(monitoring_workers)
+        ]
+        monitoring = [asyncio.create_task(w) for w in monitoring]
+        args = (take_diff, webhooks_pool)
+        webhooks = [_webhooks_worker(q, *args) for q in pages]
+        webhooks = [asyncio.create_task(w) for w in webhooks]
+
+        try:
+            next_events = await asyncio.to_thread(
+                build_monitoring_events, user_id, request_id, table_name
+            )
+            for event in next_events:
+                await events.put(event)
+        finally:
+            # Stop the stages in order so every queued item is processed.
+            for _ in monitoring:
+                await events.put(None)
+            await asyncio.gather(*monitoring)
+            for q in pages:
+                await q.put(None)
+            await asyncio.gather(*webhooks)
+
+
+async def run_forever(user_id: str, interval_minutes: int, **kwargs):
+    """Run the pipeline every ``interval_minutes`` like EventBridge."""
+    interval = interval_minutes * 60
+    next_time = time.monotonic()
+    while True:
+        try:
+            await run_once(user_id, **kwargs)
+        except Exception:
+            logger.exception("pipeline failed")
+
+        # Keep the schedule even if a run takes a while.
+        next_time += interval
+        await asyncio.sleep(max(0, next_time - time.monotonic()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--user-id",
+        default=os.getenv("NOTION_USER_EMAIL"),
+        required=not os.getenv("NOTION_USER_EMAIL"),
+    )
+    parser.add_argument(
+        "--table-name",
+        default=os.getenv("TABLE_NAME_DATABASE_ID"),
+        help="table of the database IDs (TABLE_NAME_DATABASE_ID)",
+    )
+    parser.add_argument("--once", action="store_true", help="run only once")
+    parser.add_argument("--queue-size", type=int, default=DEFAULT_QUEUE_SIZE)
+    parser.add_argument(
+        "--monitoring-workers", type=int, default=DEFAULT_MONITORING_WORKERS
+    )
+    parser.add_argument(
+        "--webhooks-workers", type=int, default=DEFAULT_WEBHOOKS_WORKERS
+    )
+    parser.add_argument(
+        "--diff-processes",
+        type=int,
+        default=DEFAULT_DIFF_PROCESSES,
+        help="processes to take the differences in (0: no process pool)",
+    )
+    args = parser.parse_args()
+
+    kwargs = {
+        "table_name": args.table_name,
+        "queue_size": args.queue_size,
+        "monitoring_workers": args.monitoring_workers,
+        "webhooks_workers": args.webhooks_workers,
+    }
+    with diff_pool(args.diff_processes) as pool:
+        if args.once:
+            asyncio.run(run_once(args.user_id, pool=pool, **kwargs))
+        else:
+            interval = int(os.environ["INTERVAL_MINUTES"])
+            coro = run_forever(args.user_id, interval, pool=pool, **kwargs)
+            asyncio.run(coro)
+
+
+if __name__ == "__main__":
+    main()
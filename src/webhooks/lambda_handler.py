@@ -1,14 +1,28 @@
+import functools
 import json
 import os
 import urllib.request
 from collections import defaultdict
-from typing import Any, Dict, List, Union
+from typing import Any, Callable, Dict, List, Optional, Union
 
-import boto3
 from aws_lambda_powertools import Logger
 from aws_lambda_powertools.utilities.data_classes import EventBridgeEvent
 from aws_lambda_powertools.utilities.typing import LambdaContext
-from deepdiff import DeepDiff, Delta
+
+from notion_webhooks.backpressure import (
+    DEFAULT_MAX_LAG_SECONDS,
+    Backpressure,
+)
+from notion_webhooks.delivery import (
+    HALF_OPEN,
+    CircuitBreaker,
+    create_circuit_breaker,
+)
+from notion_webhooks.history import ChangeHistory, create_change_history
+from notion_webhooks.snapshot_store import (
+    SnapshotStore,
+    create_snapshot_store,
+)
 
 if os.getenv("LOGLEVEL"):
     log_level = os.getenv("LOGLEVEL")
@@ -17,21 +31,40 @@ else:
 logger = Logger()
 logger.setLevel(log_level)
 
+# Snapshots of the recently edited pages kept in a warm container
+DEFAULT_SNAPSHOT_CACHE_SIZE = 1000
+# Seconds to wait for a webhooks URL to respond
+DEFAULT_SEND_TIMEOUT = 10
 
-def fetch_prev_page_info(page_id):
-    client = boto3.client("dynamodb")
-    ret = client.get_item(
-        TableName=os.environ["TABLE_NAME"],
-        Key={
-            "id": {"S": page_id},
-        },
-    )
-    if "Item" not in ret:
-        return {}
 
-    item = ret["Item"]
-    page_info = item["page_info"]["S"]
-    return json.loads(page_info)
+@functools.lru_cache(maxsize=None)
+def get_snapshot_store() -> SnapshotStore:
+    # Created once per container and reused by the following events.
+    cache_size = os.getenv("SNAPSHOT_CACHE_SIZE", DEFAULT_SNAPSHOT_CACHE_SIZE)
+    return create_snapshot_store(cache_size=int(cache_size))
+
+
+@functools.lru_cache(maxsize=None)
+def get_change_history() -> Optional[ChangeHistory]:
+    # None unless HISTORY_TABLE_NAME is set.
+    return create_change_history()
+
+
+@functools.lru_cache(maxsize=None)
+def get_circuit_breaker() -> Optional[CircuitBreaker]:
+    # None unless DELIVERY_TABLE_NAME is set.
+    return create_circuit_breaker()
+
+
+@functools.lru_cache(maxsize=None)
+def get_backpressure() -> Backpressure:
+    max_lag = os.getenv("WEBHOOKS_MAX_LAG_SECONDS", DEFAULT_MAX_LAG_SECONDS)
+    return Backpressure(get_snapshot_store(), float(max_lag))
+
+
+def swap_page_info(page_id: str, page_info: Dict[str, Any]):
+    """Save the page information and return the previous one."""
+    return get_snapshot_store().swap(page_id, page_info)
 
 
 def _generate_diff_dict(
@@ -72,6 +105,10 @@ def _generate_diff_dict(
 
 
 def take_diff_in_page_info(prev_info, current_info):
+    # Imported here, because a new page is saved without taking a difference
+    # and deepdiff takes a while to import in a cold start.
+    from deepdiff import DeepDiff, Delta
+
     # Refer to https://zepworks.com/deepdiff/6.7.1/basics.html
     # and https://zepworks.com/deepdiff/6.7.1/serialization.html#delta-serialize-to-flat-dictionaries  # noqa: E501
     exclude_paths = [
@@ -131,19 +168,6 @@ def take_diff_in_page_info(prev_info, current_info):
     return result
 
 
-def save_page_info(page_id: str, page_info: Dict[str, Any]):
-    last_edited_time = page_info["last_edited_time"]
-    client = boto3.client("dynamodb")
-    client.put_item(
-        TableName=os.environ["TABLE_NAME"],
-        Item={
-            "id": {"S": page_id},
-            "last_edited_time": {"S": last_edited_time},
-            "page_info": {"S": json.dumps(page_info, ensure_ascii=False)},
-        },
-    )
-
-
 def send_difference(url, body):
     logger.info("url: %s", url)
     logger.info("body: %s", body)
@@ -153,38 +177,269 @@ def send_difference(url, body):
     req = urllib.request.Request(
         url, json.dumps(body, ensure_ascii=False).encode(), headers
     )
-    with urllib.request.urlopen(req):
+    timeout = float(os.getenv("SEND_TIMEOUT_SECONDS", DEFAULT_SEND_TIMEOUT))
+    with urllib.request.urlopen(req, timeout=timeout):
         # Ignore the response because the purpose is to send a difference.
         pass
 
 
-@logger.inject_lambda_context
-def lambda_function(event: EventBridgeEvent, context: LambdaContext):
-    logger.structure_logs(append=True, request_id=event.get("request_id"))
+def _send_held(breaker: CircuitBreaker, url: str) -> bool:
+    """Send the held differences of the URL in order.
+
+    Return whether all of them were sent.
+    """
+    for key, body in breaker.held(url):
+        if not breaker.release(url, key):
+            # Sent by another container
+            continue
+        try:
+            send_difference(url, body)
+        except OSError:
+            logger.warning("failed to send to %s", url, exc_info=True)
+            breaker.hold(url, body)
+            breaker.record_failure(url)
+            return False
+
+    breaker.record_success(url)
+    return True
 
-    logger.debug("event: %s", event)
 
-    webhooks_url: List[str] = event["webhooks_url"]
-    page_info = event["page_info"]
+def deliver(webhooks_url: List[str], body: Dict[str, Any]):
+    """Send the difference to the URLs.
 
+    With the circuit breaker (``DELIVERY_TABLE_NAME``), a failed difference
+    is held instead of failing the event, and the URLs whose circuit is open
+    are not called at all. Otherwise the first failure is raised.
+    """
+    breaker = get_circuit_breaker()
+    for url in webhooks_url:
+        if breaker is None:
+            send_difference(url, body)
+            continue
+
+        state = breaker.acquire(url)
+        if state is None:
+            logger.info("circuit open, held for %s", url)
+            breaker.hold(url, body)
+            continue
+        if state == HALF_OPEN or breaker.circuit(url)["pending"]:
+            # Sent after the held ones, to keep the order.
+            breaker.hold(url, body)
+            _send_held(breaker, url)
+            continue
+
+        try:
+            send_difference(url, body)
+        except OSError:
+            logger.warning("failed to send to %s", url, exc_info=True)
+            breaker.hold(url, body)
+            breaker.record_failure(url)
+            continue
+        breaker.record_success(url)
+
+
+def send_held_differences():
+    """Send the held differences of the URLs which may be called again."""
+    breaker = get_circuit_breaker()
+    if breaker is None:
+        return
+
+    for url in breaker.urls_with_pending():
+        if breaker.acquire(url) is not None:
+            _send_held(breaker, url)
+
+
+def record_change(
+    database_id: Optional[str],
+    prev_page_info: Dict[str, Any],
+    page_info: Dict[str, Any],
+    diff: Optional[Dict[str, Any]] = None,
+):
+    """Append the change to the history, if it is enabled."""
+    history = get_change_history()
+    if history is None:
+        return
+    if database_id is None:
+        # Dispatched by an older monitoring
+        parent = page_info.get("parent", {})
+        database_id = parent.get("database_id")
+        if database_id is None:
+            logger.warning("no database id: %s", page_info["id"])
+            return
+
+    version = history.append(database_id, prev_page_info, page_info, diff)
+    logger.info("history version: %s", version)
+
+
+def _schema_churn(
+    prev_info: Dict[str, Any],
+    current_info: Dict[str, Any],
+    database_properties: List[str],
+) -> List[str]:
+    """Properties added to or deleted from the page by a schema change."""
+    prev_names = set(prev_info.get("properties", {}))
+    current_names = set(current_info.get("properties", {}))
+    schema = set(database_properties)
+    added = (current_names - prev_names) & schema
+    deleted = (prev_names - current_names) - schema
+    return sorted(added | deleted)
+
+
+def _without_properties(page_info: Dict[str, Any], names: List[str]):
+    properties = {
+        name: prop
+        for name, prop in page_info.get("properties", {}).items()
+        if name not in names
+    }
+    return page_info | {"properties": properties}
+
+
+def process_page(
+    webhooks_url: List[str],
+    page_info: Dict[str, Any],
+    take_diff: Callable = take_diff_in_page_info,
+    database_properties: Optional[List[str]] = None,
+    database_id: Optional[str] = None,
+):
+    """Save the page and notify the difference from the previous one.
+
+    ``take_diff`` can be replaced to take the difference elsewhere, e.g. in
+    another process. With ``database_properties`` (the properties of the
+    current schema), the properties added or deleted by a schema change are
+    not notified, because the schema change is notified once by itself.
+    The change is recorded in the history under ``database_id``.
+    """
     page_id = page_info["id"]
     logger.info("page_id: %s", page_id)
     last_edited_time = page_info["last_edited_time"]
 
-    prev_page_info = fetch_prev_page_info(page_id)
+    prev_page_info = swap_page_info(page_id, page_info)
     logger.debug("prev_info: %s", prev_page_info)
-    save_page_info(page_id, page_info)
     if prev_page_info == {}:
         # new page
         logger.info("new page: %s", page_id)
+        record_change(database_id, prev_page_info, page_info)
         return
 
-    diff = take_diff_in_page_info(prev_page_info, page_info)
+    # The history rebuilds the pages, so it takes the whole change.
+    change = (prev_page_info, page_info)
+    churn = []
+    if database_properties is not None:
+        churn = _schema_churn(prev_page_info, page_info, database_properties)
+    if churn:
+        logger.info("properties changed by the schema: %s", churn)
+        prev_page_info = _without_properties(prev_page_info, churn)
+        page_info = _without_properties(page_info, churn)
+
+    diff = take_diff(prev_page_info, page_info)
     logger.info("diff in page_info: %s", diff)
+    record_change(database_id, *change, diff)
+    if churn and diff == {}:
+        # Nothing but the schema has changed.
+        return
 
     body = {
         "id": page_id,
         "last_edited_time": last_edited_time,
     } | diff  # '|' means "merge dictionaries"
-    for url in webhooks_url:
-        send_difference(url, body)
+    deliver(webhooks_url, body)
+
+
+def process_schema(
+    webhooks_url: List[str],
+    schema: Dict[str, Any],
+    take_diff: Callable = take_diff_in_page_info,
+):
+    """Save the schema of the database and notify its difference."""
+    database_id = schema["id"]
+    logger.info("database_id: %s", database_id)
+
+    # Saved with the pages, the key doesn't collide with a page ID.
+    prev_schema = swap_page_info(f"schema#{database_id}", schema)
+    if prev_schema == {}:
+        logger.info("new schema: %s", database_id)
+        return
+
+    diff = take_diff(prev_schema, schema)
+    logger.info("diff in schema: %s", diff)
+    if diff == {}:
+        # Dispatched again by another container, or no property changed.
+        return
+
+    body = {
+        "database_id": database_id,
+        "last_edited_time": schema["last_edited_time"],
+    } | diff
+    deliver(webhooks_url, body)
+
+
+def process_event(
+    event: Dict[str, Any],
+    take_diff: Callable = take_diff_in_page_info,
+):
+    """Process an event of a page or a schema from monitoring."""
+    webhooks_url = event["webhooks_url"]
+    if "schema" in event:
+        process_schema(webhooks_url, event["schema"], take_diff)
+        return
+
+    properties = event.get("database_properties")
+    process_page(
+        webhooks_url,
+        event["page_info"],
+        take_diff,
+        properties,
+        event.get("database_id"),
+    )
+
+
+def process_records(records: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Process the SQS messages and report the failed ones.
+
+    Only the failed messages are received again. On a FIFO queue, the
+    later messages of the page of a failed one fail too, to keep the order.
+    """
+    failures = []
+    failed_groups = set()
+    for record in records:
+        group_id = record.get("attributes", {}).get("MessageGroupId")
+        if group_id is not None and group_id in failed_groups:
+            failures.append({"itemIdentifier": record["messageId"]})
+            continue
+
+        message = json.loads(record["body"])
+        request_id = message.get("request_id")
+        logger.structure_logs(append=True, request_id=request_id)
+        try:
+            process_event(message)
+        except Exception:
+            logger.exception("failed to process: %s", record["messageId"])
+            failures.append({"itemIdentifier": record["messageId"]})
+            if group_id is not None:
+                failed_groups.add(group_id)
+
+    return {"batchItemFailures": failures}
+
+
+@logger.inject_lambda_context
+def lambda_function(event: EventBridgeEvent, context: LambdaContext):
+    if "Records" in event:
+        # A batch from the webhooks queue
+        logger.debug("event: %s", event)
+        return process_records(event["Records"])
+
+    if event.get("redeliver"):
+        # Scheduled to retry the held differences
+        send_held_differences()
+        return
+
+    logger.structure_logs(append=True, request_id=event.get("request_id"))
+
+    logger.debug("event: %s", event)
+
+    if "dispatched_at" in event:
+        lag = get_backpressure().observe(event["dispatched_at"])
+        if lag is not None:
+            logger.warning("events are delayed by %.1f seconds", lag)
+
+    process_event(event)
@@ -0,0 +1,150 @@
+import json
+from collections import namedtuple
+
+import boto3
+import pytest
+from moto import mock_dynamodb
+
+from changes.lambda_handler import get_change_history, lambda_function
+from notion_webhooks.history import HISTORY_INDEX_NAME, ChangeHistory
+
+TABLE_NAME = "history-table"
+
+
+@pytest.fixture(autouse=True)
+def setenv(monkeypatch):
+    monkeypatch.setenv("HISTORY_TABLE_NAME", TABLE_NAME)
+
+
+@pytest.fixture(autouse=True)
+def clear_change_history():
+    get_change_history.cache_clear()
+    yield
+    get_change_history.cache_clear()
+
+
+@pytest.fixture(autouse=True)
+def mock_dynamodb_table(monkeypatch):
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+
+    with mock_dynamodb():
+        client = boto3.client("dynamodb")
+        client.create_table(
+            TableName=TABLE_NAME,
+            AttributeDefinitions=[
+                {"AttributeName": "id", "AttributeType": "S"},
+                {"AttributeName": "version", "AttributeType": "N"},
+                {"AttributeName": "database_id", "AttributeType": "S"},
+                {"AttributeName": "last_edited_time", "AttributeType": "S"},
+            ],
+            KeySchema=[
+                {"AttributeName": "id", "KeyType": "HASH"},
+                {"AttributeName": "version", "KeyType": "RANGE"},
+            ],
+            GlobalSecondaryIndexes=[
+                {
+                    "IndexName": HISTORY_INDEX_NAME,
+                    "KeySchema": [
+                        {"AttributeName": "database_id", "KeyType": "HASH"},
+                        {"AttributeName": "last_edited_time", "KeyType": "RANGE"},
+                    ],
+                    "Projection": {"ProjectionType": "ALL"},
+                },
+            ],
+            BillingMode="PAY_PER_REQUEST",
+        )
+
+        yield
+
+
+@pytest.fixture
+def lambda_context():
+    lambda_context = {
+        "function_name": "list_items",
+        "memory_limit_in_mb": 128,
+        "invoked_function_arn": "arn:aws:lambda:ap-northeast-1:123456789012:function:lambda",
+        "aws_request_id": "52fdfc07-2182-454f-963f-5f0f9a621d72",
+    }
+
+    return namedtuple("LambdaContext", lambda_context.keys())(*lambda_context.values())
+
+
+def create_page_info(page_id, last_edited_time, price):
+    return {
+        "object": "page",
+        "id": page_id,
+        "last_edited_time": last_edited_time,
+        "properties": {
+            "Price": {"id": "%3AaT", "type": "number", "number": price},
+        },
+    }
+
+
+def record_changes():
+    history = ChangeHistory(TABLE_NAME, boto3.client("dynamodb"))
+    for page_id in ["P001", "P002", "P003"]:
+        prev_page_info = create_page_info(page_id, "2024-01-05T00:00:00.000Z", 1)
+        history.append("D001", {}, prev_page_info)
+        minute = page_id[-1]
+        page_info = create_page_info(page_id, f"2024-01-05T03:5{minute}:00.000Z", 2)
+        diff = {"changed": {"new": {"properties": {"Price": {"number": 2}}}}}
+        history.append("D001", prev_page_info, page_info, diff)
+
+
+def url_event(params):
+    return {
+        "rawPath": "/",
+        "queryStringParameters": params,
+        "requestContext": {"http": {"method": "GET"}},
+    }
+
+
+def test_query_changes(lambda_context):
+    # prepare
+    record_changes()
+
+    # execute
+    event = url_event({"database_id": "D001", "since": "2024-01-05T03:51:30Z"})
+    act = lambda_function(event, lambda_context)
+
+    # verify
+    assert 200 == act["statusCode"]
+    body = json.loads(act["body"])
+    assert ["P002", "P003"] == [c["id"] for c in body["changes"]]
+    assert {"id", "version", "last_edited_time", "diff"} == set(body["changes"][0])
+    assert "next_token" not in body
+
+
+def test_query_changes_paginated(lambda_context):
+    # prepare
+    record_changes()
+
+    # execute
+    ids = []
+    params = {"database_id": "D001", "since": "2024-01-05T01:00:00Z", "limit": "1"}
+    while True:
+        body = json.loads(lambda_function(url_event(params), lambda_context)["body"])
+        ids += [c["id"] for c in body["changes"]]
+        if "next_token" not in body:
+            break
+        params["next_token"] = body["next_token"]
+
+    # verify
+    assert ["P001", "P002", "P003"] == ids
+
+
+@pytest.mark.parametrize(
+    "params",
+    [
+        {"since": "2024-01-05T01:00:00Z"},
+        {"database_id": "D001", "since": "yesterday"},
+        {"database_id": "D001", "since": "2024-01-05T01:00:00Z", "limit": "0"},
+        {"database_id": "D001", "since": "2024-01-05T01:00:00Z", "next_token": "x"},
+    ],
+)
+def test_bad_request(lambda_context, params):
+    # execute
+    act = lambda_function(url_event(params), lambda_context)
+
+    # verify
+    assert 400 == act["statusCode"]
@@ -1,13 +1,36 @@
 import json
 from collections import namedtuple
 
+import boto3
 import pytest
 from freezegun import freeze_time
+from moto import mock_sqs
 from pytest_mock import MockerFixture
 
-from monitoring.lambda_handler import lambda_function
+from monitoring.lambda_handler import (
+    AdaptiveRateLimiter,
+    RateLimiter,
+    get_backpressure,
+    get_client,
+    get_webhooks_rate_limiter,
+    lambda_function,
+)
 
 LAMBDA_NAME_WEBHOOKS = "webhooks-lambda"
+# time.time() at 2024-01-05T03:58:00Z
+DISPATCHED_AT = 1704427080.0
+
+
+@pytest.fixture(autouse=True)
+def clear_client_cache():
+    # The clients are cached per container, but mocked per test.
+    get_client.cache_clear()
+    get_webhooks_rate_limiter.cache_clear()
+    get_backpressure.cache_clear()
+    yield
+    get_client.cache_clear()
+    get_webhooks_rate_limiter.cache_clear()
+    get_backpressure.cache_clear()
 
 
 @pytest.fixture(autouse=True)
@@ -38,6 +61,7 @@ def lambda_context():
         "memory_limit_in_mb": 128,
         "invoked_function_arn": "arn:aws:lambda:ap-northeast-1:123456789012:function:lambda",
         "aws_request_id": "67f67f77-c1e4-4ffa-913b-11cfe51d961d",
+        "get_remaining_time_in_millis": lambda: 300000,
     }
 
     return namedtuple("LambdaContext", lambda_context.keys())(*lambda_context.values())
@@ -126,6 +150,8 @@ def test_monitoring(mocker, mock_lambda_client, lambda_context):
             "webhooks_url": event["webhooks_url"],
             "page_info": body["results"][0],
             "request_id": event["request_id"],
+            "database_id": event["database_id"],
+            "dispatched_at": DISPATCHED_AT,
         }
     )
     mock_lambda_client.invoke.assert_called_once_with(
@@ -133,3 +159,635 @@ def test_monitoring(mocker, mock_lambda_client, lambda_context):
         InvocationType="Event",
         Payload=exp,
     )
+
+
+def create_page(page_id, last_edited_time):
+    return {
+        "object": "page",
+        "id": page_id,
+        "last_edited_time": last_edited_time,
+        "properties": {},
+    }
+
+
+def mock_notion_api(mocker, responses):
+    """Mock the Notion API with a response body per requested URL."""
+
+    def _urlopen(req, *args, **kwargs):
+        body = responses[req.full_url]
+        if isinstance(body, list):
+            body = body.pop(0)
+        mock_read = mocker.MagicMock(return_value=json.dumps(body))
+        mock_res = mocker.MagicMock(read=mock_read)
+        mock_cm = mocker.MagicMock()
+        mock_cm.__enter__.return_value = mock_res
+        return mock_cm
+
+    mock_urlopen = mocker.MagicMock(side_effect=_urlopen)
+    mocker.patch("urllib.request.urlopen", mock_urlopen)
+    return mock_urlopen
+
+
+def query_url(database_id):
+    return f"https://api.notion.com/v1/databases/{database_id}/query"
+
+
+@freeze_time("2024-01-05T03:58:00Z")
+def test_monitoring_coalesced_databases(mocker, mock_lambda_client, lambda_context):
+    # prepare
+    page1 = create_page("P001", "2024-01-05T03:58:00.000Z")
+    page2 = create_page("P002", "2024-01-05T03:58:00.000Z")
+    mock_notion_api(
+        mocker,
+        {
+            query_url("D001"): {
+                "results": [page1],
+                "next_cursor": None,
+                "has_more": False,
+            },
+            query_url("D002"): {
+                "results": [page2],
+                "next_cursor": None,
+                "has_more": False,
+            },
+        },
+    )
+
+    # execute
+    event = {
+        "databases": [
+            {"database_id": "D001", "webhooks_url": ["https://a.example.com"]},
+            {"database_id": "D002", "webhooks_url": ["https://b.example.com"]},
+        ],
+        "request_id": "20b4014c-beb2-839ce70cb-470d-13b618e",
+    }
+    lambda_function(event, lambda_context)
+
+    # verify
+    payloads = sorted(
+        (
+            json.loads(c.kwargs["Payload"])
+            for c in mock_lambda_client.invoke.call_args_list
+        ),
+        key=lambda p: p["page_info"]["id"],
+    )
+    assert [
+        {
+            "webhooks_url": ["https://a.example.com"],
+            "page_info": page1,
+            "request_id": event["request_id"],
+            "database_id": "D001",
+            "dispatched_at": DISPATCHED_AT,
+        },
+        {
+            "webhooks_url": ["https://b.example.com"],
+            "page_info": page2,
+            "request_id": event["request_id"],
+            "database_id": "D002",
+            "dispatched_at": DISPATCHED_AT,
+        },
+    ] == payloads
+
+
+@freeze_time("2024-01-05T03:58:00Z")
+def test_monitoring_continue_before_timeout(mocker, mock_lambda_client, lambda_context):
+    # prepare
+    pages = [create_page(f"P00{i}", "2024-01-05T03:58:00.000Z") for i in range(4)]
+    mock_notion_api(
+        mocker,
+        {
+            query_url("D001"): [
+                {
+                    "results": pages[:2],
+                    "next_cursor": "C001",
+                    "has_more": True,
+                },
+                {
+                    "results": pages[2:],
+                    "next_cursor": None,
+                    "has_more": False,
+                },
+            ],
+        },
+    )
+    # Runs out of time while dispatching the 4th page.
+    remaining = iter([300000, 300000, 300000, 1000])
+    lambda_context = lambda_context._replace(
+        get_remaining_time_in_millis=lambda: next(remaining)
+    )
+
+    # execute
+    event = {
+        "database_id": "D001",
+        "webhooks_url": ["https://www.example.com"],
+        "request_id": "20b4014c-beb2-839ce70cb-470d-13b618e",
+    }
+    lambda_function(event, lambda_context)
+
+    # verify
+    call_args_list = mock_lambda_client.invoke.call_args_list
+    assert 4 == len(call_args_list)
+    dispatched = [
+        json.loads(c.kwargs["Payload"])["page_info"]["id"] for c in call_args_list[:3]
+    ]
+    assert ["P000", "P001", "P002"] == dispatched
+
+    kwargs = call_args_list[3].kwargs
+    assert lambda_context.function_name == kwargs["FunctionName"]
+    continuation = json.loads(kwargs["Payload"])["continuation"]
+    assert "C001" == continuation["start_cursor"]
+    assert 1 == continuation["offset"]
+
+
+@freeze_time("2024-01-05T04:10:00Z")
+def test_monitoring_resume_from_continuation(
+    mocker, mock_lambda_client, lambda_context
+):
+    # prepare
+    pages = [create_page(f"P00{i}", "2024-01-05T03:58:00.000Z") for i in range(2)]
+    mock_urlopen = mock_notion_api(
+        mocker,
+        {
+            query_url("D001"): {
+                "results": pages,
+                "next_cursor": None,
+                "has_more": False,
+            },
+        },
+    )
+    filter_conditions = {"timestamp": "last_edited_time"}
+
+    # execute
+    event = {
+        "database_id": "D001",
+        "webhooks_url": ["https://www.example.com"],
+        "continuation": {
+            "filter": filter_conditions,
+            "start_cursor": "C001",
+            "offset": 1,
+        },
+        "request_id": "20b4014c-beb2-839ce70cb-470d-13b618e",
+    }
+    lambda_function(event, lambda_context)
+
+    # verify
+    req = mock_urlopen.call_args.args[0]
+    body = json.loads(req.data)
+    assert filter_conditions == body["filter"]
+    assert "C001" == body["start_cursor"]
+
+    kwargs = mock_lambda_client.invoke.call_args.kwargs
+    assert "P001" == json.loads(kwargs["Payload"])["page_info"]["id"]
+    assert 1 == mock_lambda_client.invoke.call_count
+
+
+def mock_notion_api_by_window(mocker, pages):
+    """Mock the Notion API, returning the pages within the queried window."""
+
+    def _urlopen(req, *args, **kwargs):
+        conds = json.loads(req.data)["filter"]["and"]
+        start = conds[0]["last_edited_time"]
+        end = conds[1]["last_edited_time"]["on_or_before"]
+        results = []
+        for page in pages:
+            t = page["last_edited_time"].replace(".000Z", "+00:00")
+            if "after" in start and not start["after"] < t:
+                continue
+            if "on_or_after" in start and not start["on_or_after"] <= t:
+                continue
+            if t <= end:
+                results.append(page)
+        body = {"results": results, "next_cursor": None, "has_more": False}
+        mock_read = mocker.MagicMock(return_value=json.dumps(body))
+        mock_res = mocker.MagicMock(read=mock_read)
+        mock_cm = mocker.MagicMock()
+        mock_cm.__enter__.return_value = mock_res
+        return mock_cm
+
+    mock_urlopen = mocker.MagicMock(side_effect=_urlopen)
+    mocker.patch("urllib.request.urlopen", mock_urlopen)
+    return mock_urlopen
+
+
+def test_backfill(mocker, mock_lambda_client, lambda_context):
+    # prepare
+    pages = [
+        create_page("P003", "2024-01-05T02:30:00.000Z"),
+        create_page("P001", "2024-01-05T00:10:00.000Z"),
+        create_page("P002", "2024-01-05T01:00:00.000Z"),
+        create_page("P004", "2024-01-05T04:00:00.000Z"),  # out of range
+    ]
+    mock_urlopen = mock_notion_api_by_window(mocker, pages)
+
+    # execute
+    event = {
+        "database_id": "D001",
+        "webhooks_url": ["https://www.example.com"],
+        "backfill": {
+            "start": "2024-01-05T00:00:00Z",
+            "end": "2024-01-05T03:00:00Z",
+            "slice_minutes": 60,
+        },
+        "request_id": "20b4014c-beb2-839ce70cb-470d-13b618e",
+    }
+    lambda_function(event, lambda_context)
+
+    # verify
+    assert 3 == mock_urlopen.call_count
+    dispatched = [
+        json.loads(c.kwargs["Payload"])["page_info"]["id"]
+        for c in mock_lambda_client.invoke.call_args_list
+    ]
+    assert ["P001", "P002", "P003"] == dispatched
+
+
+def test_backfill_continue_before_timeout(mocker, mock_lambda_client, lambda_context):
+    # prepare
+    pages = [
+        create_page("P001", "2024-01-05T00:10:00.000Z"),
+        create_page("P002", "2024-01-05T00:10:00.000Z"),
+        create_page("P003", "2024-01-05T00:20:00.000Z"),
+    ]
+    mock_notion_api_by_window(mocker, pages)
+    remaining = iter([300000, 1000])
+    lambda_context = lambda_context._replace(
+        get_remaining_time_in_millis=lambda: next(remaining)
+    )
+
+    # execute
+    event = {
+        "database_id": "D001",
+        "webhooks_url": ["https://www.example.com"],
+        "backfill": {
+            "start": "2024-01-05T00:00:00Z",
+            "end": "2024-01-05T01:00:00Z",
+        },
+        "request_id": "20b4014c-beb2-839ce70cb-470d-13b618e",
+    }
+    lambda_function(event, lambda_context)
+
+    # verify
+    call_args_list = mock_lambda_client.invoke.call_args_list
+    assert 2 == len(call_args_list)
+    payload = json.loads(call_args_list[1].kwargs["Payload"])
+    assert lambda_context.function_name == call_args_list[1].kwargs["FunctionName"]
+    assert {
+        "start": "2024-01-05T00:10:00.000Z",
+        "end": "2024-01-05T01:00:00Z",
+        "slice_minutes": 60,
+        "dispatched": ["P001"],
+    } == payload["backfill"]
+
+    # resume
+    mock_lambda_client.reset_mock()
+    event["backfill"] = payload["backfill"]
+    lambda_context = lambda_context._replace(
+        get_remaining_time_in_millis=lambda: 300000
+    )
+    lambda_function(event, lambda_context)
+
+    dispatched = [
+        json.loads(c.kwargs["Payload"])["page_info"]["id"]
+        for c in mock_lambda_client.invoke.call_args_list
+    ]
+    assert ["P002", "P003"] == dispatched
+
+
+@freeze_time("2024-01-05T03:58:00Z")
+def test_monitoring_watched_properties(mocker, mock_lambda_client, lambda_context):
+    # prepare
+    page = create_page("P001", "2024-01-05T03:58:00.000Z")
+    page["properties"] = {
+        "Name": {"id": "title", "type": "title", "title": []},
+        "Category": {"id": "%3AaT", "type": "multi_select", "multi_select": []},
+        "Memo": {"id": "m%40Xy", "type": "rich_text", "rich_text": []},
+    }
+    url = query_url("D001") + "?filter_properties=title&filter_properties=%3AaT"
+    mock_notion_api(
+        mocker,
+        {url: {"results": [page], "next_cursor": None, "has_more": False}},
+    )
+
+    # execute
+    event = {
+        "database_id": "D001",
+        "webhooks_url": ["https://www.example.com"],
+        "watched_properties": ["title", "%3AaT"],
+        "request_id": "20b4014c-beb2-839ce70cb-470d-13b618e",
+    }
+    lambda_function(event, lambda_context)
+
+    # verify
+    kwargs = mock_lambda_client.invoke.call_args.kwargs
+    page_info = json.loads(kwargs["Payload"])["page_info"]
+    assert ["Name", "Category"] == list(page_info["properties"].keys())
+
+
+@freeze_time("2024-01-05T03:58:00Z")
+def test_monitoring_database_filter(mocker, mock_lambda_client, lambda_context):
+    # prepare
+    mock_urlopen = mock_notion_api(
+        mocker,
+        {
+            query_url("D001"): {
+                "results": [],
+                "next_cursor": None,
+                "has_more": False,
+            },
+        },
+    )
+    database_filter = {"property": "Status", "status": {"equals": "Done"}}
+
+    # execute
+    event = {
+        "database_id": "D001",
+        "webhooks_url": ["https://www.example.com"],
+        "filter": database_filter,
+        "request_id": "20b4014c-beb2-839ce70cb-470d-13b618e",
+    }
+    lambda_function(event, lambda_context)
+
+    # verify
+    body = json.loads(mock_urlopen.call_args.args[0].data)
+    conds = body["filter"]["and"]
+    assert 3 == len(conds)
+    assert "last_edited_time" == conds[0]["timestamp"]
+    assert "last_edited_time" == conds[1]["timestamp"]
+    assert database_filter == conds[2]
+
+
+@freeze_time("2024-01-05T03:58:00Z")
+def test_monitoring_debounce(mocker, mock_lambda_client, lambda_context):
+    # prepare
+    mock_urlopen = mock_notion_api(
+        mocker,
+        {
+            query_url("D001"): {
+                "results": [],
+                "next_cursor": None,
+                "has_more": False,
+            },
+        },
+    )
+
+    # execute
+    event = {
+        "database_id": "D001",
+        "webhooks_url": ["https://www.example.com"],
+        "debounce_minutes": 5,
+        "request_id": "20b4014c-beb2-839ce70cb-470d-13b618e",
+    }
+    lambda_function(event, lambda_context)
+
+    # verify
+    # only the pages not edited for 5 minutes are found
+    body = json.loads(mock_urlopen.call_args.args[0].data)
+    conds = body["filter"]["and"]
+    exp_start = {"after": "2024-01-05T03:52:00+00:00"}
+    exp_end = {"on_or_before": "2024-01-05T03:53:00+00:00"}
+    assert exp_start == conds[0]["last_edited_time"]
+    assert exp_end == conds[1]["last_edited_time"]
+
+
+@freeze_time("2024-01-05T03:58:00Z")
+def test_monitoring_sqs(mocker, monkeypatch, lambda_context):
+    # prepare
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    pages = [create_page(f"P{i:03}", "2024-01-05T03:58:00.000Z") for i in range(12)]
+    mock_notion_api(
+        mocker,
+        {
+            query_url("D001"): {
+                "results": pages,
+                "next_cursor": None,
+                "has_more": False,
+            },
+        },
+    )
+
+    with mock_sqs():
+        client = boto3.client("sqs")
+        queue_url = client.create_queue(
+            QueueName="webhooks-queue.fifo",
+            Attributes={"FifoQueue": "true"},
+        )["QueueUrl"]
+        monkeypatch.setenv("WEBHOOKS_QUEUE_URL", queue_url)
+        mock_send = mocker.spy(client, "send_message_batch")
+        mocker.patch("boto3.client", return_value=client)
+
+        # execute
+        event = {
+            "database_id": "D001",
+            "webhooks_url": ["https://www.example.com"],
+            "request_id": "20b4014c-beb2-839ce70cb-470d-13b618e",
+        }
+        lambda_function(event, lambda_context)
+
+        # verify
+        # 12 pages are sent in a batch of 10 and a batch of 2
+        act = [len(c.kwargs["Entries"]) for c in mock_send.call_args_list]
+        assert act == [10, 2]
+
+        messages = []
+        while True:
+            ret = client.receive_message(
+                QueueUrl=queue_url,
+                MaxNumberOfMessages=10,
+                AttributeNames=["MessageGroupId"],
+            )
+            if "Messages" not in ret:
+                break
+            messages.extend(ret["Messages"])
+
+        assert len(messages) == 12
+        for message in messages:
+            body = json.loads(message["Body"])
+            assert body["webhooks_url"] == event["webhooks_url"]
+            assert body["request_id"] == event["request_id"]
+            group_id = message["Attributes"]["MessageGroupId"]
+            assert group_id == body["page_info"]["id"]
+
+
+def database_url(database_id):
+    return f"https://api.notion.com/v1/databases/{database_id}"
+
+
+@freeze_time("2024-01-05T03:58:00Z")
+def test_monitoring_schema_events(
+    mocker, monkeypatch, mock_lambda_client, lambda_context
+):
+    # prepare
+    monkeypatch.setenv("SCHEMA_EVENTS", "true")
+    monkeypatch.setattr("monitoring.lambda_handler._schema_versions", {})
+    page = create_page("P001", "2024-01-05T03:58:00.000Z")
+    query_body = {"results": [page], "next_cursor": None, "has_more": False}
+    database_body = {
+        "object": "database",
+        "id": "D001",
+        "last_edited_time": "2024-01-05T03:50:00.000Z",
+        "properties": {
+            "Name": {"id": "title", "name": "Name", "type": "title", "title": {}},
+            "Status": {
+                "id": "Z%3ClH",
+                "name": "Status",
+                "type": "status",
+                "status": {"options": []},
+            },
+        },
+    }
+    mock_notion_api(
+        mocker,
+        {
+            query_url("D001")
+            + "?filter_properties=title": [
+                query_body,
+                query_body,
+            ],
+            database_url("D001"): [database_body, database_body],
+        },
+    )
+
+    # execute
+    # the second run finds the same schema
+    event = {
+        "database_id": "D001",
+        "webhooks_url": ["https://www.example.com"],
+        "watched_properties": ["title"],
+        "request_id": "20b4014c-beb2-839ce70cb-470d-13b618e",
+    }
+    lambda_function(event, lambda_context)
+    lambda_function(event, lambda_context)
+
+    # verify
+    payloads = [
+        json.loads(c.kwargs["Payload"])
+        for c in mock_lambda_client.invoke.call_args_list
+    ]
+    exp_schema = {
+        "id": "D001",
+        "last_edited_time": "2024-01-05T03:50:00.000Z",
+        "properties": {
+            "Name": {"id": "title", "name": "Name", "type": "title"},
+        },
+    }
+    assert [p.get("schema") for p in payloads] == [exp_schema, None, None]
+    assert payloads[1]["database_properties"] == ["Name"]
+    assert payloads[2]["database_properties"] == ["Name"]
+
+
+def test_rate_limiter_frozen_clock():
+    # prepare
+    sleeps = []
+    limiter = RateLimiter(2, capacity=2, clock=lambda: 100.0, sleep=sleeps.append)
+
+    # execute
+    # the clock does not advance while sleeping
+    for _ in range(5):
+        limiter.acquire()
+
+    # verify
+    # a burst of 2, then one per 0.5 seconds without spinning
+    assert [0.5, 1.0, 1.5] == sleeps
+
+
+def test_adaptive_rate_limiter():
+    # prepare
+    limiter = AdaptiveRateLimiter(1, 40, clock=lambda: 0.0, sleep=lambda _: None)
+    assert 10 == limiter.rate
+
+    # execute / verify
+    # additive increase: one per second's worth of successes
+    for _ in range(10):
+        limiter.on_success()
+    assert 11 == pytest.approx(limiter.rate, abs=0.05)
+
+    # multiplicative decrease
+    limiter.on_congestion()
+    assert 5.5 == pytest.approx(limiter.rate, abs=0.05)
+    for _ in range(10):
+        limiter.on_congestion()
+    assert 1 == limiter.rate
+
+    # once per report of webhooks
+    limiter.rate = 8
+    limiter.on_backpressure(1704427000.0)
+    limiter.on_backpressure(1704427000.0)
+    assert 4 == limiter.rate
+    limiter.on_backpressure(1704427010.0)
+    assert 2 == limiter.rate
+
+
+@freeze_time("2024-01-05T03:58:00Z")
+def test_monitoring_invoke_throttled(mocker, mock_lambda_client, lambda_context):
+    # prepare
+    mock_notion_api(
+        mocker,
+        {
+            query_url("D001"): {
+                "results": [create_page("P001", "2024-01-05T03:58:00.000Z")],
+                "next_cursor": None,
+                "has_more": False,
+            },
+        },
+    )
+
+    class TooManyRequestsException(Exception):
+        pass
+
+    mock_lambda_client.exceptions.TooManyRequestsException = TooManyRequestsException
+    mock_lambda_client.invoke.side_effect = [TooManyRequestsException(), {}]
+
+    # execute
+    event = {
+        "database_id": "D001",
+        "webhooks_url": ["https://www.example.com"],
+        "request_id": "20b4014c-beb2-839ce70cb-470d-13b618e",
+    }
+    lambda_function(event, lambda_context)
+
+    # verify
+    # retried at half the rate, which increased by the success
+    assert 2 == mock_lambda_client.invoke.call_count
+    assert 6.25 + 1 / 6.25 == get_webhooks_rate_limiter().rate
+
+
+@freeze_time("2024-01-05T03:58:00Z")
+def test_monitoring_backpressure(
+    mocker, monkeypatch, mock_lambda_client, lambda_context
+):
+    # prepare
+    monkeypatch.setenv("TABLE_NAME_PAGE_INFO", "page-info-table")
+    mock_notion_api(
+        mocker,
+        {
+            query_url("D001"): {
+                "results": [],
+                "next_cursor": None,
+                "has_more": False,
+            },
+        },
+    )
+    # webhooks reported a lag 10 seconds ago
+    report = {
+        "id": "pressure#webhooks",
+        "last_edited_time": "2024-01-05T03:57:50+00:00",
+        "lag": 45.0,
+    }
+    mock_lambda_client.get_item.return_value = {
+        "Item": {"page_info": {"S": json.dumps(report)}}
+    }
+
+    # execute
+    event = {
+        "database_id": "D001",
+        "webhooks_url": ["https://www.example.com"],
+        "request_id": "20b4014c-beb2-839ce70cb-470d-13b618e",
+    }
+    lambda_function(event, lambda_context)
+    lambda_function(event, lambda_context)
+
+    # verify
+    # slowed down once for the report
+    kwargs = mock_lambda_client.get_item.call_args.kwargs
+    assert {"id": {"S": "pressure#webhooks"}} == kwargs["Key"]
+    assert 6.25 == get_webhooks_rate_limiter().rate
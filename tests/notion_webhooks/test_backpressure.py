@@ -0,0 +1,45 @@
+from freezegun import freeze_time
+
+from notion_webhooks.backpressure import PRESSURE_KEY, Backpressure
+from notion_webhooks.snapshot_store import MemorySnapshotStore
+
+# time.time() at 2024-01-05T03:58:00Z
+NOW = 1704427080.0
+
+
+@freeze_time("2024-01-05T03:58:00Z")
+def test_observe():
+    # prepare
+    store = MemorySnapshotStore()
+    backpressure = Backpressure(store, max_lag_seconds=30)
+
+    # execute / verify
+    # in time
+    assert backpressure.observe(NOW - 5) is None
+    assert {} == store.get(PRESSURE_KEY)
+
+    # delayed
+    assert 45 == backpressure.observe(NOW - 45)
+    assert {
+        "id": PRESSURE_KEY,
+        "last_edited_time": "2024-01-05T03:58:00+00:00",
+        "lag": 45.0,
+    } == store.get(PRESSURE_KEY)
+
+    # reported once in the interval
+    assert backpressure.observe(NOW - 60) is None
+
+
+def test_reported_at():
+    # prepare
+    store = MemorySnapshotStore()
+    with freeze_time("2024-01-05T03:58:00Z"):
+        Backpressure(store).observe(NOW - 45)
+
+    # execute / verify
+    backpressure = Backpressure(store)
+    assert backpressure.reported_at(60) is None
+    with freeze_time("2024-01-05T03:58:30Z"):
+        assert NOW == backpressure.reported_at(60)
+    with freeze_time("2024-01-05T03:59:30Z"):
+        assert backpressure.reported_at(60) is None
@@ -0,0 +1,105 @@
+import boto3
+import pytest
+from moto import mock_dynamodb
+
+from notion_webhooks.delivery import CLOSED, HALF_OPEN, CircuitBreaker
+
+TABLE_NAME = "delivery-table"
+URL = "https://www.example.com"
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+
+    with mock_dynamodb():
+        client = boto3.client("dynamodb")
+        client.create_table(
+            TableName=TABLE_NAME,
+            AttributeDefinitions=[
+                {"AttributeName": "url", "AttributeType": "S"},
+                {"AttributeName": "key", "AttributeType": "S"},
+            ],
+            KeySchema=[
+                {"AttributeName": "url", "KeyType": "HASH"},
+                {"AttributeName": "key", "KeyType": "RANGE"},
+            ],
+            BillingMode="PAY_PER_REQUEST",
+        )
+
+        yield client
+
+
+def create_body(page_id, last_edited_time):
+    return {"id": page_id, "last_edited_time": last_edited_time, "added": {}}
+
+
+def test_open_after_failures(client):
+    # prepare
+    breaker = CircuitBreaker(TABLE_NAME, client, failure_threshold=3)
+
+    # execute
+    states = []
+    for _ in range(3):
+        states.append(breaker.acquire(URL))
+        breaker.record_failure(URL)
+
+    # verify
+    assert states == [CLOSED, CLOSED, CLOSED]
+    assert breaker.acquire(URL) is None
+
+
+def test_success_resets_failures(client):
+    # prepare
+    breaker = CircuitBreaker(TABLE_NAME, client, failure_threshold=2)
+    breaker.record_failure(URL)
+
+    # execute
+    breaker.record_success(URL)
+    breaker.record_failure(URL)
+
+    # verify
+    assert breaker.acquire(URL) == CLOSED
+
+
+def test_half_open_once(client):
+    # prepare
+    breaker = CircuitBreaker(TABLE_NAME, client, failure_threshold=1, reset_seconds=0)
+    other = CircuitBreaker(TABLE_NAME, client, failure_threshold=1, reset_seconds=0)
+    breaker.record_failure(URL)
+    # both containers have read the open circuit
+    breaker.circuit(URL)
+    other.circuit(URL)
+
+    # execute
+    act1 = breaker.acquire(URL)
+    act2 = other.acquire(URL)
+
+    # verify
+    # only one container probes
+    assert act1 == HALF_OPEN
+    assert act2 is None
+
+
+def test_hold_and_release(client):
+    # prepare
+    breaker = CircuitBreaker(TABLE_NAME, client)
+    body1 = create_body("P001", "2024-01-05T03:58:00.000Z")
+    body2 = create_body("P002", "2024-01-05T03:57:00.000Z")
+    breaker.hold(URL, body1)
+    breaker.hold(URL, body2)
+    breaker.hold(URL, body2)
+
+    # execute
+    held = breaker.held(URL)
+
+    # verify
+    # in the order of the edited time, without the duplicate
+    assert [body for _, body in held] == [body2, body1]
+    assert breaker.circuit(URL)["pending"] == 2
+    assert breaker.urls_with_pending() == [URL]
+
+    key = held[0][0]
+    assert breaker.release(URL, key) is True
+    assert breaker.release(URL, key) is False
+    assert breaker.circuit(URL)["pending"] == 1
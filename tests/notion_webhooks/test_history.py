@@ -0,0 +1,140 @@
+import boto3
+import pytest
+from moto import mock_dynamodb
+
+from notion_webhooks.history import (
+    HISTORY_INDEX_NAME,
+    ChangeHistory,
+    apply_delta,
+    make_delta,
+)
+
+TABLE_NAME = "history-table"
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+
+    with mock_dynamodb():
+        client = boto3.client("dynamodb")
+        client.create_table(
+            TableName=TABLE_NAME,
+            AttributeDefinitions=[
+                {"AttributeName": "id", "AttributeType": "S"},
+                {"AttributeName": "version", "AttributeType": "N"},
+                {"AttributeName": "database_id", "AttributeType": "S"},
+                {"AttributeName": "last_edited_time", "AttributeType": "S"},
+            ],
+            KeySchema=[
+                {"AttributeName": "id", "KeyType": "HASH"},
+                {"AttributeName": "version", "KeyType": "RANGE"},
+            ],
+            GlobalSecondaryIndexes=[
+                {
+                    "IndexName": HISTORY_INDEX_NAME,
+                    "KeySchema": [
+                        {"AttributeName": "database_id", "KeyType": "HASH"},
+                        {"AttributeName": "last_edited_time", "KeyType": "RANGE"},
+                    ],
+                    "Projection": {"ProjectionType": "ALL"},
+                },
+            ],
+            BillingMode="PAY_PER_REQUEST",
+        )
+
+        yield client
+
+
+def create_page_info(page_id, last_edited_time, price):
+    return {
+        "object": "page",
+        "id": page_id,
+        "last_edited_time": last_edited_time,
+        "properties": {
+            "Name": {"id": "title", "type": "title", "title": ["日本語"]},
+            "Price": {"id": "%3AaT", "type": "number", "number": price},
+        },
+    }
+
+
+def test_delta():
+    # prepare
+    prev = create_page_info("P001", "2024-01-05T03:57:00.000Z", 1)
+    prev["properties"]["Tags"] = {"id": "a", "multi_select": ["x"]}
+    cur = create_page_info("P001", "2024-01-05T03:58:00.000Z", None)
+    cur["properties"]["Name"]["title"] = ["英語", "日本語"]
+    cur["archived"] = False
+
+    # execute
+    delta = make_delta(prev, cur)
+
+    # verify
+    assert apply_delta(prev, delta) == cur
+    assert ["properties", "Tags"] in delta["unset"]
+
+
+def test_append_and_rebuild(client):
+    # prepare
+    history = ChangeHistory(TABLE_NAME, client, snapshot_interval=3)
+    page_infos = [
+        create_page_info("P001", f"2024-01-05T03:5{i}:00.000Z", i) for i in range(7)
+    ]
+
+    # execute
+    prev_page_info = {}
+    versions = []
+    for page_info in page_infos:
+        versions.append(history.append("D001", prev_page_info, page_info))
+        prev_page_info = page_info
+
+    # verify
+    assert versions == [1, 2, 3, 4, 5, 6, 7]
+    for version, page_info in zip(versions, page_infos):
+        assert history.get_page_info("P001", version) == page_info
+    assert history.get_page_info("P001") == page_infos[-1]
+    assert history.get_page_info("P002") == {}
+
+    # every 3 versions hold the whole page
+    ret = client.scan(TableName=TABLE_NAME)
+    snapshots = sorted(int(i["version"]["N"]) for i in ret["Items"] if "snapshot" in i)
+    assert snapshots == [1, 4, 7]
+
+
+def test_append_only_edited_time(client):
+    # prepare
+    history = ChangeHistory(TABLE_NAME, client)
+    page_info = create_page_info("P001", "2024-01-05T03:57:00.000Z", 1)
+    history.append("D001", {}, page_info)
+
+    # execute
+    new_page_info = create_page_info("P001", "2024-01-05T03:58:00.000Z", 1)
+    act = history.append("D001", page_info, new_page_info)
+
+    # verify
+    assert act is None
+
+
+def test_query_changes(client):
+    # prepare
+    history = ChangeHistory(TABLE_NAME, client)
+    prev_page_info = create_page_info("P001", "2024-01-05T03:56:00.000Z", 1)
+    history.append("D001", {}, prev_page_info)
+    diff = {"changed": {"new": {"properties": {"Price": {"number": 2}}}}}
+    page_info = create_page_info("P001", "2024-01-05T03:57:00.000Z", 2)
+    history.append("D001", prev_page_info, page_info, diff)
+    other_page_info = create_page_info("P002", "2024-01-05T03:58:00.000Z", 1)
+    history.append("D002", {}, other_page_info)
+
+    # execute
+    act, last_key = history.query_changes("D001", "2024-01-05T03:56:00.000Z")
+
+    # verify
+    exp = {
+        "id": "P001",
+        "version": 2,
+        "last_edited_time": "2024-01-05T03:57:00.000Z",
+        "diff": diff,
+    }
+    assert act == [exp]
+    assert last_key is None
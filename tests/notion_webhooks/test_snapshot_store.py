@@ -0,0 +1,212 @@
+import threading
+
+import boto3
+import pytest
+from moto import mock_dynamodb
+
+from notion_webhooks.snapshot_store import (
+    CachedSnapshotStore,
+    DynamoDbSnapshotStore,
+    MemorySnapshotStore,
+    SqliteSnapshotStore,
+    create_snapshot_store,
+)
+
+TABLE_NAME = "page-info-table"
+
+
+@pytest.fixture
+def dynamodb_store(monkeypatch):
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+
+    with mock_dynamodb():
+        client = boto3.client("dynamodb")
+        client.create_table(
+            TableName=TABLE_NAME,
+            AttributeDefinitions=[
+                {"AttributeName": "id", "AttributeType": "S"},
+            ],
+            KeySchema=[
+                {"AttributeName": "id", "KeyType": "HASH"},
+            ],
+            BillingMode="PAY_PER_REQUEST",
+        )
+
+        yield DynamoDbSnapshotStore(TABLE_NAME, client)
+
+
+@pytest.fixture(params=["dynamodb", "sqlite", "memory"])
+def store(request, tmp_path):
+    if request.param == "dynamodb":
+        return request.getfixturevalue("dynamodb_store")
+    if request.param == "sqlite":
+        return SqliteSnapshotStore(str(tmp_path / "page_info.db"))
+    return MemorySnapshotStore()
+
+
+def create_page_info(page_id, last_edited_time):
+    return {
+        "object": "page",
+        "id": page_id,
+        "last_edited_time": last_edited_time,
+        "properties": {
+            "Name": {"id": "title", "type": "title", "title": ["日本語"]},
+        },
+    }
+
+
+def test_get_new_page(store):
+    assert store.get("P001") == {}
+
+
+def test_put_and_get(store):
+    # prepare
+    page_info = create_page_info("P001", "2024-01-05T03:57:00.000Z")
+    store.put("P001", page_info)
+
+    # execute
+    new_page_info = create_page_info("P001", "2024-01-05T03:58:00.000Z")
+    store.put("P001", new_page_info)
+
+    # verify
+    assert store.get("P001") == new_page_info
+
+
+def test_put_many(store):
+    # prepare
+    page_infos = [
+        create_page_info(f"P{i:03}", "2024-01-05T03:58:00.000Z") for i in range(30)
+    ]
+
+    # execute
+    store.put_many(page_infos)
+
+    # verify
+    for page_info in page_infos:
+        assert store.get(page_info["id"]) == page_info
+
+
+def test_swap(store):
+    # prepare
+    page_info = create_page_info("P001", "2024-01-05T03:57:00.000Z")
+
+    # execute
+    new_page_info = create_page_info("P001", "2024-01-05T03:58:00.000Z")
+    act1 = store.swap("P001", page_info)
+    act2 = store.swap("P001", new_page_info)
+
+    # verify
+    assert act1 == {}
+    assert act2 == page_info
+    assert store.get("P001") == new_page_info
+
+
+def test_put_if_unchanged(store):
+    # prepare
+    page_info = create_page_info("P001", "2024-01-05T03:57:00.000Z")
+    store.put("P001", page_info)
+
+    # execute
+    new_page_info = create_page_info("P001", "2024-01-05T03:58:00.000Z")
+    act1 = store.put_if_unchanged("P001", new_page_info, "2024-01-05T03:56:00.000Z")
+    act2 = store.put_if_unchanged("P001", new_page_info, "2024-01-05T03:57:00.000Z")
+
+    # verify
+    assert act1 is False
+    assert act2 is True
+    assert store.get("P001") == new_page_info
+
+
+def test_cached_store_hit(mocker, store):
+    # prepare
+    cached_store = CachedSnapshotStore(store, 2)
+    page_info = create_page_info("P001", "2024-01-05T03:57:00.000Z")
+    cached_store.swap("P001", page_info)
+    spy_swap = mocker.spy(store, "swap")
+    spy_get = mocker.spy(store, "get")
+
+    # execute
+    new_page_info = create_page_info("P001", "2024-01-05T03:58:00.000Z")
+    act = cached_store.swap("P001", new_page_info)
+
+    # verify
+    # the previous snapshot is not read from the store
+    assert act == page_info
+    assert cached_store.hits == 1
+    spy_swap.assert_not_called()
+    spy_get.assert_not_called()
+    assert store.get("P001") == new_page_info
+
+
+def test_cached_store_stale(store):
+    # prepare
+    cached_store = CachedSnapshotStore(store, 2)
+    page_info = create_page_info("P001", "2024-01-05T03:57:00.000Z")
+    cached_store.swap("P001", page_info)
+    # another process puts a newer snapshot
+    other_page_info = create_page_info("P001", "2024-01-05T03:58:00.000Z")
+    store.put("P001", other_page_info)
+
+    # execute
+    new_page_info = create_page_info("P001", "2024-01-05T03:59:00.000Z")
+    act = cached_store.swap("P001", new_page_info)
+
+    # verify
+    assert act == other_page_info
+    assert cached_store.hits == 0
+    assert store.get("P001") == new_page_info
+
+
+def test_cached_store_eviction():
+    # prepare
+    store = MemorySnapshotStore()
+    cached_store = CachedSnapshotStore(store, 2)
+    for page_id in ["P001", "P002", "P003"]:
+        page_info = create_page_info(page_id, "2024-01-05T03:57:00.000Z")
+        cached_store.swap(page_id, page_info)
+
+    # execute
+    for page_id in ["P001", "P003"]:
+        page_info = create_page_info(page_id, "2024-01-05T03:58:00.000Z")
+        cached_store.swap(page_id, page_info)
+
+    # verify
+    # P001 was evicted as the least recently used
+    assert cached_store.hits == 1
+    assert cached_store.misses == 4
+
+
+def test_sqlite_threads(tmp_path):
+    # prepare
+    store = SqliteSnapshotStore(str(tmp_path / "page_info.db"))
+
+    def put(i):
+        page_info = create_page_info(f"P{i:03}", "2024-01-05T03:58:00.000Z")
+        store.put(page_info["id"], page_info)
+
+    # execute
+    threads = [threading.Thread(target=put, args=(i,)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # verify
+    # a new store reads what the other connections wrote
+    store = SqliteSnapshotStore(str(tmp_path / "page_info.db"))
+    for i in range(8):
+        assert store.get(f"P{i:03}")["id"] == f"P{i:03}"
+
+
+def test_create_snapshot_store(monkeypatch, tmp_path):
+    monkeypatch.setenv("SNAPSHOT_STORE", "sqlite")
+    monkeypatch.setenv("SNAPSHOT_STORE_PATH", str(tmp_path / "page_info.db"))
+    assert isinstance(create_snapshot_store(), SqliteSnapshotStore)
+
+    assert isinstance(create_snapshot_store("memory"), MemorySnapshotStore)
+    assert isinstance(
+        create_snapshot_store("memory", cache_size=10), CachedSnapshotStore
+    )
+
+    with pytest.raises(ValueError):
+        create_snapshot_store("redis")
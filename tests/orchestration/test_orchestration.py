@@ -6,12 +6,20 @@ import pytest
 from moto import mock_dynamodb
 from pytest_mock import MockerFixture
 
-from orchestration.lambda_handler import lambda_function
+from orchestration.lambda_handler import get_client, lambda_function
 
 TABLE_NAME = "database-id-table"
 LAMBDA_NAME_MONITORING = "monitoring-lambda"
 
 
+@pytest.fixture(autouse=True)
+def clear_client_cache():
+    # The clients are cached per container, but mocked per test.
+    get_client.cache_clear()
+    yield
+    get_client.cache_clear()
+
+
 @pytest.fixture(autouse=True)
 def setenv(monkeypatch):
     monkeypatch.setenv("TABLE_NAME", TABLE_NAME)
@@ -188,3 +196,110 @@ def test_two_database_id_two_url(mock_lambda_client, lambda_context):
         ),
     }
     assert exp == kwargs
+
+
+def test_group_database_ids(monkeypatch, mock_lambda_client, lambda_context):
+    # prepare
+    monkeypatch.setenv("MONITORING_GROUP_SIZE", "2")
+    add_record("user01@example.com", "D001", ["https://www.example01.com"])
+    add_record("user01@example.com", "D002", ["https://www.example02.com"])
+    add_record("user01@example.com", "D003", ["https://www.example03.com"])
+
+    # execute
+    event = {"user_id": "user01@example.com"}
+    lambda_function(event, lambda_context)
+
+    # verify
+    call_args_list = mock_lambda_client.invoke.call_args_list
+    assert 2 == len(call_args_list)
+    exp = json.dumps(
+        {
+            "databases": [
+                {
+                    "database_id": "D001",
+                    "webhooks_url": ["https://www.example01.com"],
+                },
+                {
+                    "database_id": "D002",
+                    "webhooks_url": ["https://www.example02.com"],
+                },
+            ],
+            "request_id": lambda_context.aws_request_id,
+        }
+    )
+    assert exp == call_args_list[0].kwargs["Payload"]
+    exp = json.dumps(
+        {
+            "database_id": "D003",
+            "webhooks_url": ["https://www.example03.com"],
+            "request_id": lambda_context.aws_request_id,
+        }
+    )
+    assert exp == call_args_list[1].kwargs["Payload"]
+
+
+def test_watched_properties(mock_lambda_client, lambda_context):
+    # prepare
+    client = boto3.client("dynamodb")
+    client.put_item(
+        TableName=TABLE_NAME,
+        Item={
+            "user_id": {"S": "user01@example.com"},
+            "database_id": {"S": "D001"},
+            "webhooks_url": {"SS": ["https://www.example01.com"]},
+            "watched_properties": {"SS": ["title"]},
+        },
+    )
+
+    # execute
+    event = {"user_id": "user01@example.com"}
+    lambda_function(event, lambda_context)
+
+    # verify
+    kwargs = mock_lambda_client.invoke.call_args.kwargs
+    assert ["title"] == json.loads(kwargs["Payload"])["watched_properties"]
+
+
+def test_database_filter(mock_lambda_client, lambda_context):
+    # prepare
+    database_filter = {"property": "Status", "status": {"equals": "Done"}}
+    client = boto3.client("dynamodb")
+    client.put_item(
+        TableName=TABLE_NAME,
+        Item={
+            "user_id": {"S": "user01@example.com"},
+            "database_id": {"S": "D001"},
+            "webhooks_url": {"SS": ["https://www.example01.com"]},
+            "filter": {"S": json.dumps(database_filter)},
+        },
+    )
+
+    # execute
+    event = {"user_id": "user01@example.com"}
+    lambda_function(event, lambda_context)
+
+    # verify
+    kwargs = mock_lambda_client.invoke.call_args.kwargs
+    assert database_filter == json.loads(kwargs["Payload"])["filter"]
+
+
+def test_debounce_minutes(mock_lambda_client, lambda_context):
+    # prepare
+    client = boto3.client("dynamodb")
+    client.put_item(
+        TableName=TABLE_NAME,
+        Item={
+            "user_id": {"S": "user01@example.com"},
+            "database_id": {"S": "D001"},
+            "webhooks_url": {"SS": ["https://www.example01.com"]},
+            "debounce_minutes": {"N": "5"},
+        },
+    )
+
+    # execute
+    event = {"user_id": "user01@example.com"}
+    lambda_function(event, lambda_context)
+
+    # verify
+    kwargs = mock_lambda_client.invoke.call_args.kwargs
+    assert 5 == json.loads(kwargs["Payload"])["debounce_minutes"]
@@ -0,0 +1,264 @@
+import asyncio
+import json
+
+import boto3
+import pytest
+from freezegun import freeze_time
+from moto import mock_dynamodb
+
+from monitoring.lambda_handler import get_client as get_monitoring_client
+from orchestration.lambda_handler import get_client as get_orchestration_client
+from pipeline.runner import diff_pool, run_once
+from webhooks.lambda_handler import get_snapshot_store
+
+TABLE_NAME_DATABASE_ID = "database-id-table"
+TABLE_NAME_PAGE_INFO = "page-info-table"
+USER_ID = "user@example.com"
+
+
+@pytest.fixture(autouse=True)
+def setenv(monkeypatch):
+    monkeypatch.setenv(
+        "SECRET_KEY", "secret_XXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXX"
+    )
+    monkeypatch.setenv("INTERVAL_MINUTES", "1")
+    monkeypatch.setenv("TABLE_NAME", TABLE_NAME_PAGE_INFO)
+
+
+@pytest.fixture(autouse=True)
+def clear_snapshot_store():
+    # The store is cached per container, but the table differs per test.
+    get_snapshot_store.cache_clear()
+    yield
+    get_snapshot_store.cache_clear()
+
+
+@pytest.fixture(autouse=True)
+def clear_client_cache():
+    get_monitoring_client.cache_clear()
+    get_orchestration_client.cache_clear()
+    yield
+    get_monitoring_client.cache_clear()
+    get_orchestration_client.cache_clear()
+
+
+@pytest.fixture(autouse=True)
+def mock_dynamodb_table(monkeypatch):
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+
+    with mock_dynamodb():
+        client = boto3.client("dynamodb")
+        client.create_table(
+            TableName=TABLE_NAME_DATABASE_ID,
+            AttributeDefinitions=[
+                {"AttributeName": "user_id", "AttributeType": "S"},
+                {"AttributeName": "database_id", "AttributeType": "S"},
+            ],
+            KeySchema=[
+                {"AttributeName": "user_id", "KeyType": "HASH"},
+                {"AttributeName": "database_id", "KeyType": "RANGE"},
+            ],
+            BillingMode="PAY_PER_REQUEST",
+        )
+        client.create_table(
+            TableName=TABLE_NAME_PAGE_INFO,
+            AttributeDefinitions=[
+                {"AttributeName": "id", "AttributeType": "S"},
+            ],
+            KeySchema=[
+                {"AttributeName": "id", "KeyType": "HASH"},
+            ],
+            BillingMode="PAY_PER_REQUEST",
+        )
+
+        yield
+
+
+def register_database(database_id, webhooks_url):
+    client = boto3.client("dynamodb")
+    client.put_item(
+        TableName=TABLE_NAME_DATABASE_ID,
+        Item={
+            "user_id": {"S": USER_ID},
+            "database_id": {"S": database_id},
+            "webhooks_url": {"SS": webhooks_url},
+        },
+    )
+
+
+def save_page_info(page_info):
+    client = boto3.client("dynamodb")
+    client.put_item(
+        TableName=TABLE_NAME_PAGE_INFO,
+        Item={
+            "id": {"S": page_info["id"]},
+            "last_edited_time": {"S": page_info["last_edited_time"]},
+            "page_info": {"S": json.dumps(page_info)},
+        },
+    )
+
+
+def load_page_info(page_id):
+    client = boto3.client("dynamodb")
+    ret = client.get_item(TableName=TABLE_NAME_PAGE_INFO, Key={"id": {"S": page_id}})
+    return json.loads(ret["Item"]["page_info"]["S"])
+
+
+def create_page(page_id, last_edited_time, price):
+    return {
+        "object": "page",
+        "id": page_id,
+        "last_edited_time": last_edited_time,
+        "properties": {
+            "Price": {"id": "%3AaT", "type": "number", "number": price},
+        },
+    }
+
+
+def mock_urlopen(mocker, pages):
+    """Mock the Notion API with the pages per database and the webhooks."""
+    notifications = []
+
+    def _urlopen(req, *args, **kwargs):
+        body = {}
+        if req.full_url.startswith("https://api.notion.com/"):
+            database_id = req.full_url.split("/")[-2]
+            body = {
+                "results": pages[database_id],
+                "next_cursor": None,
+                "has_more": False,
+            }
+        else:
+            notifications.append((req.full_url, json.loads(req.data)))
+        mock_read = mocker.MagicMock(return_value=json.dumps(body))
+        mock_res = mocker.MagicMock(read=mock_read)
+        mock_cm = mocker.MagicMock()
+        mock_cm.__enter__.return_value = mock_res
+        return mock_cm
+
+    mocker.patch("urllib.request.urlopen", side_effect=_urlopen)
+    return notifications
+
+
+@freeze_time("2024-01-05T03:58:00Z")
+def test_run_once(mocker):
+    # prepare
+    register_database("D001", ["https://a.example.com"])
+    register_database("D002", ["https://b.example.com"])
+
+    save_page_info(create_page("P001", "2024-01-05T00:00:00.000Z", 1))
+    page1 = create_page("P001", "2024-01-05T03:58:00.000Z", 5)
+    page2 = create_page("P002", "2024-01-05T03:58:00.000Z", 3)
+    notifications = mock_urlopen(mocker, {"D001": [page1], "D002": [page2]})
+
+    # execute
+    asyncio.run(run_once(USER_ID, TABLE_NAME_DATABASE_ID, "R001"))
+
+    # verify
+    # only the changed page is notified, the new page is just saved
+    exp = {
+        "id": "P001",
+        "last_edited_time": "2024-01-05T03:58:00.000Z",
+        "added": {},
+        "changed": {
+            "old": {"properties": {"Price": {"number": 1}}},
+            "new": {"properties": {"Price": {"number": 5}}},
+        },
+        "deleted": {},
+    }
+    assert notifications == [("https://a.example.com", exp)]
+
+    assert load_page_info("P001") == page1
+    assert load_page_info("P002") == page2
+
+
+@freeze_time("2024-01-05T03:58:00Z")
+def test_run_once_coalesced_databases(mocker, monkeypatch):
+    # prepare
+    monkeypatch.setenv("MONITORING_GROUP_SIZE", "10")
+    register_database("D001", ["https://a.example.com"])
+    register_database("D002", ["https://b.example.com"])
+
+    pages = {
+        "D001": [
+            create_page(f"P1{i:02}", "2024-01-05T03:58:00.000Z", i) for i in range(20)
+        ],
+        "D002": [
+            create_page(f"P2{i:02}", "2024-01-05T03:58:00.000Z", i) for i in range(20)
+        ],
+    }
+    mock_urlopen(mocker, pages)
+
+    # execute
+    # smaller queues than the pages, so monitoring waits for webhooks
+    asyncio.run(
+        run_once(
+            USER_ID,
+            TABLE_NAME_DATABASE_ID,
+            queue_size=2,
+            monitoring_workers=1,
+            webhooks_workers=3,
+        )
+    )
+
+    # verify
+    for database_pages in pages.values():
+        for page in database_pages:
+            assert load_page_info(page["id"]) == page
+
+
+@freeze_time("2024-01-05T03:58:00Z")
+def test_run_once_more_workers_than_threads(mocker):
+    # prepare
+    # more monitoring workers blocked on the queues than the threads of the
+    # default executor
+    database_ids = [f"D{i:03}" for i in range(40)]
+    pages = {}
+    for database_id in database_ids:
+        register_database(database_id, ["https://a.example.com"])
+        page = create_page(f"P{database_id}", "2024-01-05T03:58:00.000Z", 1)
+        pages[database_id] = [page]
+    mock_urlopen(mocker, pages)
+
+    # execute
+    asyncio.run(
+        run_once(
+            USER_ID,
+            TABLE_NAME_DATABASE_ID,
+            queue_size=1,
+            monitoring_workers=40,
+            webhooks_workers=2,
+        )
+    )
+
+    # verify
+    for database_id in database_ids:
+        assert load_page_info(f"P{database_id}") == pages[database_id][0]
+
+
+@freeze_time("2024-01-05T03:58:00Z")
+def test_run_once_diff_processes(mocker):
+    # prepare
+    register_database("D001", ["https://a.example.com"])
+
+    prev_pages = [
+        create_page(f"P{i:03}", "2024-01-05T00:00:00.000Z", i) for i in range(10)
+    ]
+    for page in prev_pages:
+        save_page_info(page)
+    pages = [
+        create_page(f"P{i:03}", "2024-01-05T03:58:00.000Z", i + 1) for i in range(10)
+    ]
+    notifications = mock_urlopen(mocker, {"D001": pages})
+
+    # execute
+    with diff_pool(2) as pool:
+        asyncio.run(run_once(USER_ID, TABLE_NAME_DATABASE_ID, pool=pool))
+
+    # verify
+    act = sorted(body["id"] for _, body in notifications)
+    assert act == [page["id"] for page in pages]
+    for _, body in notifications:
+        number = int(body["id"][1:])
+        new = body["changed"]["new"]["properties"]["Price"]["number"]
+        assert new == number + 1
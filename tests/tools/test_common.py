@@ -0,0 +1,141 @@
+import json
+
+import pytest
+from common import Change, Logic, Model, Plan
+
+USER_ID = "user@example.com"
+DATABASE_ID = "15f6f80f-6b29-4d55-b04a-32fc0f6a0fff"
+DATABASE_ID_2 = "7d3a1e5c-2f8b-4b9a-9e0c-6d1f2a3b4c5d"
+
+
+@pytest.fixture()
+def logic(mocker):
+    model = mocker.MagicMock()
+    model.query_database_id.return_value = []
+    return Logic(model)
+
+
+def test_validate_subscriptions():
+    # prepare
+    subscriptions = {
+        DATABASE_ID: {
+            "webhooks_url": ["https://www.example.com"],
+            "watched_properties": ["title"],
+            "filter": {"property": "Done", "checkbox": {"equals": False}},
+            "debounce_minutes": 5,
+        },
+    }
+
+    # execute / verify
+    assert [] == Logic.validate_subscriptions(subscriptions)
+
+
+@pytest.mark.parametrize(
+    "setting, message",
+    [
+        (["https://www.example.com"], "the setting must be an object"),
+        ({"webhooks_url": []}, "webhooks_url must not be empty"),
+        ({"webhooks_url": [1]}, "webhooks_url must be a list of strings"),
+        (
+            {"webhooks_url": ["https://a"], "watched_properties": "title"},
+            "watched_properties must be a list of strings",
+        ),
+        (
+            {"webhooks_url": ["https://a"], "watched_properties": [1]},
+            "watched_properties must be a list of strings",
+        ),
+        (
+            {"webhooks_url": ["https://a"], "filter": []},
+            "Filter must be a JSON object",
+        ),
+        (
+            {"webhooks_url": ["https://a"], "debounce_minutes": -1},
+            "debounce_minutes must be a non-negative integer",
+        ),
+        (
+            {"webhooks_url": ["https://a"], "debounce_minutes": True},
+            "debounce_minutes must be a non-negative integer",
+        ),
+    ],
+)
+def test_validate_subscriptions_error(setting, message):
+    # execute
+    errors = Logic.validate_subscriptions({DATABASE_ID: setting})
+
+    # verify
+    assert [f"{DATABASE_ID}: {message}"] == errors
+
+
+def test_plan_subscriptions_added(logic):
+    # execute
+    subscriptions = {
+        DATABASE_ID: {
+            "webhooks_url": ["https://www.example.com"],
+            "watched_properties": ["title", "%3AaT"],
+            "filter": {"property": "Done", "checkbox": {"equals": False}},
+            "debounce_minutes": 5,
+        },
+    }
+    plan = logic.plan_subscriptions(USER_ID, subscriptions)
+
+    # verify
+    flt = json.dumps(subscriptions[DATABASE_ID]["filter"])
+    item = Model.Item(
+        USER_ID,
+        DATABASE_ID,
+        ["https://www.example.com"],
+        ["%3AaT", "title"],
+        flt,
+        5,
+    )
+    assert Plan([item], [], []) == plan
+
+
+def test_plan_subscriptions_changed(logic):
+    # prepare
+    logic.model.query_database_id.return_value = [
+        Model.Item(
+            USER_ID,
+            DATABASE_ID,
+            ["https://a.example.com", "https://b.example.com"],
+            ["title"],
+            json.dumps({"property": "Done", "checkbox": {"equals": False}}),
+        ),
+    ]
+
+    # execute
+    # a URL added and another deleted, an option set and another removed
+    subscriptions = {
+        DATABASE_ID: {
+            "webhooks_url": ["https://a.example.com", "https://c.example.com"],
+            "watched_properties": ["title"],
+            "debounce_minutes": 5,
+        },
+    }
+    plan = logic.plan_subscriptions(USER_ID, subscriptions)
+
+    # verify
+    change = Change(
+        DATABASE_ID,
+        ["https://c.example.com"],
+        ["https://b.example.com"],
+        {"filter": None, "debounce_minutes": {"N": "5"}},
+    )
+    assert Plan([], [change], []) == plan
+
+
+def test_plan_subscriptions_unchanged_and_removed(logic):
+    # prepare
+    logic.model.query_database_id.return_value = [
+        Model.Item(USER_ID, DATABASE_ID, ["https://www.example.com"]),
+        Model.Item(USER_ID, DATABASE_ID_2, ["https://www.example.com"]),
+    ]
+
+    # execute
+    subscriptions = {
+        DATABASE_ID: {"webhooks_url": ["https://www.example.com"]},
+    }
+    plan = logic.plan_subscriptions(USER_ID, subscriptions)
+
+    # verify
+    assert Plan([], [], [DATABASE_ID_2]) == plan
@@ -1,15 +1,29 @@
 import json
+import subprocess
+import sys
+import urllib.error
 import urllib.request
 from collections import namedtuple
+from pathlib import Path
 
 import boto3
 import pytest
+from freezegun import freeze_time
 from moto import mock_dynamodb
 from pytest_mock import MockerFixture
 
-from webhooks.lambda_handler import lambda_function
+from notion_webhooks.history import HISTORY_INDEX_NAME, ChangeHistory
+from webhooks.lambda_handler import (
+    get_backpressure,
+    get_change_history,
+    get_circuit_breaker,
+    get_snapshot_store,
+    lambda_function,
+)
 
 TABLE_NAME = "monitoring-table"
+TABLE_NAME_HISTORY = "history-table"
+TABLE_NAME_DELIVERY = "delivery-table"
 
 
 @pytest.fixture(autouse=True)
@@ -17,6 +31,20 @@ def setenv(monkeypatch):
     monkeypatch.setenv("TABLE_NAME", TABLE_NAME)
 
 
+@pytest.fixture(autouse=True)
+def clear_snapshot_store():
+    # The store is cached per container, but the table differs per test.
+    get_snapshot_store.cache_clear()
+    get_change_history.cache_clear()
+    get_circuit_breaker.cache_clear()
+    get_backpressure.cache_clear()
+    yield
+    get_snapshot_store.cache_clear()
+    get_change_history.cache_clear()
+    get_circuit_breaker.cache_clear()
+    get_backpressure.cache_clear()
+
+
 @pytest.fixture(autouse=True)
 def mock_dynamodb_table(monkeypatch):
     monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
@@ -763,3 +791,348 @@ def test_delete_property_from_prev_info(mock_urllib_request_urlopen, lambda_cont
     item = ret["Item"]
     act = item["page_info"]["S"]
     assert json.dumps(page_info, ensure_ascii=False) == act
+
+
+def sqs_record(message_id, page_info, webhooks_url):
+    body = {
+        "webhooks_url": webhooks_url,
+        "page_info": page_info,
+        "request_id": "9f0c4a4e-1b3f-4d52-a1e0-5c1a2f6f3d7e",
+    }
+    return {
+        "messageId": message_id,
+        "body": json.dumps(body),
+        "attributes": {"MessageGroupId": page_info["id"]},
+    }
+
+
+def test_sqs_records_partial_failure(mocker, lambda_context):
+    # prepare
+    page_id_a = "d2b8393e-2817-4009-8311-57f9dcac0185"
+    page_id_b = "0b7c4f7e-6a1d-4d0e-9b55-2d0c8e3f9a41"
+
+    prev_info = create_page_info(page_id_a, "2024-01-05T00:00:00.000Z")
+    client = boto3.client("dynamodb")
+    client.put_item(
+        TableName=TABLE_NAME,
+        Item={
+            "id": {"S": page_id_a},
+            "last_edited_time": {"S": prev_info["last_edited_time"]},
+            "page_info": {"S": json.dumps(prev_info, ensure_ascii=False)},
+        },
+    )
+
+    # the notification of page A fails
+    mocker.patch("urllib.request.urlopen", side_effect=OSError("refused"))
+
+    page_a1 = json.loads(json.dumps(prev_info))
+    page_a1["last_edited_time"] = "2024-01-05T03:57:00.000Z"
+    page_a1["icon"] = {"type": "emoji", "emoji": "🐞"}
+    page_a2 = json.loads(json.dumps(page_a1))
+    page_a2["last_edited_time"] = "2024-01-05T03:58:00.000Z"
+    page_b = create_page_info(page_id_b, "2024-01-05T03:58:00.000Z")
+
+    # execute
+    webhooks_url = ["https://www.example.com"]
+    event = {
+        "Records": [
+            sqs_record("M001", page_a1, webhooks_url),
+            sqs_record("M002", page_b, webhooks_url),
+            sqs_record("M003", page_a2, webhooks_url),
+        ]
+    }
+    act = lambda_function(event, lambda_context)
+
+    # verify
+    # the later message of page A is not processed to keep the order
+    exp = {
+        "batchItemFailures": [
+            {"itemIdentifier": "M001"},
+            {"itemIdentifier": "M003"},
+        ]
+    }
+    assert exp == act
+
+    ret = client.get_item(TableName=TABLE_NAME, Key={"id": {"S": page_id_b}})
+    assert json.loads(ret["Item"]["page_info"]["S"]) == page_b
+
+
+def test_deepdiff_is_imported_lazily():
+    # A fresh interpreter, because deepdiff is already imported by the tests.
+    code = (
+        "import sys, webhooks.lambda_handler; "
+        "sys.exit('deepdiff' in sys.modules or 'boto3' in sys.modules)"
+    )
+    src = Path(__file__).parents[2] / "src"
+    result = subprocess.run([sys.executable, "-c", code], cwd=src)
+    assert result.returncode == 0
+
+
+def test_schema_change(mock_urllib_request_urlopen, lambda_context):
+    # prepare
+    page_id = "d2b8393e-2817-4009-8311-57f9dcac0185"
+    schema = {
+        "id": "36142bf2-4820-4514-8891-12bcb8b8cf2",
+        "last_edited_time": "2024-01-05T00:00:00.000Z",
+        "properties": {
+            "Name": {"id": "title", "name": "Name", "type": "title"},
+        },
+    }
+    new_schema = json.loads(json.dumps(schema))
+    new_schema["last_edited_time"] = "2024-01-05T03:50:00.000Z"
+    new_schema["properties"]["Status"] = {
+        "id": "Z%3ClH",
+        "name": "Status",
+        "type": "status",
+    }
+
+    prev_info = create_page_info(page_id, "2024-01-05T00:00:00.000Z")
+    client = boto3.client("dynamodb")
+    client.put_item(
+        TableName=TABLE_NAME,
+        Item={
+            "id": {"S": page_id},
+            "last_edited_time": {"S": prev_info["last_edited_time"]},
+            "page_info": {"S": json.dumps(prev_info, ensure_ascii=False)},
+        },
+    )
+    # the property added by the schema change
+    page_info = json.loads(json.dumps(prev_info))
+    page_info["last_edited_time"] = "2024-01-05T03:58:00.000Z"
+    page_info["properties"]["Status"] = {
+        "id": "Z%3ClH",
+        "type": "status",
+        "status": None,
+    }
+
+    mock_urlopen = mock_urllib_request_urlopen()
+
+    # execute
+    webhooks_url = ["https://www.example.com"]
+    for event in [
+        {"webhooks_url": webhooks_url, "schema": schema},
+        {"webhooks_url": webhooks_url, "schema": new_schema},
+        # dispatched again by another container
+        {"webhooks_url": webhooks_url, "schema": new_schema},
+        {
+            "webhooks_url": webhooks_url,
+            "page_info": page_info,
+            "database_properties": list(new_schema["properties"]),
+        },
+    ]:
+        lambda_function(event, lambda_context)
+
+    # verify
+    # only the schema change is notified, once
+    mock_urlopen.assert_called_once()
+    act_req: urllib.request.Request = mock_urlopen.call_args.args[0]
+    exp = {
+        "database_id": schema["id"],
+        "last_edited_time": "2024-01-05T03:50:00.000Z",
+        "added": {"properties": {"Status": new_schema["properties"]["Status"]}},
+        "changed": {},
+        "deleted": {},
+    }
+    assert json.loads(act_req.data) == exp
+
+    ret = client.get_item(TableName=TABLE_NAME, Key={"id": {"S": page_id}})
+    assert json.loads(ret["Item"]["page_info"]["S"]) == page_info
+
+
+def test_schema_churn_with_change(mock_urllib_request_urlopen, lambda_context):
+    # prepare
+    page_id = "d2b8393e-2817-4009-8311-57f9dcac0185"
+    prev_info = create_page_info(page_id, "2024-01-05T00:00:00.000Z")
+    client = boto3.client("dynamodb")
+    client.put_item(
+        TableName=TABLE_NAME,
+        Item={
+            "id": {"S": page_id},
+            "last_edited_time": {"S": prev_info["last_edited_time"]},
+            "page_info": {"S": json.dumps(prev_info, ensure_ascii=False)},
+        },
+    )
+    page_info = json.loads(json.dumps(prev_info))
+    page_info["last_edited_time"] = "2024-01-05T03:58:00.000Z"
+    page_info["icon"] = {"type": "emoji", "emoji": "🕷"}
+    page_info["properties"]["Status"] = {
+        "id": "Z%3ClH",
+        "type": "status",
+        "status": None,
+    }
+    properties = list(page_info["properties"])
+
+    mock_urlopen = mock_urllib_request_urlopen()
+
+    # execute
+    event = {
+        "webhooks_url": ["https://www.example.com"],
+        "page_info": page_info,
+        "database_properties": properties,
+    }
+    lambda_function(event, lambda_context)
+
+    # verify
+    # the change of the page is notified without the new property
+    act = json.loads(mock_urlopen.call_args.args[0].data)
+    assert act["added"] == {}
+    assert act["changed"]["new"] == {"icon": {"emoji": "🕷"}}
+
+
+def create_history_table(client):
+    client.create_table(
+        TableName=TABLE_NAME_HISTORY,
+        AttributeDefinitions=[
+            {"AttributeName": "id", "AttributeType": "S"},
+            {"AttributeName": "version", "AttributeType": "N"},
+            {"AttributeName": "database_id", "AttributeType": "S"},
+            {"AttributeName": "last_edited_time", "AttributeType": "S"},
+        ],
+        KeySchema=[
+            {"AttributeName": "id", "KeyType": "HASH"},
+            {"AttributeName": "version", "KeyType": "RANGE"},
+        ],
+        GlobalSecondaryIndexes=[
+            {
+                "IndexName": HISTORY_INDEX_NAME,
+                "KeySchema": [
+                    {"AttributeName": "database_id", "KeyType": "HASH"},
+                    {"AttributeName": "last_edited_time", "KeyType": "RANGE"},
+                ],
+                "Projection": {"ProjectionType": "ALL"},
+            },
+        ],
+        BillingMode="PAY_PER_REQUEST",
+    )
+
+
+def test_change_history(monkeypatch, mock_urllib_request_urlopen, lambda_context):
+    # prepare
+    monkeypatch.setenv("HISTORY_TABLE_NAME", TABLE_NAME_HISTORY)
+    client = boto3.client("dynamodb")
+    create_history_table(client)
+    mock_urllib_request_urlopen()
+
+    page_id = "d2b8393e-2817-4009-8311-57f9dcac0185"
+    prev_info = create_page_info(page_id, "2024-01-05T00:00:00.000Z")
+    page_info = create_page_info(page_id, "2024-01-05T03:58:00.000Z")
+    page_info["properties"]["Category"]["multi_select"] = [{"name": "A"}]
+
+    # execute
+    for info in [prev_info, page_info]:
+        event = {
+            "webhooks_url": ["https://www.example.com"],
+            "page_info": info,
+            "request_id": "20b4014c-beb2-839ce70cb-470d-13b618e",
+            "database_id": "D001",
+        }
+        lambda_function(event, lambda_context)
+
+    # verify
+    history = ChangeHistory(TABLE_NAME_HISTORY, client)
+    assert history.get_page_info(page_id, 1) == prev_info
+    assert history.get_page_info(page_id, 2) == page_info
+
+    changes, _ = history.query_changes("D001", "2024-01-05T00:00:00.000Z")
+    assert [2] == [c["version"] for c in changes]
+    new = changes[0]["diff"]["changed"]["new"]
+    assert [{"name": "A"}] == new["properties"]["Category"]["multi_select"]
+
+
+def test_circuit_breaker(mocker, monkeypatch, lambda_context):
+    # prepare
+    monkeypatch.setenv("DELIVERY_TABLE_NAME", TABLE_NAME_DELIVERY)
+    monkeypatch.setenv("CIRCUIT_FAILURE_THRESHOLD", "1")
+    client = boto3.client("dynamodb")
+    client.create_table(
+        TableName=TABLE_NAME_DELIVERY,
+        AttributeDefinitions=[
+            {"AttributeName": "url", "AttributeType": "S"},
+            {"AttributeName": "key", "AttributeType": "S"},
+        ],
+        KeySchema=[
+            {"AttributeName": "url", "KeyType": "HASH"},
+            {"AttributeName": "key", "KeyType": "RANGE"},
+        ],
+        BillingMode="PAY_PER_REQUEST",
+    )
+
+    dead_url = "https://dead.example.com"
+    sent = []
+
+    def _urlopen(req, *args, **kwargs):
+        if req.full_url == dead_url:
+            raise urllib.error.URLError("timed out")
+        sent.append((req.full_url, json.loads(req.data)["last_edited_time"]))
+        return mocker.MagicMock()
+
+    mock_urlopen = mocker.patch("urllib.request.urlopen", side_effect=_urlopen)
+
+    page_id = "d2b8393e-2817-4009-8311-57f9dcac0185"
+    page_infos = [
+        create_page_info(page_id, f"2024-01-05T03:5{i}:00.000Z") for i in range(4)
+    ]
+    for i, page_info in enumerate(page_infos):
+        page_info["properties"]["Category"]["multi_select"] = [{"name": str(i)}]
+
+    # execute
+    for page_info in page_infos[:3]:
+        event = {
+            "webhooks_url": ["https://www.example.com", dead_url],
+            "page_info": page_info,
+            "request_id": "20b4014c-beb2-839ce70cb-470d-13b618e",
+        }
+        lambda_function(event, lambda_context)
+
+    # verify
+    # the healthy URL gets every difference, the dead one is called only once
+    assert [
+        ("https://www.example.com", "2024-01-05T03:51:00.000Z"),
+        ("https://www.example.com", "2024-01-05T03:52:00.000Z"),
+    ] == sent
+    dead_calls = [
+        c for c in mock_urlopen.call_args_list if c.args[0].full_url == dead_url
+    ]
+    assert 1 == len(dead_calls)
+    assert 10 == dead_calls[0].kwargs["timeout"]
+
+    # execute
+    # the dead URL is back, and the held differences are sent in order
+    monkeypatch.setenv("CIRCUIT_RESET_SECONDS", "0")
+    get_circuit_breaker.cache_clear()
+    dead_url = "https://recovered.example.com"
+    lambda_function({"redeliver": True}, lambda_context)
+
+    # verify
+    assert [
+        "2024-01-05T03:51:00.000Z",
+        "2024-01-05T03:52:00.000Z",
+    ] == [t for url, t in sent if url != "https://www.example.com"]
+    assert [] == get_circuit_breaker().held("https://dead.example.com")
+
+
+@freeze_time("2024-01-05T03:58:00Z")
+def test_backpressure(mock_urllib_request_urlopen, lambda_context):
+    # prepare
+    mock_urllib_request_urlopen()
+    page_info = create_page_info("P001", "2024-01-05T03:57:00.000Z")
+
+    # execute
+    # dispatched by monitoring 45 seconds ago
+    event = {
+        "webhooks_url": ["https://www.example.com"],
+        "page_info": page_info,
+        "request_id": "20b4014c-beb2-839ce70cb-470d-13b618e",
+        "dispatched_at": 1704427080.0 - 45,
+    }
+    lambda_function(event, lambda_context)
+
+    # verify
+    # reported to monitoring
+    client = boto3.client("dynamodb")
+    ret = client.get_item(
+        TableName=TABLE_NAME,
+        Key={"id": {"S": "pressure#webhooks"}},
+    )
+    report = json.loads(ret["Item"]["page_info"]["S"])
+    assert 45 == report["lag"]
@@ -0,0 +1,44 @@
+import os
+
+from common import Logic, Model, Prompt
+
+SLICE_MINUTES = 60
+
+
+def main():
+    # ask profile
+    profile = Prompt.ask_profile()
+
+    model = Model(profile)
+    logic = Logic(model)
+
+    # ask user_id
+    user_id_env = os.getenv("NOTION_USER_EMAIL", "")
+    user_id = Prompt.ask_user_id(user_id_env)
+
+    # fetch database_id
+    print("Fetching your registered database ID...")
+    items = logic.fetch_database_items(user_id)
+
+    if items == {}:
+        print("You have no database settings.")
+        print(
+            "Please register database id by using "
+            "tools/manage_database_id.py"
+        )
+        return
+
+    database_id = Prompt.select_database_id(items.keys())
+    start = Prompt.ask_datetime("Start of the period? (ISO 8601)")
+    end = Prompt.ask_datetime("End of the period? (ISO 8601)")
+    if Prompt.yes_no("Notify the changes in the period. OK?"):
+        item = items[database_id]
+        logic.backfill(item, start, end, SLICE_MINUTES)
+        print("Requested. The changes will be notified soon.")
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    except KeyboardInterrupt:
+        pass
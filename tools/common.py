@@ -3,53 +3,250 @@ import os
 import urllib.parse
 import urllib.request
 from collections import namedtuple
+from datetime import datetime
 from typing import Dict, List
 from uuid import UUID
 
 import boto3
 import questionary
+from notion_webhooks.snapshot_store import (
+    BATCH_WRITE_SIZE,
+    batch_write,
+    create_snapshot_store,
+)
 from questionary import Choice
 
 TABLE_NAME = "notion-webhooks-database-id"
 TABLE_NAME_PAGE_INFO = "notion-webhooks-page-info"
+LAMBDA_NAME_MONITORING = "notion-webhooks-monitoring-lambda"
 ENDPOINT_ROOT = "https://api.notion.com/v1"
+COMPOUND_FILTER_TYPES = ("and", "or")
+
+Change = namedtuple(
+    "Change", ("database_id", "add_urls", "remove_urls", "options")
+)
+Plan = namedtuple("Plan", ("added", "changed", "removed"))
+
+
+def chunked(seq, size=BATCH_WRITE_SIZE):
+    for i in range(0, len(seq), size):
+        yield seq[i : i + size]  # noqa: E203
 
 
 class Model:
-    Item = namedtuple("Item", ("user_id", "database_id", "url_list"))
-    PageInfo = namedtuple("PageInfo", ("id", "last_edited_time", "page_info"))
+    Item = namedtuple(
+        "Item",
+        (
+            "user_id",
+            "database_id",
+            "url_list",
+            "watched_properties",
+            "filter",
+            "debounce_minutes",
+        ),
+        defaults=((), None, None),
+    )
 
     def __init__(self, profile):
         if not profile:
             profile = "default"
         session = boto3.Session(profile_name=profile)
         self.client = session.client("dynamodb")
+        self.lambda_client = session.client("lambda")
+        # SNAPSHOT_STORE selects where the page information is written.
+        self.snapshot_store = create_snapshot_store(
+            table_name=TABLE_NAME_PAGE_INFO, client=self.client
+        )
 
     def query_database_id(self, user_id) -> List[Item]:
-        result = self.client.query(
-            TableName=TABLE_NAME,
-            KeyConditionExpression="user_id = :user_id",
-            ExpressionAttributeValues={":user_id": {"S": user_id}},
-        )
+        kwargs = {
+            "TableName": TABLE_NAME,
+            "KeyConditionExpression": "user_id = :user_id",
+            "ExpressionAttributeValues": {":user_id": {"S": user_id}},
+        }
 
         ret = []
-        for r in result["Items"]:
-            database_id = r["database_id"]["S"]
-            url_list = r["webhooks_url"]["SS"]
-            entity = Model.Item(user_id, database_id, url_list)
-            ret.append(entity)
-        return ret
+        while True:
+            result = self.client.query(**kwargs)
+            for r in result["Items"]:
+                database_id = r["database_id"]["S"]
+                url_list = r["webhooks_url"]["SS"]
+                watched = r.get("watched_properties", {}).get("SS", [])
+                flt = r.get("filter", {}).get("S")
+                debounce = r.get("debounce_minutes", {}).get("N")
+                debounce = int(debounce) if debounce else None
+                item = Model.Item(
+                    user_id, database_id, url_list, watched, flt, debounce
+                )
+                ret.append(item)
+
+            if "LastEvaluatedKey" not in result:
+                return ret
+            kwargs["ExclusiveStartKey"] = result["LastEvaluatedKey"]
 
     def register_item(self, item: Item):
-        self.client.put_item(
+        # Update only the URLs to keep the other settings of the database.
+        self.client.update_item(
             TableName=TABLE_NAME,
-            Item={
+            Key={
                 "user_id": {"S": item.user_id},
                 "database_id": {"S": item.database_id},
-                "webhooks_url": {"SS": item.url_list},
             },
+            UpdateExpression="SET webhooks_url = :url_list",
+            ExpressionAttributeValues={":url_list": {"SS": item.url_list}},
+        )
+
+    def update_watched_properties(self, user_id, database_id, property_ids):
+        key = {
+            "user_id": {"S": user_id},
+            "database_id": {"S": database_id},
+        }
+        if not property_ids:
+            # An empty set is not allowed in DynamoDB, it means "watch all".
+            self.client.update_item(
+                TableName=TABLE_NAME,
+                Key=key,
+                UpdateExpression="REMOVE watched_properties",
+            )
+            return
+
+        self.client.update_item(
+            TableName=TABLE_NAME,
+            Key=key,
+            UpdateExpression="SET watched_properties = :ids",
+            ExpressionAttributeValues={":ids": {"SS": property_ids}},
         )
 
+    def update_filter(self, user_id, database_id, filter_text):
+        key = {
+            "user_id": {"S": user_id},
+            "database_id": {"S": database_id},
+        }
+        if not filter_text:
+            self.client.update_item(
+                TableName=TABLE_NAME,
+                Key=key,
+                UpdateExpression="REMOVE #filter",
+                ExpressionAttributeNames={"#filter": "filter"},
+            )
+            return
+
+        self.client.update_item(
+            TableName=TABLE_NAME,
+            Key=key,
+            UpdateExpression="SET #filter = :filter",
+            ExpressionAttributeNames={"#filter": "filter"},
+            ExpressionAttributeValues={":filter": {"S": filter_text}},
+        )
+
+    def update_debounce_minutes(self, user_id, database_id, minutes):
+        key = {
+            "user_id": {"S": user_id},
+            "database_id": {"S": database_id},
+        }
+        if not minutes:
+            self.client.update_item(
+                TableName=TABLE_NAME,
+                Key=key,
+                UpdateExpression="REMOVE debounce_minutes",
+            )
+            return
+
+        self.client.update_item(
+            TableName=TABLE_NAME,
+            Key=key,
+            UpdateExpression="SET debounce_minutes = :minutes",
+            ExpressionAttributeValues={":minutes": {"N": str(minutes)}},
+        )
+
+    def batch_register_items(self, items: List[Item]):
+        requests = []
+        for item in items:
+            attributes = {
+                "user_id": {"S": item.user_id},
+                "database_id": {"S": item.database_id},
+                "webhooks_url": {"SS": list(item.url_list)},
+            }
+            if item.watched_properties:
+                watched = list(item.watched_properties)
+                attributes["watched_properties"] = {"SS": watched}
+            if item.filter:
+                attributes["filter"] = {"S": item.filter}
+            if item.debounce_minutes:
+                minutes = str(item.debounce_minutes)
+                attributes["debounce_minutes"] = {"N": minutes}
+            requests.append({"PutRequest": {"Item": attributes}})
+
+        batch_write(self.client, TABLE_NAME, requests)
+
+    def batch_remove_items(self, user_id, database_ids: List[str]):
+        requests = [
+            {
+                "DeleteRequest": {
+                    "Key": {
+                        "user_id": {"S": user_id},
+                        "database_id": {"S": database_id},
+                    }
+                }
+            }
+            for database_id in database_ids
+        ]
+        batch_write(self.client, TABLE_NAME, requests)
+
+    def update_subscription(
+        self, user_id, database_id, add_urls, remove_urls, options
+    ):
+        """Apply only the differences of a registered database.
+
+        ``options`` maps an attribute name to its new DynamoDB value, or to
+        None to remove the attribute.
+        """
+        key = {
+            "user_id": {"S": user_id},
+            "database_id": {"S": database_id},
+        }
+        names = {}
+        values = {}
+        set_clauses = []
+        remove_clauses = []
+        for i, (name, value) in enumerate(options.items()):
+            names[f"#o{i}"] = name
+            if value is None:
+                remove_clauses.append(f"#o{i}")
+            else:
+                values[f":o{i}"] = value
+                set_clauses.append(f"#o{i} = :o{i}")
+
+        expression = []
+        if set_clauses:
+            expression.append("SET " + ", ".join(set_clauses))
+        if remove_clauses:
+            expression.append("REMOVE " + ", ".join(remove_clauses))
+        if add_urls:
+            values[":add"] = {"SS": list(add_urls)}
+            expression.append("ADD webhooks_url :add")
+
+        if expression:
+            kwargs = {"ExpressionAttributeValues": values} if values else {}
+            if names:
+                kwargs["ExpressionAttributeNames"] = names
+            self.client.update_item(
+                TableName=TABLE_NAME,
+                Key=key,
+                UpdateExpression=" ".join(expression),
+                **kwargs,
+            )
+
+        # ADD and DELETE can not target the same attribute in one update.
+        # Deleting after adding also never makes the set empty on the way.
+        if remove_urls:
+            self.client.update_item(
+                TableName=TABLE_NAME,
+                Key=key,
+                UpdateExpression="DELETE webhooks_url :remove",
+                ExpressionAttributeValues={":remove": {"SS": remove_urls}},
+            )
+
     def remove_item(self, user_id, database_id):
         self.client.delete_item(
             TableName=TABLE_NAME,
@@ -59,14 +256,36 @@ class Model:
             },
         )
 
-    def register_page_info(self, item: PageInfo):
-        self.client.put_item(
-            TableName=TABLE_NAME_PAGE_INFO,
-            Item={
-                "id": {"S": item.id},
-                "last_edited_time": {"S": item.last_edited_time},
-                "page_info": {"S": item.page_info},
-            },
+    def register_page_info(self, page_info):
+        self.snapshot_store.put(page_info["id"], page_info)
+
+    def scan_page_info(self, segment, total_segments):
+        """Yield the raw items of one segment of a parallel scan."""
+        kwargs = {
+            "TableName": TABLE_NAME_PAGE_INFO,
+            "Segment": segment,
+            "TotalSegments": total_segments,
+        }
+        while True:
+            result = self.client.scan(**kwargs)
+            yield from result["Items"]
+
+            if "LastEvaluatedKey" not in result:
+                return
+            kwargs["ExclusiveStartKey"] = result["LastEvaluatedKey"]
+
+    def batch_put_page_info_items(self, items):
+        requests = [{"PutRequest": {"Item": item}} for item in items]
+        batch_write(self.client, TABLE_NAME_PAGE_INFO, requests)
+
+    def batch_register_page_info(self, page_infos):
+        self.snapshot_store.put_many(page_infos)
+
+    def invoke_monitoring(self, event):
+        self.lambda_client.invoke(
+            FunctionName=LAMBDA_NAME_MONITORING,
+            InvocationType="Event",
+            Payload=json.dumps(event),
         )
 
 
@@ -96,6 +315,60 @@ class Logic:
     def validate_url(cls, text):
         return True
 
+    @classmethod
+    def validate_filter(cls, text):
+        # The filter is AND-combined with the time window by the monitoring
+        # Lambda, and Notion allows nesting compound filters only two deep.
+        if len(text) == 0:
+            return True
+
+        try:
+            filter_ = json.loads(text)
+        except ValueError:
+            return "Invalid JSON"
+
+        if not isinstance(filter_, dict) or len(filter_) == 0:
+            return "Filter must be a JSON object"
+
+        compound = [k for k in COMPOUND_FILTER_TYPES if k in filter_]
+        if not compound:
+            return True
+
+        if len(filter_) != 1 or not isinstance(filter_[compound[0]], list):
+            return f'"{compound[0]}" must be the only key with a list'
+
+        for f in filter_[compound[0]]:
+            if not isinstance(f, dict):
+                return "Filter must be a JSON object"
+            if any(k in f for k in COMPOUND_FILTER_TYPES):
+                return "Compound filters can not be nested"
+
+        return True
+
+    @classmethod
+    def validate_positive_integer(cls, text):
+        if not text.isdecimal() or int(text) == 0:
+            return "Please enter a positive integer"
+        return True
+
+    @classmethod
+    def validate_non_negative_integer(cls, text):
+        if not text.isdecimal():
+            return "Please enter 0 or a positive integer"
+        return True
+
+    @classmethod
+    def validate_datetime(cls, text):
+        try:
+            dt = datetime.fromisoformat(text.replace("Z", "+00:00"))
+        except ValueError:
+            return "Invalid datetime (e.g. 2024-01-05T00:00:00Z)"
+
+        if dt.tzinfo is None:
+            return "Please specify the time zone (e.g. Z, +09:00)"
+
+        return True
+
     def fetch_database_id_url(self, user_id: str) -> Dict[str, List[str]]:
         result = self.model.query_database_id(user_id)
         dic = {}
@@ -104,6 +377,111 @@ class Logic:
 
         return dic
 
+    def fetch_database_items(self, user_id: str) -> Dict[str, Model.Item]:
+        result = self.model.query_database_id(user_id)
+        return {r.database_id: r for r in result}
+
+    @classmethod
+    def validate_subscriptions(cls, subscriptions) -> List[str]:
+        errors = []
+        if not isinstance(subscriptions, dict):
+            return ["The file must be a JSON object keyed by database ID"]
+
+        for database_id, setting in subscriptions.items():
+            result = cls.validate_database_id(database_id)
+            if result is not True:
+                errors.append(f"{database_id}: {result}")
+
+            if not isinstance(setting, dict):
+                errors.append(f"{database_id}: the setting must be an object")
+                continue
+
+            url_list = setting.get("webhooks_url")
+            if not isinstance(url_list, list) or len(url_list) == 0:
+                errors.append(f"{database_id}: webhooks_url must not be empty")
+            elif not all(isinstance(url, str) for url in url_list):
+                message = "webhooks_url must be a list of strings"
+                errors.append(f"{database_id}: {message}")
+
+            watched = setting.get("watched_properties", [])
+            if not isinstance(watched, list) or not all(
+                isinstance(id_, str) for id_ in watched
+            ):
+                message = "watched_properties must be a list of strings"
+                errors.append(f"{database_id}: {message}")
+
+            if "filter" in setting:
+                result = cls.validate_filter(json.dumps(setting["filter"]))
+                if result is not True:
+                    errors.append(f"{database_id}: {result}")
+
+            # bool is a subclass of int
+            debounce = setting.get("debounce_minutes", 0)
+            if (
+                not isinstance(debounce, int)
+                or isinstance(debounce, bool)
+                or debounce < 0
+            ):
+                message = "debounce_minutes must be a non-negative integer"
+                errors.append(f"{database_id}: {message}")
+
+        return errors
+
+    def plan_subscriptions(self, user_id, subscriptions) -> Plan:
+        """Compare the declared subscriptions with the registered ones."""
+        current = self.fetch_database_items(user_id)
+
+        added = []
+        changed = []
+        for database_id, setting in subscriptions.items():
+            watched = sorted(setting.get("watched_properties", []))
+            flt = setting.get("filter")
+            flt = json.dumps(flt) if flt is not None else None
+            debounce = setting.get("debounce_minutes") or None
+            url_list = setting["webhooks_url"]
+            desired = Model.Item(
+                user_id, database_id, url_list, watched, flt, debounce
+            )
+            if database_id not in current:
+                added.append(desired)
+                continue
+
+            item = current[database_id]
+            add_urls = sorted(set(desired.url_list) - set(item.url_list))
+            remove_urls = sorted(set(item.url_list) - set(desired.url_list))
+            options = {}
+            if sorted(item.watched_properties) != watched:
+                value = {"SS": watched} if watched else None
+                options["watched_properties"] = value
+            current_filter = json.loads(item.filter) if item.filter else None
+            if current_filter != setting.get("filter"):
+                options["filter"] = {"S": flt} if flt else None
+            if item.debounce_minutes != debounce:
+                value = {"N": str(debounce)} if debounce else None
+                options["debounce_minutes"] = value
+            if add_urls or remove_urls or options:
+                change = Change(database_id, add_urls, remove_urls, options)
+                changed.append(change)
+
+        removed = sorted(set(current) - set(subscriptions))
+        return Plan(added, changed, removed)
+
+    def apply_plan(self, user_id, plan: Plan):
+        self.model.batch_register_items(plan.added)
+        for change in plan.changed:
+            self.model.update_subscription(
+                user_id,
+                change.database_id,
+                change.add_urls,
+                change.remove_urls,
+                change.options,
+            )
+            if "watched_properties" in change.options:
+                value = change.options["watched_properties"]
+                watched = value["SS"] if value else []
+                self.reregister_page_infos(change.database_id, watched)
+        self.model.batch_remove_items(user_id, plan.removed)
+
     def register(self, user_id, database_id, url_list):
         item = Model.Item(user_id, database_id, url_list)
         self.model.register_item(item)
@@ -111,8 +489,38 @@ class Logic:
     def remove_database(self, user_id, database_id):
         self.model.remove_item(user_id, database_id)
 
-    def query_database(self, database_id):
+    def set_filter(self, user_id, database_id, filter_text):
+        if filter_text:
+            # Store it compactly, whatever the user typed.
+            filter_text = json.dumps(json.loads(filter_text))
+        self.model.update_filter(user_id, database_id, filter_text)
+
+    def set_watched_properties(self, user_id, database_id, ids):
+        self.model.update_watched_properties(user_id, database_id, ids)
+        self.reregister_page_infos(database_id, ids)
+
+    def reregister_page_infos(self, database_id, watched_properties):
+        """Register the pages again with the new watched properties.
+
+        The snapshots are projected by the watched properties, so the
+        properties watched or unwatched since would be notified as added or
+        deleted otherwise.
+        """
+        pages = self.query_database(database_id, watched_properties)
+        self.register_page_infos(pages, watched_properties)
+
+    def set_debounce_minutes(self, user_id, database_id, minutes):
+        self.model.update_debounce_minutes(user_id, database_id, minutes)
+
+    def iter_query_database(self, database_id, properties=None, cursor=""):
+        """Yield the cursor to resume after each request with its pages."""
         url = f"{ENDPOINT_ROOT}/databases/{database_id}/query"
+        if properties:
+            # Property IDs are returned URL-encoded by Notion.
+            url += "?" + "&".join(
+                "filter_properties=" + urllib.parse.quote(id_, safe="%")
+                for id_ in properties
+            )
 
         SECRET_KEY = os.environ["NOTION_SECRET_KEY"]
         headers = {
@@ -121,8 +529,7 @@ class Logic:
             "Notion-Version": "2022-06-28",
         }
 
-        results = []
-        next_cursor = ""
+        next_cursor = cursor
         has_more = True
         while has_more:
             body = {
@@ -136,20 +543,66 @@ class Logic:
             with urllib.request.urlopen(req) as res:
                 body = json.load(res)
 
-            results += body["results"]
-
             next_cursor = body["next_cursor"]
             has_more = body["has_more"]
 
+            yield next_cursor, body["results"]
+
+    def query_database(self, database_id, filter_properties=None):
+        results = []
+        query = self.iter_query_database(database_id, filter_properties)
+        for _, pages in query:
+            results += pages
+
         return results
 
-    def register_page_info(self, page):
-        id_ = page["id"]
-        last_edited_time = page["last_edited_time"]
-        page_info = json.dumps(page, ensure_ascii=False)
+    @classmethod
+    def project_page(cls, page, watched_properties):
+        # Same as the projection of the monitoring Lambda.
+        if not watched_properties:
+            return page
+
+        properties = {
+            name: prop
+            for name, prop in page.get("properties", {}).items()
+            if prop["id"] in watched_properties
+        }
+        return page | {"properties": properties}
 
-        item = Model.PageInfo(id_, last_edited_time, page_info)
-        self.model.register_page_info(item)
+    def register_page_info(self, page, watched_properties=None):
+        page = Logic.project_page(page, watched_properties)
+        self.model.register_page_info(page)
+
+    def register_page_infos(self, pages, watched_properties=None):
+        pages = [
+            Logic.project_page(page, watched_properties) for page in pages
+        ]
+        self.model.batch_register_page_info(pages)
+
+    @classmethod
+    def build_monitoring_database(cls, item: Model.Item):
+        # Same as the databases in the events of the orchestration Lambda.
+        database = {
+            "database_id": item.database_id,
+            "webhooks_url": item.url_list,
+        }
+        if item.watched_properties:
+            database["watched_properties"] = item.watched_properties
+        if item.filter:
+            database["filter"] = json.loads(item.filter)
+        if item.debounce_minutes:
+            database["debounce_minutes"] = item.debounce_minutes
+        return database
+
+    def backfill(self, item: Model.Item, start, end, slice_minutes):
+        event = Logic.build_monitoring_database(item) | {
+            "backfill": {
+                "start": start,
+                "end": end,
+                "slice_minutes": slice_minutes,
+            },
+        }
+        self.model.invoke_monitoring(event)
 
 
 class Prompt:
@@ -187,6 +640,54 @@ class Prompt:
             validate=Logic.validate_url,
         ).unsafe_ask()
 
+    @classmethod
+    def ask_property_ids(cls) -> List[str]:
+        text = questionary.text(
+            "Input the property IDs to watch, separated by commas"
+            " (empty to watch all)"
+        ).unsafe_ask()
+        return [id_.strip() for id_ in text.split(",") if id_.strip()]
+
+    @classmethod
+    def ask_filter(cls) -> str:
+        return questionary.text(
+            "Input the Notion filter as JSON (empty to remove)",
+            validate=Logic.validate_filter,
+        ).unsafe_ask()
+
+    @classmethod
+    def ask_debounce_minutes(cls) -> int:
+        text = questionary.text(
+            "Minutes to wait until the page is no longer edited (0 to remove)",
+            validate=Logic.validate_non_negative_integer,
+        ).unsafe_ask()
+        return int(text)
+
+    @classmethod
+    def ask_directory(cls, default="") -> str:
+        return questionary.path(
+            "Directory?",
+            only_directories=True,
+            validate=Logic.validate_empty_input,
+            default=default,
+        ).unsafe_ask()
+
+    @classmethod
+    def ask_positive_integer(cls, message, default="") -> int:
+        text = questionary.text(
+            message,
+            validate=Logic.validate_positive_integer,
+            default=default,
+        ).unsafe_ask()
+        return int(text)
+
+    @classmethod
+    def ask_datetime(cls, message) -> str:
+        return questionary.text(
+            message,
+            validate=Logic.validate_datetime,
+        ).unsafe_ask()
+
     @classmethod
     def select_operation(cls, ope_list: List[Choice]) -> str:
         return questionary.select(
@@ -1,7 +1,67 @@
+import json
 import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait
 
 import tqdm
-from common import Logic, Model, Prompt
+from common import Logic, Model, Prompt, chunked
+
+MAX_WORKERS = 8
+# Notion responses whose pages may be written at the same time
+MAX_PENDING_RESPONSES = 16
+
+
+def checkpoint_path(database_id):
+    return f".initial_register_{database_id}.checkpoint"
+
+
+def load_checkpoint(path):
+    if not os.path.exists(path):
+        return None
+
+    with open(path) as f:
+        return json.load(f)["next_cursor"]
+
+
+def save_checkpoint(path, next_cursor):
+    with open(path, "w") as f:
+        json.dump({"next_cursor": next_cursor}, f)
+
+
+def flush(pending, progress, path, limit):
+    # The responses are completed in order, so the checkpoint always points
+    # to the first page which may not be written yet.
+    while len(pending) > limit:
+        next_cursor, futures, count = pending.popleft()
+        wait(futures)
+        for future in futures:
+            future.result()
+
+        progress.update(count)
+        if next_cursor:
+            save_checkpoint(path, next_cursor)
+
+
+def register_pages(logic: Logic, database_id, watched, cursor):
+    """Write the pages with BatchWriteItem while fetching the next ones."""
+    path = checkpoint_path(database_id)
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        with tqdm.tqdm(unit="pages", leave=False) as progress:
+            query = logic.iter_query_database(database_id, watched, cursor)
+            for next_cursor, pages in query:
+                futures = [
+                    executor.submit(logic.register_page_infos, chunk, watched)
+                    for chunk in chunked(pages)
+                ]
+                pending.append((next_cursor, futures, len(pages)))
+                flush(pending, progress, path, MAX_PENDING_RESPONSES)
+
+            flush(pending, progress, path, 0)
+
+    # Everything is written, nothing to resume.
+    if os.path.exists(path):
+        os.remove(path)
 
 
 def main():
@@ -17,18 +77,22 @@ def main():
 
     # fetch database_id
     print("Fetching your registered database ID...")
-    id_url_dict = logic.fetch_database_id_url(user_id)
+    items = logic.fetch_database_items(user_id)
 
-    if id_url_dict == {}:
+    if items == {}:
         print("You have no database settings.")
         print("Please register database id by using tools/manage_database_id.py")
         return
 
-    database_id = Prompt.select_database_id(id_url_dict.keys())
+    database_id = Prompt.select_database_id(items.keys())
+    watched_properties = items[database_id].watched_properties
+
+    cursor = load_checkpoint(checkpoint_path(database_id))
+    if cursor and not Prompt.yes_no("Resume from the last checkpoint?"):
+        cursor = None
+
     if Prompt.yes_no("Register page information in DB. OK?"):
-        pages = logic.query_database(database_id)
-        for page in tqdm.tqdm(pages, leave=False):
-            logic.register_page_info(page)
+        register_pages(logic, database_id, watched_properties, cursor or "")
         print("Done.")
 
 
@@ -1,4 +1,7 @@
+import argparse
+import json
 import os
+import sys
 from enum import Enum
 
 from common import Logic, Model, Prompt
@@ -10,6 +13,69 @@ class Operation(Enum):
     REMOVE_DATABASE = 2
     ADD_WEBHOOKS_URL = 3
     REMOVE_WEBHOOKS_URL = 4
+    SET_WATCHED_PROPERTIES = 5
+    SET_FILTER = 6
+    SET_DEBOUNCE_MINUTES = 7
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Manage the Notion databases to monitor."
+    )
+    parser.add_argument(
+        "--apply",
+        metavar="FILE",
+        help="apply a JSON file of {database_id: settings} without prompts",
+    )
+    parser.add_argument("--profile", default="", help="AWS profile")
+    parser.add_argument(
+        "--user-id",
+        default=os.getenv("NOTION_USER_EMAIL", ""),
+        help="user_id (default: $NOTION_USER_EMAIL)",
+    )
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="only show the differences with --apply",
+    )
+    return parser.parse_args()
+
+
+def apply(args):
+    with open(args.apply) as f:
+        subscriptions = json.load(f)
+
+    errors = Logic.validate_subscriptions(subscriptions)
+    if not args.user_id:
+        errors.append("--user-id or NOTION_USER_EMAIL is required")
+    if errors:
+        for error in errors:
+            print(error, file=sys.stderr)
+        sys.exit(1)
+
+    model = Model(args.profile)
+    logic = Logic(model)
+
+    plan = logic.plan_subscriptions(args.user_id, subscriptions)
+    for item in plan.added:
+        print(f"+ {item.database_id}")
+    for change in plan.changed:
+        print(f"~ {change.database_id}")
+        for url in change.add_urls:
+            print(f"    + {url}")
+        for url in change.remove_urls:
+            print(f"    - {url}")
+        for name in change.options:
+            print(f"    ~ {name}")
+    for database_id in plan.removed:
+        print(f"- {database_id}")
+
+    if args.dry_run:
+        return
+
+    logic.apply_plan(args.user_id, plan)
+    added, changed, removed = map(len, plan)
+    print(f"Done. {added} added, {changed} changed, {removed} removed.")
 
 
 def main():
@@ -32,6 +98,9 @@ def main():
         Operation.REMOVE_DATABASE: "remove database",
         Operation.ADD_WEBHOOKS_URL: "add webhooks url",
         Operation.REMOVE_WEBHOOKS_URL: "remove webhooks url",
+        Operation.SET_WATCHED_PROPERTIES: "set watched properties",
+        Operation.SET_FILTER: "set filter",
+        Operation.SET_DEBOUNCE_MINUTES: "set debounce minutes",
     }
     ope_list = [Choice(title=v, value=k) for k, v in operation.items()]
 
@@ -99,8 +168,37 @@ def main():
             logic.register(user_id, database_id, url_list)
             print("Done.")
 
+    elif ope == Operation.SET_WATCHED_PROPERTIES:
+        database_id_list = id_url_dict.keys()
+        database_id = Prompt.select_database_id(database_id_list)
+        property_ids = Prompt.ask_property_ids()
+        print("Update database info...")
+        logic.set_watched_properties(user_id, database_id, property_ids)
+        print("Done.")
+
+    elif ope == Operation.SET_FILTER:
+        database_id_list = id_url_dict.keys()
+        database_id = Prompt.select_database_id(database_id_list)
+        filter_text = Prompt.ask_filter()
+        print("Update database info...")
+        logic.set_filter(user_id, database_id, filter_text)
+        print("Done.")
+
+    elif ope == Operation.SET_DEBOUNCE_MINUTES:
+        database_id_list = id_url_dict.keys()
+        database_id = Prompt.select_database_id(database_id_list)
+        minutes = Prompt.ask_debounce_minutes()
+        print("Update database info...")
+        logic.set_debounce_minutes(user_id, database_id, minutes)
+        print("Done.")
+
 
 if __name__ == "__main__":
+    args = parse_args()
+    if args.apply:
+        apply(args)
+        sys.exit()
+
     try:
         main()
     except KeyboardInterrupt:
@@ -0,0 +1,81 @@
+"""Measure the import time of each Lambda handler in a fresh interpreter.
+
+The handler is imported as on Lambda: the directory of the function and the
+layer (here ``src``) are on ``sys.path``. Run it before and after a change to
+track the cold start.
+
+    python tools/measure_cold_start.py --repeat 10
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SRC = os.path.join(ROOT, "src")
+STAGES = ("orchestration", "monitoring", "webhooks")
+# -X importtime reports microseconds
+IMPORT_TIME_PREFIX = "import time:"
+
+
+def measure(stage):
+    """Return the wall time and the import time of the handler (s), and the
+    cumulative import time of each module it imports directly."""
+    env = os.environ | {
+        "PYTHONPATH": os.pathsep.join([os.path.join(SRC, stage), SRC]),
+    }
+    start = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import lambda_handler"],
+        env=env,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    elapsed = time.perf_counter() - start
+
+    handler = 0
+    modules = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith(IMPORT_TIME_PREFIX) or "cumulative" in line:
+            continue
+        fields = line.removeprefix(IMPORT_TIME_PREFIX)
+        _, cumulative, name = fields.split("|")
+        seconds = int(cumulative) / 1_000_000
+        # The nested imports are indented by 2 spaces per level.
+        if name.strip() == "lambda_handler":
+            handler = seconds
+        elif name.startswith("   ") and not name.startswith("     "):
+            modules[name.strip()] = seconds
+    return elapsed, handler, modules
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--top", type=int, default=5, help="modules to show")
+    parser.add_argument("stages", nargs="*", default=STAGES)
+    args = parser.parse_args()
+
+    # The first run fills the bytecode cache, as it is in the deployed code.
+    for stage in args.stages:
+        measure(stage)
+
+    for stage in args.stages:
+        runs = [measure(stage) for _ in range(args.repeat)]
+        elapsed = statistics.median(e for e, _, _ in runs)
+        handler = statistics.median(h for _, h, _ in runs)
+        modules = runs[-1][2]
+        print(
+            f"{stage}: import {handler * 1000:.0f} ms, "
+            f"process {elapsed * 1000:.0f} ms (median of {args.repeat})"
+        )
+        top = sorted(modules.items(), key=lambda m: m[1], reverse=True)
+        for name, seconds in top[: args.top]:
+            print(f"  {seconds * 1000:8.1f} ms  {name}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+import gzip
+import json
+import os
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from enum import Enum
+from itertools import islice
+
+import tqdm
+from common import Model, Prompt
+from notion_webhooks.snapshot_store import BATCH_WRITE_SIZE
+from questionary import Choice
+
+DEFAULT_DIRECTORY = "./snapshot"
+DEFAULT_SEGMENTS = 8
+SHARD_PREFIX = "page-info-"
+SHARD_SUFFIX = ".jsonl.gz"
+# Items written by one BatchWriteItem worker at a time
+IMPORT_CHUNK_SIZE = BATCH_WRITE_SIZE * 4
+# Chunks read ahead of the writes, to keep the memory bounded
+MAX_PENDING_CHUNKS = 32
+
+
+class Operation(Enum):
+    EXPORT = 1
+    IMPORT = 2
+
+
+def shard_path(directory, segment):
+    name = f"{SHARD_PREFIX}{segment:04d}{SHARD_SUFFIX}"
+    return os.path.join(directory, name)
+
+
+def list_shards(directory):
+    return sorted(
+        os.path.join(directory, name)
+        for name in os.listdir(directory)
+        if name.startswith(SHARD_PREFIX) and name.endswith(SHARD_SUFFIX)
+    )
+
+
+def export_segment(model: Model, directory, segment, total_segments, progress):
+    # Items are kept as DynamoDB JSON, so the import needs no conversion.
+    count = 0
+    path = shard_path(directory, segment)
+    with gzip.open(path, "wt", encoding="utf-8") as f:
+        for item in model.scan_page_info(segment, total_segments):
+            f.write(json.dumps(item, ensure_ascii=False))
+            f.write("\n")
+            count += 1
+            progress.update()
+    return count
+
+
+def export_snapshot(model: Model, directory, total_segments):
+    os.makedirs(directory, exist_ok=True)
+    # The shards of a previous export with more segments would be imported
+    # with the new ones.
+    for path in list_shards(directory):
+        os.remove(path)
+    with ThreadPoolExecutor(max_workers=total_segments) as executor:
+        with tqdm.tqdm(unit="items", leave=False) as progress:
+            futures = [
+                executor.submit(
+                    export_segment,
+                    model,
+                    directory,
+                    segment,
+                    total_segments,
+                    progress,
+                )
+                for segment in range(total_segments)
+            ]
+            return sum(future.result() for future in futures)
+
+
+def read_shard(path):
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        for line in f:
+            yield json.loads(line)
+
+
+def flush(pending, limit):
+    while len(pending) > limit:
+        pending.popleft().result()
+
+
+def import_shard(model: Model, executor, path, progress, pending):
+    items = read_shard(path)
+    while chunk := list(islice(items, IMPORT_CHUNK_SIZE)):
+        future = executor.submit(model.batch_put_page_info_items, chunk)
+        future.add_done_callback(lambda _, n=len(chunk): progress.update(n))
+        pending.append(future)
+        flush(pending, MAX_PENDING_CHUNKS)
+
+
+def import_snapshot(model: Model, directory, max_workers):
+    count = 0
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        with tqdm.tqdm(unit="items", leave=False) as progress:
+            for path in list_shards(directory):
+                import_shard(model, executor, path, progress, pending)
+            flush(pending, 0)
+            count = progress.n
+    return count
+
+
+def main():
+    # ask profile
+    profile = Prompt.ask_profile()
+
+    model = Model(profile)
+
+    operation = {
+        Operation.EXPORT: "export page information to files",
+        Operation.IMPORT: "import page information from files",
+    }
+    ope_list = [Choice(title=v, value=k) for k, v in operation.items()]
+    ope = Prompt.select_operation(ope_list)
+    directory = Prompt.ask_directory(DEFAULT_DIRECTORY)
+    workers = Prompt.ask_positive_integer(
+        "Number of parallel workers?", str(DEFAULT_SEGMENTS)
+    )
+
+    start = time.monotonic()
+    if ope == Operation.EXPORT:
+        print("Exporting page information...")
+        count = export_snapshot(model, directory, workers)
+    elif ope == Operation.IMPORT:
+        if not Prompt.yes_no("Existing items will be overwritten. OK?"):
+            return
+        print("Importing page information...")
+        count = import_snapshot(model, directory, workers)
+
+    elapsed = time.monotonic() - start
+    throughput = count / elapsed if elapsed else count
+    print(f"Done. {count} items in {elapsed:.1f}s ({throughput:.0f} items/s)")
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    except KeyboardInterrupt:
+        pass